@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import logging
+from fastapi                import HTTPException
+from redis.asyncio          import Redis
+from sqlalchemy             import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from api.core.db_con    import JobResult, BatchStatus
+from api.core.redis_con import get_redis
+from api.core.security  import IDEMPOTENCY_TTL, INFLIGHT_TTL
+
+
+# KEYS[1] — обратная ссылка inflight_batch:{batch_id} на метку.
+# Удаляет метку, только если она всё ещё указывает на этот батч
+RELEASE_SCRIPT = """
+local key = redis.call('GET', KEYS[1])
+redis.call('DEL', KEYS[1])
+if key and redis.call('GET', key) == ARGV[1] then
+    return redis.call('DEL', key)
+end
+return 0
+"""
+
+# Продлевает метку и обратную ссылку на ARGV[2] секунд, если метка всё ещё указывает на этот батч
+REFRESH_SCRIPT = """
+local key = redis.call('GET', KEYS[1])
+if key and redis.call('GET', key) == ARGV[1] then
+    redis.call('EXPIRE', key, ARGV[2])
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Пока батч готовится (токенизация и сохранение кода), повторные запросы ждут его появления в БД.
+# Метка batch_pending:{batch_id} снимается после создания батча; TTL — на случай падения API
+BATCH_PENDING_TTL = 10 * 60
+BATCH_WAIT_DELAY = 0.2
+
+
+def idempotency_key_name(idempotency_key: str) -> str:
+    return f"idempotency:{hashlib.sha256(idempotency_key.encode('utf-8')).hexdigest()}"
+
+
+def request_options(request_data) -> str:
+    """Отпечаток опций запроса, от которых зависит результат: запросы с разными опциями не объединяются"""
+    options = request_data.model_dump_json(include={"map_reduce", "repository", "prompt_caching", "use_cache"})
+    return hashlib.sha256(options.encode('utf-8')).hexdigest()[:16]
+
+
+def request_body_hash(request_data, source_hash: str) -> str:
+    """Хеш тела запроса (код — по уже посчитанному source_hash) для проверки повторов с Idempotency-Key"""
+    body = request_data.model_dump_json(exclude={"request"}) + source_hash
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def inflight_key_name(ai_model: str, model: str, source_hash: str, options: str) -> str:
+    return f"inflight:{ai_model}:{model}:{source_hash}:{options}"
+
+
+def pending_key_name(batch_id: str) -> str:
+    return f"batch_pending:{batch_id}"
+
+
+def inflight_batch_key_name(batch_id: str) -> str:
+    # Обратная ссылка: воркер снимает и продлевает метку, зная только batch_id
+    return f"inflight_batch:{batch_id}"
+
+
+async def mark_pending(redis_conn: Redis, batch_id: str) -> None:
+    """Батч готовится: ключи, которые он займёт, ведут на батч, которого ещё нет в БД"""
+    await redis_conn.set(pending_key_name(batch_id), 1, ex=BATCH_PENDING_TTL)
+
+
+async def clear_pending(redis_conn: Redis, batch_id: str) -> None:
+    try:
+        await redis_conn.delete(pending_key_name(batch_id))
+    except Exception as e:
+        logging.warning(f"Could not clear pending key for batch {batch_id}: {e}")
+
+
+async def claim_key(redis_conn: Redis, key: str, value: str, ttl: int) -> str | None:
+    """
+    Занимает ключ под новый батч (SET NX).
+    Возвращает значение, которым ключ уже занят, или None, если ключ занят нами.
+    """
+    if await redis_conn.set(key, value, nx=True, ex=ttl):
+        return None
+    existing = await redis_conn.get(key)
+    if existing is None:
+        # Ключ истёк между SET и GET — пробуем ещё раз
+        return await claim_key(redis_conn, key, value, ttl)
+    return existing.decode('utf-8')
+
+
+async def claim_idempotency_key(redis_conn: Redis, idempotency_key: str, batch_id: str, body_hash: str) -> str | None:
+    """
+    batch_id батча, уже созданного с этим ключом, или None, если ключ занят нами.
+    Повтор с другим телом запроса — 422: ключ не должен отдавать результат другого запроса.
+    """
+    existing = await claim_key(redis_conn, idempotency_key_name(idempotency_key), f"{batch_id}|{body_hash}", IDEMPOTENCY_TTL)
+    if existing is None:
+        return None
+    existing_batch_id, _, existing_body_hash = existing.partition("|")
+    if existing_body_hash != body_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key уже использован с другим телом запроса")
+    return existing_batch_id
+
+
+async def point_idempotency_key(redis_conn: Redis, idempotency_key: str, batch_id: str, body_hash: str) -> None:
+    """Перенаправляет Idempotency-Key на батч, к которому присоединили запрос"""
+    await redis_conn.set(idempotency_key_name(idempotency_key), f"{batch_id}|{body_hash}", ex=IDEMPOTENCY_TTL)
+
+
+async def claim_inflight(redis_conn: Redis, ai_model: str, model: str, source_hash: str, options: str, batch_id: str) -> str | None:
+    key = inflight_key_name(ai_model, model, source_hash, options)
+    existing = await claim_key(redis_conn, key, batch_id, INFLIGHT_TTL)
+    if existing is None:
+        await redis_conn.set(inflight_batch_key_name(batch_id), key, ex=INFLIGHT_TTL)
+    return existing
+
+
+async def take_over_inflight(redis_conn: Redis, ai_model: str, model: str, source_hash: str, options: str, batch_id: str) -> None:
+    """Метка указывает на уже завершённый (или пропавший) батч — занимаем её под новый"""
+    key = inflight_key_name(ai_model, model, source_hash, options)
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.set(key, batch_id, ex=INFLIGHT_TTL)
+        pipe.set(inflight_batch_key_name(batch_id), key, ex=INFLIGHT_TTL)
+        await pipe.execute()
+
+
+async def arelease_inflight(redis_conn: Redis, batch_id: str) -> None:
+    try:
+        await redis_conn.eval(RELEASE_SCRIPT, 1, inflight_batch_key_name(batch_id), batch_id)
+    except Exception as e:
+        logging.warning(f"Could not release in-flight key for batch {batch_id}: {e}")
+
+
+def release_inflight(batch_id: str) -> None:
+    """Снимает метку "в работе" при финализации батча (воркер)"""
+    try:
+        get_redis().eval(RELEASE_SCRIPT, 1, inflight_batch_key_name(batch_id), batch_id)
+    except Exception as e:
+        logging.warning(f"Could not release in-flight key for batch {batch_id}: {e}")
+
+
+def refresh_inflight(batch_id: str) -> None:
+    """
+    Heartbeat метки "в работе" (воркер, при движении задач батча). Метка живёт INFLIGHT_TTL
+    с последнего движения, поэтому зависший батч перестаёт принимать повторные отправки
+    """
+    try:
+        get_redis().eval(REFRESH_SCRIPT, 1, inflight_batch_key_name(batch_id), batch_id, INFLIGHT_TTL)
+    except Exception as e:
+        logging.warning(f"Could not refresh in-flight key for batch {batch_id}: {e}")
+
+
+async def accepts_callback(db: AsyncSession, batch_id: str, callback_url: str | None) -> bool:
+    """К батчу можно присоединить запрос, только если его webhook уйдёт на тот же адрес"""
+    if not callback_url:
+        return True
+    batch_callback_url = (await db.execute(
+        select(BatchStatus.callback_url).where(BatchStatus.batch_id == batch_id)
+    )).scalar_one_or_none()
+    return batch_callback_url == callback_url
+
+
+async def load_existing_batch(
+    db: AsyncSession,
+    redis_conn: Redis,
+    batch_id: str,
+    processing_only: bool = False
+) -> dict | None:
+    """
+    Ответ send_task для уже созданного батча.
+    Батч мог занять ключ и ещё не закоммитить строки — пока он готовится (метка batch_pending), ждём его появления.
+    processing_only — вернуть None, если батч уже завершён (к нему нельзя присоединиться).
+    """
+    query = select(BatchStatus.status, BatchStatus.total_jobs).where(BatchStatus.batch_id == batch_id)
+    while True:
+        batch = (await db.execute(query)).first()
+        if batch is not None:
+            break
+        if not await redis_conn.exists(pending_key_name(batch_id)):
+            # Батч мог закоммититься между чтением и проверкой метки
+            batch = (await db.execute(query)).first()
+            break
+        await asyncio.sleep(BATCH_WAIT_DELAY)
+
+    if batch is None:
+        return None
+    if processing_only and batch.status != 'processing':
+        return None
+
+    jobs = (await db.execute(
+        select(JobResult.job_id, JobResult.prompt_name)
+        .where(
+            JobResult.batch_id == batch_id,
+            JobResult.prompt_name != "MERGED_DOCUMENTATION"
+        )
+        .order_by(JobResult.id)
+    )).all()
+
+    return {
+        "jobs": [{"job_id": job.job_id, "prompt_name": job.prompt_name} for job in jobs],
+        "total": len(jobs),
+        "batch_id": batch_id,
+        "deduplicated": True
+    }
@@ -0,0 +1,105 @@
+import json
+import asyncio
+import logging
+
+from api.core.redis_con import get_redis, get_async_redis
+
+
+# Воркеры публикуют изменения задач и батча в канал batch:{batch_id}, API отдаёт их клиентам через SSE
+CHANNEL_PREFIX = "batch:"
+FINAL_BATCH_STATUSES = ('completed', 'completed_with_errors', 'failed')
+# Сколько ждать подписки хаба на первом подключении, с
+SUBSCRIBE_TIMEOUT = 2
+
+
+def batch_channel(batch_id: str) -> str:
+    return f"{CHANNEL_PREFIX}{batch_id}"
+
+
+def publish_batch_event(batch_id: str, event: str, data: dict) -> None:
+    """
+    Публикует событие батча (воркер). Событие — только подсказка для открытых страниц:
+    состояние хранится в БД, поэтому ошибки Redis не влияют на задачу.
+    """
+    try:
+        get_redis().publish(batch_channel(batch_id), json.dumps({"event": event, "data": data}, default=str))
+    except Exception as e:
+        logging.warning(f"Could not publish {event} event for batch {batch_id}: {e}")
+
+
+class BatchEventHub:
+    """
+    Одна подписка на batch:* на процесс API, события раздаются локальным очередям слушателей.
+    Соединение из пула Redis занимает только хаб, а не каждый открытый SSE поток.
+    """
+    def __init__(self):
+        self._listeners = {}
+        self._task = None
+        self._ready = asyncio.Event()
+
+    @property
+    def connected(self) -> bool:
+        return self._ready.is_set()
+
+    async def subscribe(self, batch_id: str) -> asyncio.Queue:
+        """Очередь событий батча. Ждёт подписки хаба, чтобы снимок, прочитанный после, не разошёлся с событиями"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        queue = asyncio.Queue()
+        self._listeners.setdefault(batch_id, set()).add(queue)
+        try:
+            await asyncio.wait_for(self._ready.wait(), SUBSCRIBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning("Batch event hub is not connected, streaming DB snapshots only")
+        return queue
+
+    def unsubscribe(self, batch_id: str, queue: asyncio.Queue) -> None:
+        listeners = self._listeners.get(batch_id)
+        if listeners is None:
+            return
+        listeners.discard(queue)
+        if not listeners:
+            del self._listeners[batch_id]
+
+    def _broadcast(self, message: dict) -> None:
+        for listeners in self._listeners.values():
+            for queue in listeners:
+                queue.put_nowait(message)
+
+    async def _run(self) -> None:
+        reconnect = False
+        while True:
+            pubsub = get_async_redis().pubsub()
+            try:
+                await pubsub.psubscribe(f"{CHANNEL_PREFIX}*")
+                self._ready.set()
+                if reconnect:
+                    # События за время переподключения потеряны — потоки заново отправят снимок из БД
+                    self._broadcast({"event": "resync", "data": {}})
+                async for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    batch_id = message["channel"].decode("utf-8")[len(CHANNEL_PREFIX):]
+                    for queue in self._listeners.get(batch_id, ()):
+                        queue.put_nowait(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Batch event subscription lost, reconnecting: {e}")
+                reconnect = True
+                await asyncio.sleep(1)
+            finally:
+                self._ready.clear()
+                await pubsub.aclose()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+
+batch_event_hub = BatchEventHub()
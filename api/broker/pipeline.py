@@ -0,0 +1,430 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime           import datetime
+
+from api.core                  import metrics
+from api.core.rate_limiter     import rate_limiter
+from api.core.source_blobs     import compute_source_hash
+from api.broker.response_cache import response_cache
+from api.broker.provider_calls import provider_call_log
+from openai_.call_trace        import start_trace, end_trace
+from openai_.chunker           import split_export_into_chunks, layout_export, ratio_estimator
+
+
+# Доля контекста под промпт в режиме prompt caching: нарезка не должна зависеть от промпта
+PROMPT_CACHING_RESERVE = 0.1
+
+# map-reduce: фрагмент без номера части, чтобы результат по нему можно было кешировать и переиспользовать
+MAP_HEADER = "[Фрагмент репозитория. Выполни задание только для кода этого фрагмента]"
+REDUCE_INSTRUCTION = (
+    "Ниже частичные результаты задания, выполненного по отдельным фрагментам одного репозитория. "
+    "Объедини их в один связный результат в формате задания: убери повторы, сохрани все существенные детали, "
+    "итог должен выглядеть так, как если бы весь репозиторий был обработан за один раз."
+)
+
+
+def build_job_messages(
+    client,
+    prompt: str,
+    request_code: str,
+    prompt_caching: bool = False,
+    request_tokens: int | None = None,
+    prompt_tokens: int | None = None,
+    map_reduce: bool = False,
+    previous_layout: dict | None = None
+) -> tuple:
+    """
+    Готовит сообщения для одной задачи: запрос целиком, если помещается в контекст,
+    иначе чанки с пометкой [Часть i из n] (в режиме map_reduce — с общей пометкой MAP_HEADER).
+    В режиме prompt_caching решение и размер чанков считаются без промпта (с резервом под него),
+    чтобы все промпты батча получили одинаковые чанки и общий кешируемый префикс.
+    request_tokens/prompt_tokens — посчитанные заранее (при отправке и при сохранении промпта);
+    пересчитываются клиентом, только если их нет.
+    previous_layout — инкрементальный режим: раскладка чанков прошлого батча ({} — прошлого нет).
+    Возвращает (список (сообщение, оценка входных токенов), раскладка чанков или None).
+    Оценка токенов идёт в лимитер.
+    """
+    if request_tokens is None:
+        request_tokens = client.count_tokens(request_code)
+    if prompt_tokens is None:
+        prompt_tokens = client.count_tokens(prompt) if prompt else 0
+    system_tokens = prompt_tokens if prompt else 0
+    total_input_tokens = request_tokens + system_tokens
+
+    logging.info(f"{client.model_name} request tokens: {request_tokens}, System tokens: {system_tokens}, Total: {total_input_tokens}, Max: {client.max_tokens}")
+
+    # Нарезка не должна зависеть от промпта: в обоих режимах все промпты батча получают одни и те же чанки
+    if prompt_caching or previous_layout is not None:
+        reserved_tokens = int(client.max_tokens * PROMPT_CACHING_RESERVE)
+        if system_tokens > reserved_tokens:
+            logging.warning(f"Prompt ({system_tokens} tokens) is larger than the reserved {reserved_tokens} tokens")
+    else:
+        reserved_tokens = system_tokens
+
+    if request_tokens + reserved_tokens <= client.max_tokens:
+        return [(request_code, total_input_tokens)], None
+
+    logging.warning(f"Request too large ({total_input_tokens} tokens), splitting into chunks")
+
+    # Размер чанка = 80% от доступного места (оставляем место на ответ)
+    chunk_size = int(client.max_tokens * 0.8) - reserved_tokens
+    # Чанки повторно не токенизируем: оценка по плотности токенов всего кода
+    estimate = ratio_estimator(request_code, request_tokens)
+
+    # Выгрузка репозитория режется по файлам и определениям, остальное — сплиттером клиента
+    fallback_split = lambda text, size: client.split_text_into_chunks(text, chunk_size=size)
+    layout = None
+    if previous_layout is not None:
+        export = layout_export(request_code, chunk_size, estimate, fallback_split, previous_layout)
+        if export is not None:
+            chunks, layout = export
+        else:
+            chunks = fallback_split(request_code, chunk_size)
+    else:
+        chunks = split_export_into_chunks(request_code, chunk_size, estimate, fallback_split)
+
+    if map_reduce:
+        return [(f"{MAP_HEADER}\n\n{chunk}", estimate(chunk) + system_tokens) for chunk in chunks], layout
+
+    return [
+        (f"[Часть {idx} из {len(chunks)}]\n\n{chunk}", estimate(chunk) + system_tokens)
+        for idx, chunk in enumerate(chunks, 1)
+    ], layout
+
+
+def sum_usage(results: list) -> dict:
+    total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+    for result in results:
+        for key in total_usage:
+            total_usage[key] += result["usage"].get(key, 0)
+    return total_usage
+
+
+def merge_call_results(results: list) -> dict:
+    """Склеивает ответы в порядке чанков и суммирует usage"""
+    if len(results) == 1:
+        return results[0]
+
+    return {
+        "text": '\n\n'.join(result["text"] for result in results),
+        "usage": sum_usage(results)
+    }
+
+
+def _extra_tokens(result: dict, reserved_tokens: int) -> int:
+    """Сколько токенов вызов потратил сверх фактически зарезервированных лимитером (ответ + ошибка оценки)"""
+    return result["usage"].get("total_tokens", 0) - reserved_tokens
+
+
+def _record_call(ai_model: str, model: str, result: dict) -> None:
+    metrics.PROVIDER_CALLS.labels(ai_model, model, "ok").inc()
+    metrics.record_provider_usage(ai_model, model, result["usage"])
+
+
+def call_provider(
+    client,
+    ai_model: str,
+    message: str,
+    tokens: int,
+    prompt: str,
+    prompt_caching: bool = False,
+    job_id: str | None = None,
+    kind: str = "chunk",
+    chunk_index: int | None = None,
+    enqueued_at: datetime | None = None
+) -> dict:
+    """
+    Один вызов провайдера через общий лимитер.
+    job_id, kind, chunk_index, enqueued_at — для журнала provider_calls.
+    """
+    enqueued_at = enqueued_at or datetime.utcnow()
+    reserved = rate_limiter.acquire(ai_model, client.model_name, tokens)
+    # Ретраи клиента резервируют место в лимитере так же, как первая попытка
+    trace, token = start_trace(lambda: rate_limiter.acquire(ai_model, client.model_name, tokens), reserved)
+    sent_at = datetime.utcnow()
+    try:
+        with metrics.PROVIDER_CALL_SECONDS.labels(ai_model, client.model_name).time():
+            result = client.send_message_with_usage(message, system_prompt=prompt, prompt_caching=prompt_caching)
+    except Exception:
+        metrics.PROVIDER_CALLS.labels(ai_model, client.model_name, "error").inc()
+        provider_call_log.record(job_id, ai_model, client.model_name, kind, chunk_index, enqueued_at, sent_at, trace, None)
+        raise
+    finally:
+        end_trace(token)
+    _record_call(ai_model, client.model_name, result)
+    provider_call_log.record(job_id, ai_model, client.model_name, kind, chunk_index, enqueued_at, sent_at, trace, result["usage"])
+    rate_limiter.charge(ai_model, client.model_name, _extra_tokens(result, trace.reserved))
+    return result
+
+
+async def acall_provider(
+    client,
+    ai_model: str,
+    message: str,
+    tokens: int,
+    prompt: str,
+    prompt_caching: bool = False,
+    job_id: str | None = None,
+    kind: str = "chunk",
+    chunk_index: int | None = None,
+    enqueued_at: datetime | None = None
+) -> dict:
+    """Асинхронный вариант call_provider"""
+    enqueued_at = enqueued_at or datetime.utcnow()
+    reserved = await rate_limiter.aacquire(ai_model, client.model_name, tokens)
+    trace, token = start_trace(lambda: rate_limiter.aacquire(ai_model, client.model_name, tokens), reserved)
+    sent_at = datetime.utcnow()
+    try:
+        with metrics.PROVIDER_CALL_SECONDS.labels(ai_model, client.model_name).time():
+            result = await client.asend_message_with_usage(message, system_prompt=prompt, prompt_caching=prompt_caching)
+    except Exception:
+        metrics.PROVIDER_CALLS.labels(ai_model, client.model_name, "error").inc()
+        provider_call_log.record(job_id, ai_model, client.model_name, kind, chunk_index, enqueued_at, sent_at, trace, None)
+        raise
+    finally:
+        end_trace(token)
+    _record_call(ai_model, client.model_name, result)
+    provider_call_log.record(job_id, ai_model, client.model_name, kind, chunk_index, enqueued_at, sent_at, trace, result["usage"])
+    await rate_limiter.acharge(ai_model, client.model_name, _extra_tokens(result, trace.reserved))
+    return result
+
+
+def _map_cache_key(client, ai_model: str, prompt: str, message: str) -> str:
+    """Результат map зависит только от модели, промпта и содержимого фрагмента"""
+    return response_cache.make_key(ai_model, client.model_name, prompt, compute_source_hash(message))
+
+
+def _cached_map_result(text: str) -> dict:
+    return {
+        "text": text,
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+    }
+
+
+async def _gather_or_cancel(coros) -> list:
+    """
+    gather, который при первой ошибке отменяет остальные вызовы: задача уже провалена,
+    и оставшиеся чанки не должны расходовать лимит провайдера. Пробрасывает исходное исключение
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def split_oversized_results(client, texts: list, budget: int) -> list:
+    """
+    Результат больше budget не поместится ни в один reduce-вызов: он режется сплиттером клиента
+    на части по половине бюджета, чтобы соседние части объединялись попарно
+    """
+    split = []
+    for text in texts:
+        if client.count_tokens(text) > budget:
+            split.extend(client.split_text_into_chunks(text, chunk_size=max(1, budget // 2)))
+        else:
+            split.append(text)
+    return split
+
+
+def plan_reduce_groups(client, texts: list, budget: int) -> list:
+    """
+    Делит частичные результаты (каждый не больше budget, см. split_oversized_results) на группы для reduce-вызовов:
+    группа закрывается, когда следующий результат в неё уже не помещается, так что вход вызова не превышает budget токенов.
+    Одиночная группа переходит на следующий уровень без вызова, если на уровне есть что объединять.
+    Если объединять нечего (любые два соседних результата вместе больше budget), каждый результат сжимается отдельным вызовом.
+    Возвращает список (индексы результатов, оценка входных токенов, нужен ли reduce-вызов).
+    """
+    groups, current, current_size = [], [], 0
+    for idx, text in enumerate(texts):
+        tokens = client.count_tokens(text)
+        if current and current_size + tokens > budget:
+            groups.append((current, current_size))
+            current, current_size = [], 0
+        current.append(idx)
+        current_size += tokens
+    groups.append((current, current_size))
+
+    merging = any(len(indices) > 1 for indices, _ in groups)
+    return [(indices, tokens, len(indices) > 1 or not merging) for indices, tokens in groups]
+
+
+def _next_level_texts(texts: list, groups: list, results: list) -> list:
+    """Тексты следующего уровня в исходном порядке: ответы reduce-вызовов и одиночные результаты без вызова"""
+    reduced = iter(result["text"] for result in results)
+    return [next(reduced) if call else texts[indices[0]] for indices, _, call in groups]
+
+
+def build_reduce_message(texts: list) -> str:
+    parts = [f"[Результат {idx}]\n{text}" for idx, text in enumerate(texts, 1)]
+    return REDUCE_INSTRUCTION + "\n\n" + "\n\n".join(parts)
+
+
+def _reduce_budget(client, prompt: str, prompt_tokens: int | None) -> tuple:
+    """(бюджет на частичные результаты в одном reduce-вызове, токены промпта)"""
+    if prompt_tokens is None:
+        prompt_tokens = client.count_tokens(prompt) if prompt else 0
+    budget = int(client.max_tokens * 0.8) - prompt_tokens - client.count_tokens(REDUCE_INSTRUCTION)
+    return budget, prompt_tokens
+
+
+def process_job(
+    client,
+    ai_model: str,
+    prompt: str,
+    request_code: str,
+    max_concurrency: int = 1,
+    prompt_caching: bool = False,
+    request_tokens: int | None = None,
+    prompt_tokens: int | None = None,
+    map_reduce: bool = False,
+    previous_layout: dict | None = None,
+    job_id: str | None = None,
+    use_cache: bool = True
+) -> dict:
+    """
+    Синхронная обработка задачи (RQ воркер).
+    Чанки отправляются одновременно в пуле потоков, не больше max_concurrency за раз.
+    Каждый вызов проходит через общий лимитер провайдера.
+    map_reduce — чанки обрабатываются независимо (map), затем частичные результаты
+    сворачиваются деревом reduce-вызовов в один ответ.
+    previous_layout — инкрементальный режим (вместе с map_reduce): неизменённые чанки прошлого батча
+    сохраняются, их результаты берутся из кеша. Новая раскладка возвращается в result["layout"].
+    job_id — каждый вызов провайдера записывается в журнал provider_calls.
+    use_cache=False — результаты map не читаются из кеша ответов и не пишутся в него.
+    """
+    messages, layout = build_job_messages(
+        client, prompt, request_code, prompt_caching, request_tokens, prompt_tokens, map_reduce, previous_layout
+    )
+    metrics.JOB_CHUNKS.labels(ai_model, client.model_name).observe(len(messages))
+    map_reduce = map_reduce and len(messages) > 1
+    kind = "map" if map_reduce else "chunk"
+    enqueued_at = datetime.utcnow()
+
+    def _send(item):
+        idx, (message, tokens) = item
+        logging.info(f"Processing chunk {idx}/{len(messages)}")
+        if not (map_reduce and use_cache):
+            return call_provider(client, ai_model, message, tokens, prompt, prompt_caching, job_id, kind, idx, enqueued_at)
+
+        key = _map_cache_key(client, ai_model, prompt, message)
+        cached_text = response_cache.get(key)
+        if cached_text is not None:
+            return _cached_map_result(cached_text)
+        result = call_provider(client, ai_model, message, tokens, prompt, prompt_caching, job_id, kind, idx, enqueued_at)
+        response_cache.set(key, result["text"])
+        return result
+
+    workers = max(1, min(max_concurrency, len(messages)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map сохраняет порядок чанков независимо от порядка завершения
+        results = list(executor.map(_send, enumerate(messages, 1)))
+        if not map_reduce:
+            return {**merge_call_results(results), "layout": layout}
+
+        all_results = list(results)
+        texts = [result["text"] for result in results]
+        budget, prompt_tokens = _reduce_budget(client, prompt, prompt_tokens)
+
+        level = 1
+        while len(texts) > 1:
+            texts = split_oversized_results(client, texts, budget)
+            groups = plan_reduce_groups(client, texts, budget)
+            calls = [(idx, group) for idx, group in enumerate(groups, 1) if group[2]]
+            logging.info(f"Reduce level {level}: {len(texts)} results -> {len(groups)} ({len(calls)} reduce calls)")
+            enqueued_at = datetime.utcnow()
+            results = list(executor.map(
+                lambda item: call_provider(
+                    client, ai_model,
+                    build_reduce_message([texts[idx] for idx in item[1][0]]),
+                    item[1][1] + prompt_tokens, prompt,
+                    job_id=job_id, kind="reduce", chunk_index=item[0], enqueued_at=enqueued_at
+                ),
+                calls
+            ))
+            all_results.extend(results)
+            texts = _next_level_texts(texts, groups, results)
+            level += 1
+
+    return {"text": texts[0], "usage": sum_usage(all_results), "layout": layout}
+
+
+async def aprocess_job(
+    client,
+    ai_model: str,
+    prompt: str,
+    request_code: str,
+    max_concurrency: int = 1,
+    prompt_caching: bool = False,
+    request_tokens: int | None = None,
+    prompt_tokens: int | None = None,
+    map_reduce: bool = False,
+    previous_layout: dict | None = None,
+    job_id: str | None = None,
+    use_cache: bool = True
+) -> dict:
+    """
+    Асинхронная обработка задачи (async воркер).
+    Подсчёт токенов и нарезка уходят в поток, чтобы не блокировать event loop.
+    """
+    messages, layout = await asyncio.to_thread(
+        build_job_messages, client, prompt, request_code, prompt_caching, request_tokens, prompt_tokens, map_reduce, previous_layout
+    )
+    metrics.JOB_CHUNKS.labels(ai_model, client.model_name).observe(len(messages))
+    map_reduce = map_reduce and len(messages) > 1
+    kind = "map" if map_reduce else "chunk"
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    enqueued_at = datetime.utcnow()
+
+    async def _send(idx: int, message: str, tokens: int) -> dict:
+        async with semaphore:
+            logging.info(f"Processing chunk {idx}/{len(messages)}")
+            if not (map_reduce and use_cache):
+                return await acall_provider(client, ai_model, message, tokens, prompt, prompt_caching, job_id, kind, idx, enqueued_at)
+
+            key = _map_cache_key(client, ai_model, prompt, message)
+            cached_text = await asyncio.to_thread(response_cache.get, key)
+            if cached_text is not None:
+                return _cached_map_result(cached_text)
+            result = await acall_provider(client, ai_model, message, tokens, prompt, prompt_caching, job_id, kind, idx, enqueued_at)
+            await asyncio.to_thread(response_cache.set, key, result["text"])
+            return result
+
+    async def _reduce(idx: int, texts: list, tokens: int, enqueued_at: datetime) -> dict:
+        async with semaphore:
+            return await acall_provider(
+                client, ai_model, build_reduce_message(texts), tokens, prompt,
+                job_id=job_id, kind="reduce", chunk_index=idx, enqueued_at=enqueued_at
+            )
+
+    # Результаты в порядке чанков
+    results = await _gather_or_cancel(
+        _send(idx, message, tokens) for idx, (message, tokens) in enumerate(messages, 1)
+    )
+    if not map_reduce:
+        return {**merge_call_results(list(results)), "layout": layout}
+
+    all_results = list(results)
+    texts = [result["text"] for result in results]
+    budget, prompt_tokens = await asyncio.to_thread(_reduce_budget, client, prompt, prompt_tokens)
+
+    level = 1
+    while len(texts) > 1:
+        texts = await asyncio.to_thread(split_oversized_results, client, texts, budget)
+        groups = await asyncio.to_thread(plan_reduce_groups, client, texts, budget)
+        calls = [(idx, group) for idx, group in enumerate(groups, 1) if group[2]]
+        logging.info(f"Reduce level {level}: {len(texts)} results -> {len(groups)} ({len(calls)} reduce calls)")
+        enqueued_at = datetime.utcnow()
+        results = await _gather_or_cancel(
+            _reduce(idx, [texts[i] for i in indices], tokens + prompt_tokens, enqueued_at)
+            for idx, (indices, tokens, _) in calls
+        )
+        all_results.extend(results)
+        texts = _next_level_texts(texts, groups, results)
+        level += 1
+
+    return {"text": texts[0], "usage": sum_usage(all_results), "layout": layout}
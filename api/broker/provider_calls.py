@@ -0,0 +1,94 @@
+import atexit
+import logging
+import threading
+from datetime   import datetime
+from sqlalchemy import insert
+
+from api.core.db_con   import ProviderCall, SyncSessionLocal
+from api.core.security import PROVIDER_CALLS_FLUSH_SIZE, PROVIDER_CALLS_FLUSH_INTERVAL
+from openai_.call_trace import CallTrace
+
+
+class ProviderCallLog:
+    """
+    Журнал вызовов провайдеров.
+    record только добавляет строку в буфер; запись в БД делает фоновый поток
+    одним INSERT на пачку, поэтому на время вызовов журнал не влияет.
+    """
+    def __init__(self, flush_size: int, flush_interval: float):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(
+        self,
+        job_id: str | None,
+        ai_model: str,
+        model: str,
+        kind: str,
+        chunk_index: int | None,
+        enqueued_at: datetime,
+        sent_at: datetime,
+        trace: CallTrace,
+        usage: dict | None
+    ) -> None:
+        """usage=None — вызов упал"""
+        if not job_id:
+            return
+        usage = usage or {}
+        row = {
+            "job_id": job_id,
+            "ai_model": ai_model,
+            "model": model,
+            "kind": kind,
+            "chunk_index": chunk_index,
+            "enqueued_at": enqueued_at,
+            # Без HTTP хуков (клиент создан не через реестр) — время перед вызовом клиента
+            "started_at": trace.started_at or sent_at,
+            "first_byte_at": trace.first_byte_at,
+            "ended_at": datetime.utcnow(),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "cached_tokens": usage.get("cached_tokens"),
+            "retry_count": trace.retry_count,
+            "succeeded": bool(usage),
+        }
+        with self._lock:
+            self._rows.append(row)
+            size = len(self._rows)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="provider-calls-flush", daemon=True)
+                self._thread.start()
+        if size >= self.flush_size:
+            self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+
+        db = SyncSessionLocal()
+        try:
+            db.execute(insert(ProviderCall), rows)
+            db.commit()
+        except Exception as e:
+            # Журнал вспомогательный: при недоступной БД строки теряются, задачи не падают
+            logging.warning(f"Could not write {len(rows)} provider calls: {e}")
+            db.rollback()
+        finally:
+            db.close()
+
+
+provider_call_log = ProviderCallLog(PROVIDER_CALLS_FLUSH_SIZE, PROVIDER_CALLS_FLUSH_INTERVAL)
+# Остаток буфера пишется при штатной остановке воркера
+atexit.register(provider_call_log.flush)
@@ -0,0 +1,109 @@
+import time
+import hashlib
+import logging
+
+from api.core.redis_con import get_redis
+from api.core.security  import RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES
+
+
+KEY_PREFIX = "llm_cache"
+INDEX_KEY = f"{KEY_PREFIX}:index"
+SIZES_KEY = f"{KEY_PREFIX}:sizes"
+TOTAL_KEY = f"{KEY_PREFIX}:bytes"
+
+# Записывает ответ и следит за общим объёмом кеша:
+# INDEX_KEY — ZSET ключей по времени записи, SIZES_KEY — размеры, TOTAL_KEY — сумма.
+# Сначала забываются истёкшие по TTL записи, затем вытесняются самые старые, пока объём больше лимита.
+SET_SCRIPT = """
+local key = KEYS[1]
+local value = ARGV[1]
+local ttl_ms = tonumber(ARGV[2])
+local max_bytes = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local size = string.len(value)
+
+local function forget(k)
+    local old = tonumber(redis.call('HGET', KEYS[3], k))
+    if old then
+        redis.call('DECRBY', KEYS[4], old)
+        redis.call('HDEL', KEYS[3], k)
+    end
+    redis.call('ZREM', KEYS[2], k)
+end
+
+forget(key)
+redis.call('SET', key, value, 'PX', ttl_ms)
+redis.call('ZADD', KEYS[2], now, key)
+redis.call('HSET', KEYS[3], key, size)
+local total = redis.call('INCRBY', KEYS[4], size)
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - ttl_ms)
+for _, k in ipairs(expired) do
+    forget(k)
+end
+total = tonumber(redis.call('GET', KEYS[4]) or 0)
+
+while total > max_bytes and redis.call('ZCARD', KEYS[2]) > 1 do
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0)[1]
+    if oldest == key then break end
+    redis.call('DEL', oldest)
+    forget(oldest)
+    total = tonumber(redis.call('GET', KEYS[4]) or 0)
+end
+return total
+"""
+
+
+class ResponseCache:
+    """
+    Кеш ответов моделей в Redis по ключу (ai_model, model, hash(промпт), hash(код)).
+    Повторная отправка того же кода с теми же промптами не тратит токены.
+    Ошибки Redis не мешают обработке: задача просто идёт к провайдеру.
+    """
+    def __init__(self, ttl: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._set_script = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_bytes > 0
+
+    @staticmethod
+    def make_key(ai_model: str, model: str, prompt: str, source_hash: str, mode: str | None = None) -> str:
+        """mode — режим обработки, от которого зависит ответ (нарезка, map-reduce); None — ответ по одному фрагменту"""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        key = f"{KEY_PREFIX}:{ai_model}:{model}:{prompt_hash}:{source_hash}"
+        return f"{key}:{mode}" if mode else key
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        try:
+            value = get_redis().get(key)
+        except Exception as e:
+            logging.warning(f"Response cache unavailable: {e}")
+            return None
+        if value is None:
+            return None
+        logging.info(f"Response cache hit: {key}")
+        return value.decode('utf-8')
+
+    def set(self, key: str, text: str) -> None:
+        if not self.enabled:
+            return
+        value = text.encode('utf-8')
+        if len(value) > self.max_bytes:
+            return
+        try:
+            if self._set_script is None:
+                self._set_script = get_redis().register_script(SET_SCRIPT)
+            self._set_script(
+                keys=[key, INDEX_KEY, SIZES_KEY, TOTAL_KEY],
+                args=[value, self.ttl * 1000, self.max_bytes, int(time.time() * 1000)]
+            )
+        except Exception as e:
+            logging.warning(f"Could not store response in cache: {e}")
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
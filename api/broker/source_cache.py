@@ -0,0 +1,126 @@
+import os
+import logging
+import tempfile
+import threading
+from collections    import OrderedDict
+from sqlalchemy.orm import Session
+
+from api.core.security     import SOURCE_CACHE_DIR, SOURCE_CACHE_MAX_BYTES, SOURCE_CACHE_DISK_MAX_BYTES
+from api.core.source_blobs import load_source_blob_sync
+
+
+class SourceCache:
+    """
+    Локальный кеш присланного кода на воркере.
+    Код адресуется хешем содержимого, поэтому запись никогда не устаревает:
+    - в памяти процесса (LRU, ограничен по объёму в байтах UTF-8);
+    - на диске воркера, чтобы кеш переживал fork рабочих процессов RQ
+      (LRU по времени последнего чтения файла, ограничен disk_max_bytes).
+    """
+    def __init__(self, cache_dir: str, max_bytes: int, disk_max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, db: Session, content_hash: str) -> str:
+        content = self._get_memory(content_hash)
+        if content is not None:
+            return content
+
+        content = self._read_disk(content_hash)
+        size = None
+        if content is None:
+            content = load_source_blob_sync(db, content_hash)
+            if content is None:
+                raise ValueError(f"Исходный код {content_hash} не найден в source_blobs")
+            size = self._write_disk(content_hash, content)
+            logging.info(f"Source {content_hash[:12]} loaded from DB ({len(content)} chars)")
+
+        self._put_memory(content_hash, content, size)
+        return content
+
+    def _get_memory(self, content_hash: str) -> str | None:
+        with self._lock:
+            item = self._items.get(content_hash)
+            if item is None:
+                return None
+            self._items.move_to_end(content_hash)
+            return item[0]
+
+    def _put_memory(self, content_hash: str, content: str, size: int | None = None) -> None:
+        if size is None:
+            size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if content_hash in self._items:
+                return
+            self._items[content_hash] = (content, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._size -= evicted_size
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, content_hash)
+
+    def _read_disk(self, content_hash: str) -> str | None:
+        path = self._path(content_hash)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            # mtime — время последнего использования: по нему вытесняются старые файлы
+            os.utime(path)
+            return content
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Could not read cached source {content_hash[:12]}: {e}")
+            return None
+
+    def _write_disk(self, content_hash: str, content: str) -> int:
+        """Возвращает размер кода в байтах UTF-8"""
+        data = content.encode('utf-8')
+        if len(data) > self.disk_max_bytes:
+            return len(data)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Пишем во временный файл и переименовываем, чтобы параллельные воркеры не читали недописанный файл
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp_')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(content_hash))
+            self._evict_disk()
+        except Exception as e:
+            logging.warning(f"Could not write cached source {content_hash[:12]}: {e}")
+        return len(data)
+
+    def _evict_disk(self) -> None:
+        """Удаляет давно не читавшиеся файлы, пока кеш на диске больше disk_max_bytes (после каждой записи)"""
+        files = []
+        total = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.tmp_') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        if total <= self.disk_max_bytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Уже удалил другой воркер с тем же каталогом
+                pass
+            total -= size
+            if total <= self.disk_max_bytes:
+                break
+
+
+source_cache = SourceCache(SOURCE_CACHE_DIR, SOURCE_CACHE_MAX_BYTES, SOURCE_CACHE_DISK_MAX_BYTES)
@@ -1,309 +1,535 @@
 import logging
 from fastapi                    import HTTPException
-from api.core.db_con            import RequestData, JobResult, PromptTemplate, BatchStatus, async_session
-from openai_.openai_client      import ChatGPTClient
-from openai_.deepseek_client    import DeepSeekClient
-from openai_.sonnet_client      import SonnetClient
-from api.core.security          import SECRET_KEY_OPENAI, SECRET_KEY_DEEPSEEK, SECRET_KEY_SONNET
+from api.core.db_con            import RequestData, JobResult, PromptTemplate, BatchStatus, BatchFile, async_session, SyncSessionLocal
+from api.core.source_blobs      import save_source_blob, compute_source_hash, load_source_token_count
+from api.core.redis_con         import get_redis
+from api.broker.source_cache    import source_cache
+from api.broker.response_cache  import response_cache
+from api.broker                 import dedup
+from api.broker.events          import publish_batch_event
+from api.broker.pipeline        import process_job, aprocess_job
+from api.core                   import metrics
+from openai_.registry           import client_registry
+from openai_.tokenizer          import count_tokens
+from api.core.security          import SECRET_KEY_OPENAI, SECRET_KEY_DEEPSEEK, SECRET_KEY_SONNET, CHUNK_CONCURRENCY
 from api.schemas.openapi_schema import request_form
 from sqlalchemy.ext.asyncio     import AsyncSession
-from sqlalchemy                 import select, create_engine
-from sqlalchemy.orm             import sessionmaker, Session
+from sqlalchemy                 import select, insert, update, case
+from sqlalchemy.dialects        import postgresql
+from sqlalchemy.orm             import Session
 from datetime                   import datetime
 import asyncio
 import uuid
 import requests
 
-import redis
 from rq import Queue
+from rq.exceptions import AbandonedJobError
+from redis.asyncio import Redis
+from starlette.concurrency import run_in_threadpool
 
-# синхронный engine для воркеров
-from api.core.security import POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_DB, POSTGRES_PORT
-SYNC_DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@pg:{POSTGRES_PORT}/{POSTGRES_DB}"
-sync_engine = create_engine(SYNC_DATABASE_URL)
-SyncSessionLocal = sessionmaker(bind=sync_engine)
+FINAL_JOB_STATUSES = ('finished', 'failed')
+# Сколько раз вернуть в очередь задачу, брошенную умершим воркером
+ABANDONED_JOB_REQUEUES = 1
+# Метка "раскладка батча уже записана" (инкрементальный режим)
+LAYOUT_KEY_PREFIX = "batch_layout"
+LAYOUT_CLAIM_TTL = 24 * 3600
 
-def add_prompt_task(data: dict):
-    """Синхронная версия для RQ воркеров"""
-    prompt_data: request_form  = data["prompt_data"]
-    prompt: str = data["prompt"]
-    prompt_name: str = data.get("prompt_name", "result")
-    job_id: str = data.get("job_id")
-    batch_id: str = data.get("batch_id")
+
+PROVIDER_API_KEYS = {
+    "chatgpt": SECRET_KEY_OPENAI,
+    "deepseek": SECRET_KEY_DEEPSEEK,
+    "sonnet": SECRET_KEY_SONNET,
+}
+
+
+def load_prompt_content(db: Session, prompt_id: int) -> str:
+    """Загружает текст промпта по id"""
+    content = db.query(PromptTemplate.content).filter(PromptTemplate.id == prompt_id).scalar()
+    if content is None:
+        raise ValueError(f"Промпт {prompt_id} не найден")
+    return content
+
+
+def get_provider_client(ai_model: str, model: str):
+    """Клиент провайдера из кеша процесса"""
+    if ai_model not in PROVIDER_API_KEYS:
+        raise HTTPException(status_code=400, detail="Нет такой AI модели")
+    return client_registry.get_client(ai_model, model, PROVIDER_API_KEYS[ai_model])
+
+
+def job_processing_mode(data: dict) -> str:
+    """
+    Опции, меняющие ответ на тот же код и промпт: инкрементальный режим (нарезка по раскладке
+    прошлого батча), map-reduce (свёрнутый ответ вместо склеенных) и prompt caching (другая нарезка)
+    """
+    if data.get("repository"):
+        mode = f"incremental-{data.get('previous_batch_id') or 'none'}"
+    elif data.get("map_reduce"):
+        mode = "map_reduce"
+    else:
+        mode = "chunks"
+    if data.get("prompt_caching"):
+        mode += "-pc"
+    return mode
+
+
+def job_cache_key(data: dict, prompt: str) -> str:
+    return response_cache.make_key(data["ai_model"], data["model"], prompt, data["source_hash"], job_processing_mode(data))
+
+
+def cached_result(text: str) -> dict:
+    """Результат из кеша ответов: токены не тратились"""
+    return {
+        "text": text,
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+    }
+
+
+def start_job(data: dict) -> tuple:
+    """
+    Помечает задачу как started и загружает её промпт и код.
+    Возвращает (prompt, request_code, cached_text): если ответ есть в кеше, код не загружается.
+    """
+    job_id = data.get("job_id")
+    prompt_name = data.get("prompt_name", "result")
 
     db = SyncSessionLocal()
-    
     try:
-        job_record = db.query(JobResult).filter(JobResult.job_id == job_id).first()
-        if job_record:
-            job_record.status = 'started'
+        try:
+            started = db.execute(
+                update(JobResult)
+                .where(
+                    JobResult.job_id == job_id,
+                    JobResult.status.notin_(FINAL_JOB_STATUSES)
+                )
+                .values(status='started')
+            ).rowcount
+            if started:
+                bump_batch_version(data["batch_id"], db)
             db.commit()
-            logging.info(f"Job {job_id} ({prompt_name}) started")
-        else:
-            logging.warning(f"Job {job_id} not found in database")
+            if started:
+                logging.info(f"Job {job_id} ({prompt_name}) started")
+                publish_batch_event(data["batch_id"], "job", {"job_id": job_id, "status": 'started'})
+                dedup.refresh_inflight(data["batch_id"])
+            else:
+                logging.warning(f"Job {job_id} not found in database")
+        except Exception as e:
+            logging.warning(f"Could not update job status to started: {e}")
+            db.rollback()
+
+        prompt = load_prompt_content(db, data["prompt_id"])
+        if data.get("use_cache", True):
+            cached_text = response_cache.get(job_cache_key(data, prompt))
+            if cached_text is not None:
+                return prompt, None, cached_text
+
+        request_code = source_cache.get(db, data["source_hash"])
+        return prompt, request_code, None
+    finally:
+        db.close()
+
+
+def load_batch_layout(batch_id: str | None) -> dict:
+    """Раскладка чанков прошлого батча того же репозитория: {хеш части: номер чанка} ({} — прошлого нет)"""
+    if not batch_id:
+        return {}
+    db = SyncSessionLocal()
+    try:
+        rows = db.execute(
+            select(BatchFile.content_hash, BatchFile.chunk_index).where(BatchFile.batch_id == batch_id)
+        ).all()
+        return {row.content_hash: row.chunk_index for row in rows}
     except Exception as e:
-        logging.warning(f"Could not update job status to started: {e}")
-        db.rollback()
-    
-    # Обрабатываем AI запросы с обработкой ошибок
-    texts = None
-    total_usage = None
-    
+        logging.warning(f"Could not load layout of batch {batch_id}: {e}")
+        return {}
+    finally:
+        db.close()
+
+
+def claim_batch_layout(batch_id: str) -> bool:
+    """Все задачи батча считают одинаковую раскладку: пишет её только задача, первой занявшая ключ"""
     try:
-        ai_model = prompt_data.ai_model
-        
-        if ai_model == "chatgpt":
-            chatgpt_client = ChatGPTClient(
-                api_key=SECRET_KEY_OPENAI,
-                model_name=prompt_data.model,
-                embeddings_model_name="text-embedding-3-small",
-                system_prompt=prompt,
-                mathematical_percent=10
-            )
-            
-            # Проверяем размер запроса
-            request_tokens = len(chatgpt_client.tokenize_text(prompt_data.request))
-            system_tokens = len(chatgpt_client.tokenize_text(prompt)) if prompt else 0
-            total_input_tokens = request_tokens + system_tokens
-            
-            logging.info(f"Request tokens: {request_tokens}, System tokens: {system_tokens}, Total: {total_input_tokens}, Max: {chatgpt_client.max_tokens}")
-            
-            # Если запрос помещается целиком
-            if total_input_tokens <= chatgpt_client.max_tokens:
-                result = chatgpt_client.send_full_request_with_usage(prompt_data.request)
-                texts = result["text"]
-                total_usage = result["usage"]
-                logging.info(f"Sent as single request. Tokens used: {total_usage['total_tokens']}")
-            # Если не помещается - разбиваем на чанки
-            else:
-                logging.warning(f"Request too large ({total_input_tokens} tokens), splitting into chunks")
-                
-                # Размер чанка = 80% от доступного места (оставляем место на ответ)
-                chunk_size = int(chatgpt_client.max_tokens * 0.8) - system_tokens
-                chunks = chatgpt_client.split_text_into_chunks(prompt_data.request, chunk_size=chunk_size)
-                
-                all_texts = []
-                total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                
-                for idx, chunk in enumerate(chunks, 1):
-                    logging.info(f"Processing chunk {idx}/{len(chunks)}")
-                    
-                    chunk_message = f"[Часть {idx} из {len(chunks)}]\n\n{chunk}"
-                    
-                    result = chatgpt_client.send_message_with_usage(chunk_message)
-                    all_texts.append(result["text"])
-                    
-                    for key in total_usage:
-                        total_usage[key] += result["usage"].get(key, 0)
-                
-                texts = '\n\n'.join(all_texts)  
-                logging.info(f"Completed processing {len(chunks)} chunks. Total tokens: {total_usage['total_tokens']}")
-        
-        elif ai_model == "deepseek":
-            client = DeepSeekClient(
-                api_key=SECRET_KEY_DEEPSEEK,
-                model_name=prompt_data.model,
-                system_prompt=prompt,
-                mathematical_percent=10
-            )
-            
-            request_tokens = len(client.tokenize_text(prompt_data.request))
-            system_tokens = len(client.tokenize_text(prompt)) if prompt else 0
-            total_input_tokens = request_tokens + system_tokens
-            
-            logging.info(f"DeepSeek request tokens: {request_tokens}, System tokens: {system_tokens}, Total: {total_input_tokens}, Max: {client.max_tokens}")
-            
-            # Если запрос помещается целиком
-            if total_input_tokens <= client.max_tokens:
-                result = client.send_full_request_with_usage(prompt_data.request)
-                texts = result["text"]
-                total_usage = result["usage"]
-                logging.info(f"DeepSeek sent as single request. Tokens used: {total_usage['total_tokens']}")
-            
-            # Если не помещается - разбиваем на чанки
-            else:
-                logging.warning(f"DeepSeek request too large ({total_input_tokens} tokens), splitting into chunks")
-                
-                # Размер чанка = 80% от доступного места (оставляем место на ответ)
-                chunk_size = int(client.max_tokens * 0.8) - system_tokens
-                chunks = client.split_text_into_chunks(prompt_data.request, chunk_size=chunk_size)
-                
-                all_texts = []
-                total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-                
-                for idx, chunk in enumerate(chunks, 1):
-                    logging.info(f"Processing DeepSeek chunk {idx}/{len(chunks)}")
-                    
-                    chunk_message = f"[Часть {idx} из {len(chunks)}]\n\n{chunk}"
-                    result = client.send_message_with_usage(chunk_message)
-                    all_texts.append(result["text"])
-                    
-                    for key in total_usage:
-                        total_usage[key] += result["usage"].get(key, 0)
-                
-                texts = '\n\n'.join(all_texts)
-                logging.info(f"DeepSeek completed {len(chunks)} chunks. Total tokens: {total_usage['total_tokens']}")
-        
-        elif ai_model == "sonnet":
-            client = SonnetClient(
-                api_key=SECRET_KEY_SONNET,
-                model_name=prompt_data.model,
-                system_prompt=prompt,
-                mathematical_percent=10
-            )
-            
-            request_tokens = client.count_tokens(prompt_data.request)
-            system_tokens = client.count_tokens(prompt) if prompt else 0
-            total_input_tokens = request_tokens + system_tokens
-            
-            logging.info(f"Claude request tokens: ~{request_tokens}, System tokens: ~{system_tokens}, Total: ~{total_input_tokens}, Max: {client.max_tokens}")
-            
-            if total_input_tokens <= client.max_tokens:
-                result = client.send_full_request_with_usage(prompt_data.request)
-                texts = result["text"]
-                total_usage = result["usage"]
-                logging.info(f"Claude sent as single request. Tokens used: {total_usage['total_tokens']}")
-            
-            else:
-                logging.warning(f"Claude request too large (~{total_input_tokens} tokens), splitting into chunks")
-                result = client.send_chunked_message_with_usage(prompt_data.request)
-                texts = result["text"]
-                total_usage = result["usage"]
-                logging.info(f"Claude completed chunked request. Total tokens: {total_usage['total_tokens']}")
-        
-        else:
-            raise HTTPException(status_code=400, detail="Нет такой AI модели")
-    
+        return bool(get_redis().set(f"{LAYOUT_KEY_PREFIX}:{batch_id}", 1, nx=True, ex=LAYOUT_CLAIM_TTL))
     except Exception as e:
-        # Обрабатываем ошибки (включая rate limit)
-        error_message = str(e)
-        error_type = type(e).__name__
-        
-        if "RateLimitError" in error_type or "rate_limit" in error_message.lower():
-            error_message = f"Rate limit exceeded: {error_message[:200]}"
-            logging.warning(f"Rate limit error for job {job_id}: {error_message}")
-        else:
-            logging.error(f"Error processing job {job_id} ({prompt_name}): {e}", exc_info=True)
-        
-        # Помечаем задачу как failed
-        try:
-            job_record = db.query(JobResult).filter(JobResult.job_id == job_id).first()
-            if job_record:
-                job_record.status = 'failed'
-                job_record.error_message = error_message[:500]
-                job_record.completed_at = datetime.utcnow()
-                db.commit()
-                logging.info(f"Job {job_id} ({prompt_name}) marked as failed")
-                
-                # Обновляем статус батча
-                check_and_update_batch_status(batch_id, db)
-            else:
-                logging.error(f"Job {job_id} not found in database when trying to mark as failed")
-        except Exception as db_error:
-            logging.error(f"Error updating job status to failed: {db_error}")
-            db.rollback()
-        finally:
-            db.close()
-        
-        # Пробрасываем исключение дальше для RQ
-        raise
-    
-    # Проверяем, что результат получен
-    if texts is None or total_usage is None:
-        logging.error(f"Job {job_id} completed but texts or total_usage is None")
+        # Без Redis пишут все: повторные строки отбрасывает ON CONFLICT
+        logging.warning(f"Could not claim layout of batch {batch_id}: {e}")
+        return True
+
+
+def release_batch_layout(batch_id: str) -> None:
+    """Запись не удалась — раскладку запишет следующая задача батча"""
+    try:
+        get_redis().delete(f"{LAYOUT_KEY_PREFIX}:{batch_id}")
+    except Exception as e:
+        logging.warning(f"Could not release layout claim of batch {batch_id}: {e}")
+
+
+def save_batch_layout(batch_id: str, layout: list) -> None:
+    """Сохраняет раскладку батча (один раз на батч)"""
+    if not claim_batch_layout(batch_id):
+        return
+
+    db = SyncSessionLocal()
+    try:
+        db.execute(
+            postgresql.insert(BatchFile)
+            .values([
+                {"batch_id": batch_id, "path": path, "content_hash": content_hash, "chunk_index": chunk_index}
+                for path, content_hash, chunk_index in layout
+            ])
+            .on_conflict_do_nothing(index_elements=[BatchFile.batch_id, BatchFile.content_hash])
+        )
+        db.commit()
+    except Exception as e:
+        logging.warning(f"Could not save layout of batch {batch_id}: {e}")
+        db.rollback()
+        release_batch_layout(batch_id)
+    finally:
         db.close()
-        raise ValueError("AI processing failed - no result")
-    
-    # Сохраняем результат в БД (синхронно)
-    job_record = db.query(JobResult).filter(JobResult.job_id == job_id).first()
+
+
+def fail_job(data: dict, error: BaseException) -> None:
+    """Помечает задачу как failed (с учётом в счётчиках батча)"""
+    job_id = data.get("job_id")
+    prompt_name = data.get("prompt_name", "result")
+
+    # Обрабатываем ошибки (включая rate limit)
+    error_message = str(error) or type(error).__name__
+    error_type = type(error).__name__
     
-    if job_record:
-        job_record.result_text = texts
-        job_record.prompt_tokens = total_usage["prompt_tokens"]
-        job_record.completion_tokens = total_usage["completion_tokens"]
-        job_record.total_tokens = total_usage["total_tokens"]
-        job_record.status = 'finished'
-        job_record.completed_at = datetime.utcnow()
-        db.commit()
-        print(f"[SAVE] Job {job_id} saved: tokens={total_usage['total_tokens']}, result_len={len(texts)}")
-        
-        # Обновляем статус батча
-        check_and_update_batch_status(batch_id, db)
+    if "RateLimitError" in error_type or "rate_limit" in error_message.lower():
+        error_message = f"Rate limit exceeded: {error_message[:200]}"
+        logging.warning(f"Rate limit error for job {job_id}: {error_message}")
     else:
-        print(f"[ERROR] Job {job_id} NOT FOUND after processing")
-    
-    db.close()
+        logging.error(f"Error processing job {job_id} ({prompt_name}): {error}", exc_info=error)
 
+    db = SyncSessionLocal()
+    try:
+        complete_job(
+            db, job_id, data.get("batch_id"),
+            status='failed',
+            error_message=error_message[:500]
+        )
+        logging.info(f"Job {job_id} ({prompt_name}) marked as failed")
+    except Exception as db_error:
+        logging.error(f"Error updating job status to failed: {db_error}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def requeue_abandoned_job(job, exc_type, exc_value, traceback) -> bool:
+    """
+    exception handler RQ воркеров для задач, брошенных умершим воркером (AbandonedJobError из
+    очистки StartedJobRegistry). Первый раз задача возвращается в очередь, повторно — помечается
+    failed в БД, чтобы батч всё равно завершился. Остальные ошибки обрабатываются RQ как обычно.
+    """
+    if exc_type is not AbandonedJobError:
+        return True
+
+    abandoned = job.meta.get("abandoned", 0) + 1
+    job.meta["abandoned"] = abandoned
+    job.save_meta()
+    if abandoned <= ABANDONED_JOB_REQUEUES:
+        logging.warning(f"Job {job.id} was abandoned by a dead worker, requeueing")
+        # Очистка реестра возвращает в очередь задачи, у которых остались попытки
+        job.retries_left = 1
+        job.retry_intervals = None
+    elif job.func_name == "api.broker.task.add_prompt_task":
+        fail_job(job.args[0], exc_value)
+    return True
+
+
+def finish_job(data: dict, result: dict, from_cache: bool = False) -> None:
+    """Сохраняет результат задачи в БД (с учётом в счётчиках батча)"""
+    job_id = data.get("job_id")
+    texts = result["text"]
+    total_usage = result["usage"]
+
+    db = SyncSessionLocal()
+    try:
+        complete_job(
+            db, job_id, data.get("batch_id"),
+            status='finished',
+            result_text=texts,
+            prompt_tokens=total_usage["prompt_tokens"],
+            completion_tokens=total_usage["completion_tokens"],
+            total_tokens=total_usage["total_tokens"],
+            cached_tokens=total_usage.get("cached_tokens", 0),
+            from_cache=from_cache
+        )
+        print(f"[SAVE] Job {job_id} saved: tokens={total_usage['total_tokens']}, result_len={len(texts)}, from_cache={from_cache}")
+    finally:
+        db.close()
+
+
+def build_task_result(data: dict, result: dict) -> dict:
+    total_usage = result["usage"]
     return {
-        "ai_model": prompt_data.ai_model,
-        "model": prompt_data.model,
-        "prompt_name": prompt_name,
+        "ai_model": data["ai_model"],
+        "model": data["model"],
+        "prompt_name": data.get("prompt_name", "result"),
         "request_statistics": {
             "prompt_tokens": total_usage["prompt_tokens"],
             "completion_tokens": total_usage["completion_tokens"],
             "total_tokens": total_usage["total_tokens"],
+            "cached_tokens": total_usage.get("cached_tokens", 0),
         }
     }
+
+
+def add_prompt_task(data: dict):
+    """
+    Синхронная версия для RQ воркеров.
+    В payload только идентификаторы: текст промпта и код загружаются на воркере.
+    """
+    ai_model: str = data["ai_model"]
+    model: str = data["model"]
+
+    # Инкрементальный режим: сравнение с раскладкой прошлого батча репозитория (всегда через map-reduce)
+    incremental = bool(data.get("repository"))
+
+    try:
+        with metrics.job_stage("start", ai_model, model):
+            prompt, request_code, cached_text = start_job(data)
+        if cached_text is None:
+            client = get_provider_client(ai_model, model)
+            previous_layout = load_batch_layout(data.get("previous_batch_id")) if incremental else None
+            with metrics.job_stage("process", ai_model, model):
+                result = process_job(
+                    client, ai_model, prompt, request_code,
+                    max_concurrency=CHUNK_CONCURRENCY[ai_model],
+                    prompt_caching=data.get("prompt_caching", False),
+                    request_tokens=data.get("request_tokens"),
+                    prompt_tokens=data.get("prompt_tokens"),
+                    map_reduce=data.get("map_reduce", False) or incremental,
+                    previous_layout=previous_layout,
+                    job_id=data.get("job_id"),
+                    use_cache=data.get("use_cache", True)
+                )
+            if not result or result.get("text") is None:
+                raise ValueError("AI processing failed - no result")
+    except Exception as e:
+        metrics.JOBS.labels(ai_model, model, "failed").inc()
+        fail_job(data, e)
+        # Пробрасываем исключение дальше для RQ
+        raise
+
+    if cached_text is not None:
+        result = cached_result(cached_text)
+        with metrics.job_stage("finish", ai_model, model):
+            finish_job(data, result, from_cache=True)
+        metrics.JOBS.labels(ai_model, model, "cached").inc()
+        return build_task_result(data, result)
+
+    if result.get("layout"):
+        with metrics.job_stage("save_layout", ai_model, model):
+            save_batch_layout(data["batch_id"], result["layout"])
+    with metrics.job_stage("finish", ai_model, model):
+        finish_job(data, result)
+    if data.get("use_cache", True):
+        with metrics.job_stage("cache", ai_model, model):
+            response_cache.set(job_cache_key(data, prompt), result["text"])
+    metrics.JOBS.labels(ai_model, model, "finished").inc()
+    return build_task_result(data, result)
+
+
+async def add_prompt_task_async(data: dict):
+    """
+    Асинхронная версия для async воркера.
+    Вызовы провайдеров идут через event loop, статусы JobResult пишутся теми же функциями в потоке.
+    """
+    ai_model: str = data["ai_model"]
+    model: str = data["model"]
+
+    incremental = bool(data.get("repository"))
+
+    try:
+        with metrics.job_stage("start", ai_model, model):
+            prompt, request_code, cached_text = await asyncio.to_thread(start_job, data)
+        if cached_text is None:
+            client = get_provider_client(ai_model, model)
+            previous_layout = (
+                await asyncio.to_thread(load_batch_layout, data.get("previous_batch_id")) if incremental else None
+            )
+            with metrics.job_stage("process", ai_model, model):
+                result = await aprocess_job(
+                    client, ai_model, prompt, request_code,
+                    max_concurrency=CHUNK_CONCURRENCY[ai_model],
+                    prompt_caching=data.get("prompt_caching", False),
+                    request_tokens=data.get("request_tokens"),
+                    prompt_tokens=data.get("prompt_tokens"),
+                    map_reduce=data.get("map_reduce", False) or incremental,
+                    previous_layout=previous_layout,
+                    job_id=data.get("job_id"),
+                    use_cache=data.get("use_cache", True)
+                )
+            if not result or result.get("text") is None:
+                raise ValueError("AI processing failed - no result")
+    except (Exception, asyncio.CancelledError) as e:
+        # CancelledError — таймаут задачи в воркере: задача тоже должна попасть в счётчики батча
+        metrics.JOBS.labels(ai_model, model, "failed").inc()
+        await asyncio.to_thread(fail_job, data, e)
+        raise
+
+    if cached_text is not None:
+        result = cached_result(cached_text)
+        with metrics.job_stage("finish", ai_model, model):
+            await asyncio.to_thread(finish_job, data, result, True)
+        metrics.JOBS.labels(ai_model, model, "cached").inc()
+        return build_task_result(data, result)
+
+    if result.get("layout"):
+        with metrics.job_stage("save_layout", ai_model, model):
+            await asyncio.to_thread(save_batch_layout, data["batch_id"], result["layout"])
+    with metrics.job_stage("finish", ai_model, model):
+        await asyncio.to_thread(finish_job, data, result)
+    if data.get("use_cache", True):
+        with metrics.job_stage("cache", ai_model, model):
+            await asyncio.to_thread(response_cache.set, job_cache_key(data, prompt), result["text"])
+    metrics.JOBS.labels(ai_model, model, "finished").inc()
+    return build_task_result(data, result)
     
 
-def check_and_update_batch_status(batch_id: str, db: Session):
-    """Проверяет статус всех задач в батче и обновляет BatchStatus"""
+def complete_job(db: Session, job_id: str, batch_id: str, status: str, **values) -> bool:
+    """
+    Переводит задачу в финальный статус (finished/failed) и учитывает её в счётчиках батча.
+    Задача, уже учтённая ранее (например, при повторном запуске RQ), повторно не считается.
+    """
+    result = db.execute(
+        update(JobResult)
+        .where(
+            JobResult.job_id == job_id,
+            JobResult.status.notin_(FINAL_JOB_STATUSES)
+        )
+        .values(status=status, completed_at=datetime.utcnow(), **values)
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        logging.warning(f"Job {job_id} not found or already completed, batch counters not changed")
+        return False
+
+    # Обновление задачи и счётчика батча коммитятся одной транзакцией
+    job = {
+        "job_id": job_id,
+        "status": status,
+        "total_tokens": values.get("total_tokens"),
+        "error_message": values.get("error_message"),
+        "completed_at": datetime.utcnow()
+    }
+    check_and_update_batch_status(batch_id, db, succeeded=(status == 'finished'), job=job)
+    return True
+
+
+@metrics.BATCH_STATUS_UPDATE_SECONDS.time()
+def check_and_update_batch_status(batch_id: str, db: Session, succeeded: bool, job: dict | None = None):
+    """
+    Атомарно увеличивает счётчик батча и, если это была последняя задача,
+    завершает батч — в той же транзакции, чтобы падение воркера между ними не оставило
+    батч с полными счётчиками в processing. Финализацию (merge + webhook) выполняет ровно одна задача.
+    После коммита публикует событие progress (счётчики и завершённая задача job),
+    после финализации — событие batch с итоговым статусом.
+    """
     try:
-        # Получаем статус батча
-        batch_status = db.query(BatchStatus).filter(BatchStatus.batch_id == batch_id).first()
-        if not batch_status:
+        counter = BatchStatus.completed_jobs if succeeded else BatchStatus.failed_jobs
+        counters = db.execute(
+            update(BatchStatus)
+            .where(BatchStatus.batch_id == batch_id)
+            .values({counter: counter + 1, BatchStatus.version: BatchStatus.version + 1})
+            .returning(BatchStatus.completed_jobs, BatchStatus.failed_jobs, BatchStatus.total_jobs)
+        ).first()
+
+        if not counters:
+            db.commit()
             print(f"[BATCH] Batch {batch_id} not found")
             return
-        
-        # Получаем все задачи этого батча
-        all_jobs = db.query(JobResult).filter(JobResult.batch_id == batch_id).all()
-        
-        completed_count = sum(1 for job in all_jobs if job.status == 'finished')
-        failed_count = sum(1 for job in all_jobs if job.status == 'failed')
-        started_count = sum(1 for job in all_jobs if job.status == 'started')
-        queued_count = sum(1 for job in all_jobs if job.status == 'queued')
-        
-        print(f"[BATCH] {batch_id}: {completed_count}/{batch_status.total_jobs} completed, {failed_count} failed")
-        
-        # Обновляем счетчики
-        batch_status.completed_jobs = completed_count
-        batch_status.failed_jobs = failed_count
-        
-        # Проверяем, все ли задачи завершены
+
+        completed_count, failed_count, total_jobs = counters
         total_finished = completed_count + failed_count
-        if total_finished >= batch_status.total_jobs:
-            batch_status.status = 'completed' if failed_count == 0 else 'completed_with_errors'
-            batch_status.completed_at = datetime.utcnow()
-            db.commit()
-            
-            print(f"[BATCH] Batch {batch_id} COMPLETED! Starting merge...")
-            
-            # Объединяем результаты в один файл
-            if completed_count > 0:
-                merged_id = merge_batch_results(batch_id, db)
-                if merged_id:
-                    print(f"[MERGE] Created merged result with ID: {merged_id}")
-            
-            # Отправляем webhook если указан
-            if batch_status.callback_url and not batch_status.callback_sent:
-                send_webhook_notification(batch_status, db)
-        else:
-            db.commit()
-            logging.info(f"Batch {batch_id} progress: {total_finished}/{batch_status.total_jobs} (completed: {completed_count}, failed: {failed_count}, started: {started_count}, queued: {queued_count})")
-            
-            # Логируем задачи, которые долго выполняются
-            for job in all_jobs:
-                if job.status == 'started' and job.created_at:
-                    # Если задача выполняется больше 10 минут
-                    time_diff = (datetime.utcnow() - job.created_at).total_seconds()
-                    if time_diff > 600:
-                        logging.warning(f"Job {job.job_id} ({job.prompt_name}) has been running for {time_diff/60:.1f} minutes")
-            
+
+        finalized = None
+        if total_finished >= total_jobs:
+            # Батч закрывает только та задача, чей UPDATE сменил статус с processing.
+            # Строка заблокирована UPDATE счётчика до коммита, поэтому конкурирующая задача
+            # увидит уже закрытый батч и не найдёт его по условию
+            finalized = db.execute(
+                update(BatchStatus)
+                .where(
+                    BatchStatus.batch_id == batch_id,
+                    BatchStatus.status == 'processing'
+                )
+                .values(
+                    status=case((BatchStatus.failed_jobs == 0, 'completed'), else_='completed_with_errors'),
+                    completed_at=datetime.utcnow(),
+                    version=BatchStatus.version + 1
+                )
+                .returning(BatchStatus.id, BatchStatus.status, BatchStatus.completed_at)
+            ).first()
+        db.commit()
+
+        print(f"[BATCH] {batch_id}: {completed_count}/{total_jobs} completed, {failed_count} failed")
+        publish_batch_event(batch_id, "progress", {
+            "batch_id": batch_id,
+            "completed_jobs": completed_count,
+            "failed_jobs": failed_count,
+            "total_jobs": total_jobs,
+            "job": job
+        })
+
+        if total_finished < total_jobs:
+            dedup.refresh_inflight(batch_id)
+            logging.info(f"Batch {batch_id} progress: {total_finished}/{total_jobs} (completed: {completed_count}, failed: {failed_count})")
+            return
+
+        if not finalized:
+            return
+
+        print(f"[BATCH] Batch {batch_id} COMPLETED! Starting merge...")
+
+        # Новые отправки того же кода больше не присоединяются к этому батчу
+        dedup.release_inflight(batch_id)
+
+        # Объединяем результаты в один файл
+        merged_id = None
+        if completed_count > 0:
+            merged_id = merge_batch_results(batch_id, db)
+            if merged_id:
+                print(f"[MERGE] Created merged result with ID: {merged_id}")
+                # Ответ /batch/{id} изменился (has_merged_result): новый ETag
+                bump_batch_version(batch_id, db)
+                db.commit()
+
+        publish_batch_event(batch_id, "batch", {
+            "batch_id": batch_id,
+            "status": finalized.status,
+            "total_jobs": total_jobs,
+            "completed_jobs": completed_count,
+            "failed_jobs": failed_count,
+            "completed_at": finalized.completed_at,
+            "has_merged_result": merged_id is not None,
+            "merged_job_id": f"merged_{batch_id}" if merged_id else None
+        })
+
+        # Отправляем webhook если указан
+        batch_status = db.query(BatchStatus).filter(BatchStatus.batch_id == batch_id).first()
+        if batch_status and batch_status.callback_url and not batch_status.callback_sent:
+            send_webhook_notification(batch_status, db)
+
     except Exception as e:
         logging.error(f"Error updating batch status for {batch_id}: {e}", exc_info=True)
         db.rollback()
 
 
+def bump_batch_version(batch_id: str, db: Session) -> None:
+    """Меняет версию батча (ETag /batch/{id}) при изменении, не видном по счётчикам. Коммит — на вызывающем"""
+    db.execute(
+        update(BatchStatus)
+        .where(BatchStatus.batch_id == batch_id)
+        .values(version=BatchStatus.version + 1)
+    )
+
+
+@metrics.BATCH_MERGE_SECONDS.time()
 def merge_batch_results(batch_id: str, db: Session):
     """Объединяет все результаты батча в один файл"""
     print(f"[MERGE] Starting merge for batch {batch_id}")
@@ -339,6 +565,7 @@ def merge_batch_results(batch_id: str, db: Session):
         total_prompt_tokens = sum(job.prompt_tokens or 0 for job in all_jobs)
         total_completion_tokens = sum(job.completion_tokens or 0 for job in all_jobs)
         total_tokens = sum(job.total_tokens or 0 for job in all_jobs)
+        total_cached_tokens = sum(job.cached_tokens or 0 for job in all_jobs)
         
         merged_content.append("\n\n" + "=" * 60 + "\n")
         merged_content.append("# Статистика обработки\n")
@@ -349,6 +576,8 @@ def merge_batch_results(batch_id: str, db: Session):
         merged_content.append(f"- Всего токенов (prompt): {total_prompt_tokens:,}\n")
         merged_content.append(f"- Всего токенов (completion): {total_completion_tokens:,}\n")
         merged_content.append(f"- Всего токенов: {total_tokens:,}\n")
+        if total_cached_tokens:
+            merged_content.append(f"- Из них прочитано из кеша промптов: {total_cached_tokens:,}\n")
         
         merged_text = "".join(merged_content)
         
@@ -359,11 +588,12 @@ def merge_batch_results(batch_id: str, db: Session):
             ai_model=all_jobs[0].ai_model,
             model=all_jobs[0].model,
             prompt_name="MERGED_DOCUMENTATION",
-            request_code=all_jobs[0].request_code,
+            source_hash=all_jobs[0].source_hash,
             result_text=merged_text,
             prompt_tokens=total_prompt_tokens,
             completion_tokens=total_completion_tokens,
             total_tokens=total_tokens,
+            cached_tokens=total_cached_tokens,
             status='finished',
             completed_at=datetime.utcnow()
         )
@@ -409,67 +639,183 @@ def send_webhook_notification(batch_status: BatchStatus, db: Session):
         logging.error(f"Error sending webhook for batch {batch_status.batch_id}: {e}")
     
 
-async def send_task(request_data: request_form, db: AsyncSession):
-    redis_conn = redis.Redis(host='redis', port=6379)
-    q = Queue('to_aimodel', connection=redis_conn)
-    
+def enqueue_batch(q: Queue, enqueue_data: list) -> None:
+    """Ставит все задачи батча в очередь одним pipeline в Redis"""
+    with q.connection.pipeline() as pipe:
+        q.enqueue_many(enqueue_data, pipeline=pipe)
+        pipe.execute()
+
+
+async def send_task(
+    request_data: request_form,
+    db: AsyncSession,
+    q: Queue,
+    redis_conn: Redis,
+    idempotency_key: str | None = None
+):
     # Генерируем уникальный batch_id для всего батча задач
     batch_id = str(uuid.uuid4())
+    # Повторные запросы, попавшие на ключи этого батча, ждут его создания (см. dedup.load_existing_batch)
+    await dedup.mark_pending(redis_conn, batch_id)
+    try:
+        return await create_batch(request_data, db, q, redis_conn, batch_id, idempotency_key)
+    finally:
+        await dedup.clear_pending(redis_conn, batch_id)
+
+
+async def create_batch(
+    request_data: request_form,
+    db: AsyncSession,
+    q: Queue,
+    redis_conn: Redis,
+    batch_id: str,
+    idempotency_key: str | None = None
+):
+    source_hash = await run_in_threadpool(compute_source_hash, request_data.request)
+    
+    # Повтор запроса с тем же Idempotency-Key (и тем же телом) получает уже созданный батч
+    body_hash = dedup.request_body_hash(request_data, source_hash)
+    if idempotency_key:
+        existing_batch_id = await dedup.claim_idempotency_key(redis_conn, idempotency_key, batch_id, body_hash)
+        if existing_batch_id:
+            existing = await dedup.load_existing_batch(db, redis_conn, existing_batch_id)
+            if existing:
+                logging.info(f"Idempotency-Key matched batch {existing_batch_id}")
+                return existing
+            await dedup.point_idempotency_key(redis_conn, idempotency_key, batch_id, body_hash)
     
-    # Загружаем все активные промпты из БД
+    # Тот же код для той же модели и с теми же опциями уже в работе — присоединяемся к этому батчу.
+    # Запрос со своим callback_url к чужому батчу не присоединяется: его webhook потерялся бы
+    options = dedup.request_options(request_data)
+    existing_batch_id = await dedup.claim_inflight(
+        redis_conn, request_data.ai_model, request_data.model, source_hash, options, batch_id
+    )
+    if existing_batch_id:
+        existing = await dedup.load_existing_batch(db, redis_conn, existing_batch_id, processing_only=True)
+        if existing and await dedup.accepts_callback(db, existing_batch_id, request_data.callback_url):
+            logging.info(f"Request coalesced with in-flight batch {existing_batch_id}")
+            if idempotency_key:
+                await dedup.point_idempotency_key(redis_conn, idempotency_key, existing_batch_id, body_hash)
+            return existing
+        if not existing:
+            await dedup.take_over_inflight(redis_conn, request_data.ai_model, request_data.model, source_hash, options, batch_id)
+    
+    # Загружаем все активные промпты из БД (текст промпта воркер загрузит сам)
     result = await db.execute(
-        select(PromptTemplate).where(PromptTemplate.is_active == True)
+        select(PromptTemplate.id, PromptTemplate.name, PromptTemplate.token_count).where(PromptTemplate.is_active == True)
     )
-    prompts = result.scalars().all()
+    prompts = result.all()
     
     if not prompts:
+        await dedup.arelease_inflight(redis_conn, batch_id)
         raise HTTPException(status_code=500, detail="Не найдено ни одного активного промпта в БД")
     
+    # Токены кода считаются один раз на содержимое (вне event loop) и уходят в задачи
+    request_tokens = await load_source_token_count(db, source_hash)
+    if request_tokens is None:
+        request_tokens = await run_in_threadpool(count_tokens, request_data.request)
+    
+    # Код сохраняется один раз на батч, задачи ссылаются на него по хешу
+    await save_source_blob(db, request_data.request, source_hash, request_tokens)
+    
+    # Инкрементальный режим: последний батч репозитория с сохранённой раскладкой файлов
+    previous_batch_id = None
+    if request_data.repository:
+        previous_batch_id = (await db.execute(
+            select(BatchStatus.batch_id)
+            .where(
+                BatchStatus.repository == request_data.repository,
+                select(BatchFile.id).where(BatchFile.batch_id == BatchStatus.batch_id).exists()
+            )
+            .order_by(BatchStatus.created_at.desc())
+            .limit(1)
+        )).scalar_one_or_none()
+    
     # Создаём запись о батче
     batch_status = BatchStatus(
         batch_id=batch_id,
         total_jobs=len(prompts),
         callback_url=request_data.callback_url,
+        source_hash=source_hash,
+        repository=request_data.repository,
         status='processing'
     )
     db.add(batch_status)
-    await db.flush()
     
-    jobs = []
-    for prompt in prompts:
-        # Генерируем UUID вручную, чтобы избежать создания задач с job_id=None
-        job_id = str(uuid.uuid4())
-        
-        # Создаём запись в БД с сгенерированным job_id
-        job_record = JobResult(
-            job_id=job_id,
-            batch_id=batch_id,
-            ai_model=request_data.ai_model,
-            model=request_data.model,
-            prompt_name=prompt.name,
-            request_code=request_data.request,
-            status='queued'
-        )
-        db.add(job_record)
-        await db.flush()
-        
-        # Создаём задачу с правильным job_id
-        data = {
-            "prompt_data": request_data,
-            "prompt": prompt.content,
+    # Генерируем UUID вручную, чтобы избежать создания задач с job_id=None
+    created_at = datetime.utcnow()
+    job_rows = [
+        {
+            "job_id": str(uuid.uuid4()),
+            "batch_id": batch_id,
+            "ai_model": request_data.ai_model,
+            "model": request_data.model,
             "prompt_name": prompt.name,
-            "job_id": job_id,
-            "batch_id": batch_id
+            "source_hash": source_hash,
+            "status": 'queued',
+            "created_at": created_at
         }
-        job = q.enqueue(add_prompt_task, data, job_id=job_id)
-        
-        print(f"Задача поставлена в очередь: {job.id} (промпт: {prompt.name}, batch: {batch_id})")
-        jobs.append({
-            "job_id": job.id,
-            "prompt_name": prompt.name
-        })
+        for prompt in prompts
+    ]
     
+    # Все строки задач одним multi-row INSERT; коммитим до постановки в очередь,
+    # чтобы воркер гарантированно нашёл свою запись
+    await db.flush()
+    await db.execute(insert(JobResult), job_rows)
     await db.commit()
     
-    return {"jobs": jobs, "total": len(jobs), "batch_id": batch_id}
-            
+    # В очередь уходят только ссылки: код и промпт воркер загрузит сам
+    enqueue_data = [
+        Queue.prepare_data(
+            add_prompt_task,
+            args=({
+                "job_id": row["job_id"],
+                "batch_id": batch_id,
+                "prompt_id": prompt.id,
+                "prompt_name": prompt.name,
+                "source_hash": source_hash,
+                "request_tokens": request_tokens,
+                "prompt_tokens": prompt.token_count,
+                "ai_model": request_data.ai_model,
+                "model": request_data.model,
+                "prompt_caching": request_data.prompt_caching,
+                "use_cache": request_data.use_cache,
+                "map_reduce": request_data.map_reduce,
+                "repository": request_data.repository,
+                "previous_batch_id": previous_batch_id
+            },),
+            job_id=row["job_id"]
+        )
+        for prompt, row in zip(prompts, job_rows)
+    ]
+    
+    try:
+        # Redis-клиент синхронный (так требует RQ), поэтому не блокируем event loop
+        await run_in_threadpool(enqueue_batch, q, enqueue_data)
+    except Exception as e:
+        logging.error(f"Could not enqueue batch {batch_id}: {e}", exc_info=True)
+        await db.execute(
+            update(JobResult)
+            .where(JobResult.batch_id == batch_id)
+            .values(status='failed', error_message="Не удалось поставить задачу в очередь", completed_at=datetime.utcnow())
+        )
+        await db.execute(
+            update(BatchStatus)
+            .where(BatchStatus.batch_id == batch_id)
+            .values(status='failed', failed_jobs=len(job_rows), completed_at=datetime.utcnow(), version=BatchStatus.version + 1)
+        )
+        await db.commit()
+        await dedup.arelease_inflight(redis_conn, batch_id)
+        raise HTTPException(status_code=503, detail="Очередь задач недоступна")
+    
+    print(f"Батч {batch_id}: поставлено в очередь задач: {len(job_rows)}")
+    
+    jobs = [
+        {
+            "job_id": row["job_id"],
+            "prompt_name": row["prompt_name"]
+        }
+        for row in job_rows
+    ]
+    
+    return {"jobs": jobs, "total": len(jobs), "batch_id": batch_id, "deduplicated": False}
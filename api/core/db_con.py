@@ -2,16 +2,21 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import (
+    create_engine,
     Column,
     Integer,
     String,
     Text,
     DateTime,
     Boolean,
+    BigInteger,
+    Index,
+    UniqueConstraint,
 )
 from datetime import datetime
+from pathlib  import Path
 
-from .security import POSTGRES_PASSWORD, POSTGRES_DB, POSTGRES_USER, POSTGRES_PORT
+from .security import POSTGRES_PASSWORD, POSTGRES_DB, POSTGRES_USER, POSTGRES_PORT, ASYNC_WORKER_THREADS
 
 
 SQLACHEMY_DATABASE_URL = (
@@ -24,6 +29,13 @@ Base = declarative_base()
 
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# синхронный engine для воркеров
+SYNC_DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@pg:{POSTGRES_PORT}/{POSTGRES_DB}"
+# async воркер пишет в БД из ASYNC_WORKER_THREADS потоков: каждому — своё соединение без ожидания пула
+# (соединения открываются по мере надобности, overflow — для фоновых записей вроде журнала provider_calls)
+sync_engine = create_engine(SYNC_DATABASE_URL, pool_size=ASYNC_WORKER_THREADS, max_overflow=10)
+SyncSessionLocal = sessionmaker(bind=sync_engine)
+
 
 class Prompt(Base):
     __tablename__ = "prompt_data"
@@ -51,11 +63,18 @@ class PromptTemplate(Base):
     content = Column(Text, nullable=False)
     description = Column(Text)
     is_active = Column(Boolean, default=True, index=True)
+    # Токены content (cl100k_base), пересчитываются при создании и изменении промпта
+    token_count = Column(Integer)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class JobResult(Base):
     __tablename__ = "job_results"
+    # Под keyset-пагинацию списков /jobs и /results
+    __table_args__ = (
+        Index("idx_job_results_created_at_id", "created_at", "id"),
+        Index("idx_job_results_status_completed_at_id", "status", "completed_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     job_id = Column(String, unique=True, nullable=False, index=True)
@@ -63,14 +82,21 @@ class JobResult(Base):
     ai_model = Column(String, nullable=False)
     model = Column(String, nullable=False)
     prompt_name = Column(String, nullable=False)
-    request_code = Column(Text, nullable=False)
+    # Код хранится один раз в source_blobs, здесь только ссылка на него.
+    # request_code оставлен для строк, созданных до появления source_blobs.
+    source_hash = Column(String(64), index=True)
+    request_code = Column(Text)
     result_text = Column(Text)
     prompt_tokens = Column(Integer)
     completion_tokens = Column(Integer)
     total_tokens = Column(Integer)
+    # Входные токены, прочитанные из кеша промптов провайдера (входят в prompt_tokens)
+    cached_tokens = Column(Integer)
+    # Ответ взят из кеша ответов (провайдер не вызывался)
+    from_cache = Column(Boolean, default=False)
     status = Column(String, nullable=False, default='queued')
     error_message = Column(Text)
-    created_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime)
 
 
@@ -85,10 +111,79 @@ class BatchStatus(Base):
     status = Column(String, nullable=False, default='processing')
     callback_url = Column(Text)
     callback_sent = Column(Boolean, default=False)
+    source_hash = Column(String(64))
+    # Ключ репозитория для инкрементального режима (следующий батч сравнивает файлы с этим)
+    repository = Column(String, index=True)
+    # Растёт при каждом изменении батча или его задач — из неё строится ETag статуса батча
+    version = Column(Integer, nullable=False, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime)
 
 
+class BatchFile(Base):
+    """Раскладка выгрузки батча: часть файла (по хешу содержимого) и номер чанка, в который она попала"""
+    __tablename__ = "batch_files"
+    __table_args__ = (UniqueConstraint("batch_id", "content_hash"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String, nullable=False, index=True)
+    path = Column(Text, nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    chunk_index = Column(Integer, nullable=False)
+
+
+class ProviderCall(Base):
+    """
+    Один вызов провайдера: чанк задачи или reduce-вызов.
+    enqueued_at — чанк готов к отправке, started_at — ушёл первый HTTP запрос (после лимитера и очереди чанков),
+    first_byte_at — пришли заголовки ответа, ended_at — ответ разобран или вызов упал.
+    """
+    __tablename__ = "provider_calls"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    job_id = Column(String, nullable=False, index=True)
+    ai_model = Column(String, nullable=False)
+    model = Column(String, nullable=False)
+    # chunk — обычный чанк, map — чанк map-reduce, reduce — свёртка частичных результатов
+    kind = Column(String, nullable=False, default='chunk')
+    chunk_index = Column(Integer)
+    enqueued_at = Column(DateTime)
+    started_at = Column(DateTime, index=True)
+    first_byte_at = Column(DateTime)
+    ended_at = Column(DateTime)
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    cached_tokens = Column(Integer)
+    retry_count = Column(Integer, default=0)
+    succeeded = Column(Boolean, default=True)
+
+
+class SourceBlob(Base):
+    """Присланный код, адресуемый по sha256 содержимого (одинаковые загрузки хранятся один раз)"""
+    __tablename__ = "source_blobs"
+
+    content_hash = Column(String(64), primary_key=True)
+    content = Column(Text, nullable=False)
+    size_bytes = Column(Integer, nullable=False)
+    # Токены content (cl100k_base), считаются один раз при первой загрузке
+    token_count = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+MIGRATIONS_DIR = Path(__file__).resolve().parents[2] / "db" / "migrations"
+
+
+async def apply_migrations(conn) -> None:
+    """
+    Выполняет идемпотентные SQL скрипты db/migrations по порядку имён (при каждом старте API):
+    так существующие базы получают колонки и индексы, добавленные в init.sql позже
+    """
+    raw = await conn.get_raw_connection()
+    for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+        # Напрямую через asyncpg: в скрипте несколько команд
+        await raw.driver_connection.execute(path.read_text(encoding="utf-8"))
+
+
 async def get_db():
     async with async_session() as db:
         yield db
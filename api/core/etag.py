@@ -0,0 +1,29 @@
+from fastapi import Response
+
+
+def make_etag(*parts) -> str:
+    """ETag из коротких полей строки (версия, статус, время завершения)"""
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Совпадает ли If-None-Match с текущим ETag (список через запятую, слабые W/ и *)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def set_etag(response: Response, etag: str) -> None:
+    # no-cache: браузер хранит ответ, но каждый раз переспрашивает сервер с If-None-Match
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+
+def not_modified(etag: str) -> Response:
+    response = Response(status_code=304)
+    set_etag(response, etag)
+    return response
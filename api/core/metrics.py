@@ -0,0 +1,69 @@
+import logging
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from api.core.security import WORKER_METRICS_PORT
+
+
+# Вызовы провайдеров длятся от секунд до минут
+PROVIDER_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+QUEUE_DEPTH = Gauge(
+    "queue_depth", "Задачи, ожидающие воркера в очереди", ["queue"]
+)
+
+PROVIDER_CALL_SECONDS = Histogram(
+    "provider_call_seconds", "Длительность одного вызова провайдера",
+    ["ai_model", "model"], buckets=PROVIDER_BUCKETS
+)
+PROVIDER_CALLS = Counter(
+    "provider_calls_total", "Вызовы провайдера по результату (ok / error)",
+    ["ai_model", "model", "outcome"]
+)
+PROVIDER_TOKENS = Counter(
+    "provider_tokens_total", "Токены, потраченные на вызовы провайдера (prompt / completion / cached)",
+    ["ai_model", "model", "kind"]
+)
+
+JOB_CHUNKS = Histogram(
+    "job_chunks", "Число чанков, на которые нарезан код задачи",
+    ["ai_model", "model"], buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+)
+JOB_STAGE_SECONDS = Histogram(
+    "job_stage_seconds", "Длительность этапов add_prompt_task",
+    ["stage", "ai_model", "model"], buckets=STAGE_BUCKETS
+)
+JOBS = Counter(
+    "jobs_total", "Обработанные задачи по результату (finished / cached / failed)",
+    ["ai_model", "model", "outcome"]
+)
+
+BATCH_STATUS_UPDATE_SECONDS = Histogram(
+    "batch_status_update_seconds", "Длительность check_and_update_batch_status (с финализацией батча)",
+    buckets=STAGE_BUCKETS
+)
+BATCH_MERGE_SECONDS = Histogram(
+    "batch_merge_seconds", "Длительность merge_batch_results", buckets=STAGE_BUCKETS
+)
+
+
+def job_stage(stage: str, ai_model: str, model: str):
+    """Контекстный менеджер: время этапа задачи"""
+    return JOB_STAGE_SECONDS.labels(stage, ai_model, model).time()
+
+
+def record_provider_usage(ai_model: str, model: str, usage: dict) -> None:
+    for kind in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+        PROVIDER_TOKENS.labels(ai_model, model, kind.removesuffix("_tokens")).inc(usage.get(kind, 0))
+
+
+def start_worker_metrics_server() -> None:
+    """HTTP экспортер метрик воркера; WORKER_METRICS_PORT=0 — выключен"""
+    if not WORKER_METRICS_PORT:
+        return
+    try:
+        start_http_server(WORKER_METRICS_PORT)
+        logging.info(f"Worker metrics on :{WORKER_METRICS_PORT}/metrics")
+    except OSError as e:
+        # Порт занят (несколько воркеров в одном контейнере) — работаем без экспортера
+        logging.warning(f"Could not start metrics server on port {WORKER_METRICS_PORT}: {e}")
@@ -0,0 +1,87 @@
+import json
+import base64
+from datetime               import datetime
+from fastapi                import HTTPException
+from sqlalchemy             import Select, select, func, tuple_
+from sqlalchemy.dialects    import postgresql
+from sqlalchemy.exc         import CompileError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def encode_cursor(sort_value: datetime, row_id: int) -> str:
+    """Непрозрачный курсор: позиция последней строки страницы (значение сортировки и id)"""
+    raw = json.dumps([sort_value.isoformat(), row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        return datetime.fromisoformat(sort_value), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Некорректный cursor")
+
+
+def keyset_page(query: Select, sort_column, id_column, cursor: str | None, limit: int) -> Select:
+    """
+    Страница по убыванию (sort_column, id) после курсора.
+    Условие по кортежу совпадает с порядком составного индекса, поэтому глубокие страницы
+    читаются так же быстро, как первая (в отличие от OFFSET).
+    """
+    # DESC ставит NULL первыми и курсор по ним не построить; created_at/completed_at в списках всегда заполнены
+    # (у старых строк их проставляет db/migrations/001_upgrade_existing.sql)
+    query = query.where(sort_column.isnot(None))
+    if cursor:
+        query = query.where(tuple_(sort_column, id_column) < tuple_(*decode_cursor(cursor)))
+    # На одну строку больше: так видно, есть ли следующая страница
+    return query.order_by(sort_column.desc(), id_column.desc()).limit(limit + 1)
+
+
+def offset_page(query: Select, sort_column, offset: int, limit: int) -> Select:
+    """Прежняя выдача через OFFSET (параметр offset для старых клиентов): глубокие страницы читают все предыдущие строки"""
+    return query.order_by(sort_column.desc()).limit(limit).offset(offset)
+
+
+def check_offset_mode(cursor: str | None) -> None:
+    if cursor:
+        raise HTTPException(status_code=400, detail="cursor и offset нельзя передавать вместе")
+
+
+def page_result(rows: list, limit: int, sort_key: str, id_key: str = "id") -> tuple:
+    """(строки страницы, курсор следующей страницы или None)"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[sort_key], last[id_key])
+
+
+async def count_rows(db: AsyncSession, query: Select) -> int:
+    """Точное число строк запроса (COUNT(*) — на миллионах строк читает весь индекс)"""
+    unordered = query.order_by(None).limit(None)
+    return (await db.execute(select(func.count()).select_from(unordered.subquery()))).scalar()
+
+
+async def estimate_count(db: AsyncSession, query: Select) -> int:
+    """Приблизительное число строк запроса по оценке планировщика (EXPLAIN без выполнения, мгновенно)"""
+    unordered = query.order_by(None).limit(None)
+    try:
+        compiled = unordered.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    except CompileError:
+        return await count_rows(db, query)
+    # Мимо text(): двоеточия в подставленных строках не должны разбираться как параметры
+    conn = await db.connection()
+    plan = (await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+async def total_rows(db: AsyncSession, query: Select, mode: str | None) -> int | None:
+    """mode: None — не считать, approximate — оценка планировщика, exact — COUNT(*)"""
+    if mode == "approximate":
+        return await estimate_count(db, query)
+    if mode == "exact":
+        return await count_rows(db, query)
+    return None
@@ -0,0 +1,166 @@
+import time
+import random
+import asyncio
+import logging
+
+from .redis_con import get_redis, get_async_redis
+from .security  import RATE_LIMITS, RATE_LIMIT_HEADROOM
+
+
+# Два token bucket (запросы и токены) в одном hash: пополняются равномерно, ёмкость = лимит в минуту.
+# Списывает оба сразу, если хватает обоих; иначе возвращает, сколько мс подождать.
+# force=1 — списать без проверки (доплата по фактическому usage), баланс может уйти в минус.
+# Время берётся из Redis, поэтому часы воркеров не важны.
+TOKEN_BUCKET_SCRIPT = """
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local req_cost = tonumber(ARGV[3])
+local tok_cost = tonumber(ARGV[4])
+local force = tonumber(ARGV[5])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'req', 'tok', 'ts')
+local req = tonumber(state[1]) or rpm
+local tok = tonumber(state[2]) or tpm
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+
+req = math.min(rpm, req + elapsed * rpm / 60000)
+tok = math.min(tpm, tok + elapsed * tpm / 60000)
+
+local wait = 0
+if force == 0 then
+    if rpm > 0 and req < req_cost then
+        wait = math.max(wait, math.ceil((req_cost - req) * 60000 / rpm))
+    end
+    if tpm > 0 and tok < tok_cost then
+        wait = math.max(wait, math.ceil((tok_cost - tok) * 60000 / tpm))
+    end
+end
+
+if wait == 0 then
+    if rpm > 0 then req = req - req_cost end
+    if tpm > 0 then tok = tok - tok_cost end
+end
+
+redis.call('HSET', KEYS[1], 'req', req, 'tok', tok, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], 120000)
+return wait
+"""
+
+KEY_PREFIX = "ratelimit"
+
+
+class RateLimiter:
+    """
+    Общий для всех воркеров лимитер вызовов провайдеров (RPM и TPM) по ключу провайдер:модель.
+    Перед вызовом резервируется оценка входных токенов, после ответа доплачивается разница с usage.
+    Если Redis недоступен, вызовы не блокируются.
+    """
+    def __init__(self, limits: dict, headroom: float = 1.0):
+        self.limits = {
+            ai_model: {
+                "rpm": int(limit["rpm"] * headroom),
+                "tpm": int(limit["tpm"] * headroom),
+            }
+            for ai_model, limit in limits.items()
+        }
+        self._script = None
+        self._async_script = None
+
+    def _get_limits(self, ai_model: str) -> dict | None:
+        limits = self.limits.get(ai_model)
+        if not limits or (limits["rpm"] <= 0 and limits["tpm"] <= 0):
+            return None
+        return limits
+
+    def _script_args(self, limits: dict, requests: int, tokens: int, force: bool) -> list:
+        if not force and limits["tpm"] > 0:
+            # Запрос больше ёмкости бакета иначе не прошёл бы никогда
+            tokens = min(tokens, limits["tpm"])
+        return [limits["rpm"], limits["tpm"], requests, tokens, int(force)]
+
+    @staticmethod
+    def _key(ai_model: str, model: str) -> str:
+        return f"{KEY_PREFIX}:{ai_model}:{model}"
+
+    @staticmethod
+    def _wait_seconds(wait_ms: int) -> float:
+        # Небольшой разброс, чтобы ожидающие воркеры не просыпались одновременно
+        return wait_ms / 1000 + random.uniform(0, 0.05)
+
+    def _call(self, key: str, args: list) -> int:
+        if self._script is None:
+            self._script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+        return int(self._script(keys=[key], args=args))
+
+    async def _acall(self, key: str, args: list) -> int:
+        if self._async_script is None:
+            self._async_script = get_async_redis().register_script(TOKEN_BUCKET_SCRIPT)
+        return int(await self._async_script(keys=[key], args=args))
+
+    def acquire(self, ai_model: str, model: str, tokens: int) -> int:
+        """
+        Ждёт, пока в бакетах провайдера хватит места на один запрос и tokens токенов.
+        Возвращает, сколько токенов зарезервировано (tokens, урезанное до ёмкости бакета; 0 — лимита нет):
+        от этого числа считается доплата в charge
+        """
+        limits = self._get_limits(ai_model)
+        if limits is None:
+            return 0
+
+        key = self._key(ai_model, model)
+        args = self._script_args(limits, 1, tokens, force=False)
+        while True:
+            try:
+                wait_ms = self._call(key, args)
+            except Exception as e:
+                logging.warning(f"Rate limiter unavailable, calling {key} without limit: {e}")
+                return 0
+            if wait_ms <= 0:
+                return args[3]
+            logging.info(f"Rate limit {key}: waiting {wait_ms}ms")
+            time.sleep(self._wait_seconds(wait_ms))
+
+    async def aacquire(self, ai_model: str, model: str, tokens: int) -> int:
+        """Асинхронный вариант acquire"""
+        limits = self._get_limits(ai_model)
+        if limits is None:
+            return 0
+
+        key = self._key(ai_model, model)
+        args = self._script_args(limits, 1, tokens, force=False)
+        while True:
+            try:
+                wait_ms = await self._acall(key, args)
+            except Exception as e:
+                logging.warning(f"Rate limiter unavailable, calling {key} without limit: {e}")
+                return 0
+            if wait_ms <= 0:
+                return args[3]
+            logging.info(f"Rate limit {key}: waiting {wait_ms}ms")
+            await asyncio.sleep(self._wait_seconds(wait_ms))
+
+    def charge(self, ai_model: str, model: str, tokens: int) -> None:
+        """Списывает токены сверх зарезервированных (по usage из ответа)"""
+        limits = self._get_limits(ai_model)
+        if limits is None or tokens <= 0:
+            return
+        try:
+            self._call(self._key(ai_model, model), self._script_args(limits, 0, tokens, force=True))
+        except Exception as e:
+            logging.warning(f"Rate limiter charge failed: {e}")
+
+    async def acharge(self, ai_model: str, model: str, tokens: int) -> None:
+        """Асинхронный вариант charge"""
+        limits = self._get_limits(ai_model)
+        if limits is None or tokens <= 0:
+            return
+        try:
+            await self._acall(self._key(ai_model, model), self._script_args(limits, 0, tokens, force=True))
+        except Exception as e:
+            logging.warning(f"Rate limiter charge failed: {e}")
+
+
+rate_limiter = RateLimiter(RATE_LIMITS, headroom=RATE_LIMIT_HEADROOM)
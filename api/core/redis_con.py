@@ -0,0 +1,69 @@
+import redis
+import redis.asyncio as aioredis
+from rq import Queue
+
+from .security import (
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_POOL_TIMEOUT,
+    REDIS_HEALTH_CHECK_INTERVAL,
+)
+
+
+QUEUE_NAME = 'to_aimodel'
+
+# Пулы общие на процесс: создаются на старте FastAPI (или лениво в воркере)
+_sync_pool: redis.BlockingConnectionPool | None = None
+_async_pool: aioredis.BlockingConnectionPool | None = None
+_queue: Queue | None = None
+
+
+def _pool_kwargs() -> dict:
+    return {
+        "host": REDIS_HOST,
+        "port": REDIS_PORT,
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        "timeout": REDIS_POOL_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+        "socket_keepalive": True,
+    }
+
+
+def init_redis() -> None:
+    """Создаёт пулы соединений. BlockingConnectionPool ждёт свободное соединение вместо открытия лишних"""
+    global _sync_pool, _async_pool, _queue
+    if _sync_pool is None:
+        _sync_pool = redis.BlockingConnectionPool(**_pool_kwargs())
+    if _async_pool is None:
+        _async_pool = aioredis.BlockingConnectionPool(**_pool_kwargs())
+    if _queue is None:
+        _queue = Queue(QUEUE_NAME, connection=redis.Redis(connection_pool=_sync_pool))
+
+
+async def close_redis() -> None:
+    global _sync_pool, _async_pool, _queue
+    if _sync_pool is not None:
+        _sync_pool.disconnect()
+    if _async_pool is not None:
+        await _async_pool.disconnect()
+    _sync_pool = None
+    _async_pool = None
+    _queue = None
+
+
+def get_redis() -> redis.Redis:
+    """Синхронный клиент поверх общего пула (RQ работает только с ним)"""
+    init_redis()
+    return redis.Redis(connection_pool=_sync_pool)
+
+
+def get_queue() -> Queue:
+    init_redis()
+    return _queue
+
+
+def get_async_redis() -> aioredis.Redis:
+    """Асинхронный клиент поверх общего пула для эндпоинтов"""
+    init_redis()
+    return aioredis.Redis(connection_pool=_async_pool)
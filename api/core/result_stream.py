@@ -0,0 +1,135 @@
+import re
+import io
+import json
+import gzip
+import tarfile
+import time
+from typing import AsyncIterator
+
+from sqlalchemy import select
+
+from api.core.db_con import async_session, JobResult
+
+
+# Сколько строк результатов забирать из серверного курсора за раз (result_text может весить мегабайты)
+RESULTS_FETCH_SIZE = 10
+
+RESULT_COLUMNS = (
+    JobResult.job_id,
+    JobResult.prompt_name,
+    JobResult.status,
+    JobResult.result_text,
+    JobResult.error_message,
+    JobResult.prompt_tokens,
+    JobResult.completion_tokens,
+    JobResult.total_tokens,
+    JobResult.cached_tokens,
+    JobResult.from_cache,
+    JobResult.completed_at,
+)
+
+
+async def stream_batch_rows(batch_id: str) -> AsyncIterator:
+    """
+    Задачи батча (объединённый файл — последним) через серверный курсор:
+    в памяти одновременно не больше RESULTS_FETCH_SIZE результатов.
+    Сессия своя — ответ отдаётся после выхода из эндпоинта.
+    """
+    async with async_session() as db:
+        result = await db.stream(
+            select(*RESULT_COLUMNS)
+            .where(JobResult.batch_id == batch_id)
+            .order_by(JobResult.created_at, JobResult.id)
+            .execution_options(yield_per=RESULTS_FETCH_SIZE)
+        )
+        async for row in result.mappings():
+            yield row
+
+
+def job_item(row) -> dict:
+    """Описание задачи без текста результата — в том же виде, что у /jobs/{job_id}"""
+    item = {
+        "job_id": row["job_id"],
+        "prompt_name": row["prompt_name"],
+        "status": row["status"],
+        "completed_at": row["completed_at"].isoformat() if row["completed_at"] else None,
+    }
+    if row["status"] == 'finished':
+        item["statistics"] = {
+            "prompt_tokens": row["prompt_tokens"],
+            "completion_tokens": row["completion_tokens"],
+            "total_tokens": row["total_tokens"],
+            "cached_tokens": row["cached_tokens"],
+            "from_cache": row["from_cache"],
+        }
+    elif row["status"] == 'failed':
+        item["error"] = row["error_message"]
+    return item
+
+
+async def ndjson_results(rows: AsyncIterator) -> AsyncIterator[bytes]:
+    """Строка JSON на задачу; у завершённых — поле result с текстом"""
+    async for row in rows:
+        item = job_item(row)
+        if row["status"] == 'finished':
+            item["result"] = row["result_text"]
+        yield (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Файл для gzip/tarfile, из которого записанное забирается кусками по мере генерации архива"""
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _markdown_name(index: int, prompt_name: str) -> str:
+    if prompt_name == "MERGED_DOCUMENTATION":
+        return "documentation.md"
+    safe_name = re.sub(r"[^\w.-]+", "_", prompt_name)
+    return f"{index:02d}_{safe_name}.md"
+
+
+def _add_file(archive: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    archive.addfile(info, io.BytesIO(data))
+
+
+async def tar_gz_results(rows: AsyncIterator, batch_id: str) -> AsyncIterator[bytes]:
+    """
+    tar.gz: markdown файл на каждую завершённую задачу, documentation.md (объединённый результат)
+    и в конце manifest.json со статусами и статистикой всех задач
+    """
+    buffer = _ChunkBuffer()
+    gz = gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6)
+    archive = tarfile.open(fileobj=gz, mode="w|")
+    manifest = []
+    index = 0
+    async for row in rows:
+        item = job_item(row)
+        if row["status"] == 'finished' and row["result_text"] is not None:
+            if row["prompt_name"] != "MERGED_DOCUMENTATION":
+                index += 1
+            item["file"] = _markdown_name(index, row["prompt_name"])
+            _add_file(archive, f"{batch_id}/{item['file']}", row["result_text"].encode("utf-8"))
+        manifest.append(item)
+        chunk = buffer.drain()
+        if chunk:
+            yield chunk
+
+    _add_file(archive, f"{batch_id}/manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+    archive.close()
+    gz.close()
+    yield buffer.drain()
@@ -14,6 +14,69 @@ SECRET_KEY_DEEPSEEK = os.getenv("SECRET_KEY_DEEPSEEK")
 SECRET_KEY_SONNET = os.getenv("SECRET_KEY_SONNET")
 SECRET_ADMIN_TOKEN = os.getenv("SECRET_ADMIN_TOKEN")
 
+# Адреса API провайдеров (для локального фейкового сервера bench/fake_llm_server.py). None — адрес по умолчанию
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL")
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+
+# Сколько чанков одной задачи отправляется одновременно (1 = последовательно)
+CHUNK_CONCURRENCY = {
+    "chatgpt": int(os.getenv("CHUNK_CONCURRENCY_CHATGPT", "4")),
+    "deepseek": int(os.getenv("CHUNK_CONCURRENCY_DEEPSEEK", "4")),
+    "sonnet": int(os.getenv("CHUNK_CONCURRENCY_SONNET", "2")),
+}
+
+# Лимиты провайдеров (на провайдера и модель, общие для всех воркеров): запросов и токенов в минуту.
+# 0 — лимит не проверяется. RATE_LIMIT_HEADROOM — доля лимита, которую разрешено использовать
+RATE_LIMITS = {
+    "chatgpt": {
+        "rpm": int(os.getenv("RATE_LIMIT_RPM_CHATGPT", "500")),
+        "tpm": int(os.getenv("RATE_LIMIT_TPM_CHATGPT", "200000")),
+    },
+    "deepseek": {
+        "rpm": int(os.getenv("RATE_LIMIT_RPM_DEEPSEEK", "0")),
+        "tpm": int(os.getenv("RATE_LIMIT_TPM_DEEPSEEK", "0")),
+    },
+    "sonnet": {
+        "rpm": int(os.getenv("RATE_LIMIT_RPM_SONNET", "50")),
+        "tpm": int(os.getenv("RATE_LIMIT_TPM_SONNET", "30000")),
+    },
+}
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.9"))
+
+# async воркер: сколько задач держать одновременно и сколько потоков для БД
+ASYNC_WORKER_CONCURRENCY = int(os.getenv("ASYNC_WORKER_CONCURRENCY", "100"))
+ASYNC_WORKER_THREADS = int(os.getenv("ASYNC_WORKER_THREADS", "16"))
+
+# Журнал вызовов провайдеров (provider_calls): строки копятся в памяти воркера
+# и пишутся в БД пачкой, когда набралось FLUSH_SIZE или прошло FLUSH_INTERVAL секунд
+PROVIDER_CALLS_FLUSH_SIZE = int(os.getenv("PROVIDER_CALLS_FLUSH_SIZE", "200"))
+PROVIDER_CALLS_FLUSH_INTERVAL = float(os.getenv("PROVIDER_CALLS_FLUSH_INTERVAL", "5"))
+
+# Порт Prometheus экспортера воркера (у API метрики на /metrics). 0 — без экспортера
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+
+# Redis: общий пул соединений на процесс
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT = int(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+# Кеш ответов моделей в Redis (ключ — модель, промпт и код). TTL 0 — кеш выключен
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Повторные отправки: сколько живёт Idempotency-Key и метка "этот код уже обрабатывается".
+# Метку продлевает каждое движение задач батча, INFLIGHT_TTL — сколько она живёт без движения
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+INFLIGHT_TTL = int(os.getenv("INFLIGHT_TTL", str(30 * 60)))
+
+# Локальный кеш исходного кода на воркерах: в памяти процесса и на диске (байты UTF-8)
+SOURCE_CACHE_DIR = os.getenv("SOURCE_CACHE_DIR", "/tmp/source_cache")
+SOURCE_CACHE_MAX_BYTES = int(os.getenv("SOURCE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+SOURCE_CACHE_DISK_MAX_BYTES = int(os.getenv("SOURCE_CACHE_DISK_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
 
 def verify_admin_token(x_admin_token: str = Header(..., alias="X-Admin-Token")):
     if x_admin_token != SECRET_ADMIN_TOKEN:
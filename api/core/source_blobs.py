@@ -0,0 +1,60 @@
+import hashlib
+from sqlalchemy                    import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio        import AsyncSession
+from sqlalchemy.orm                import Session
+
+from .db_con import SourceBlob
+
+
+def compute_source_hash(content: str) -> str:
+    """sha256 содержимого — ключ, по которому код хранится в source_blobs"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+async def save_source_blob(
+    db: AsyncSession,
+    content: str,
+    content_hash: str | None = None,
+    token_count: int | None = None
+) -> str:
+    """
+    Сохраняет код в source_blobs, если такого содержимого ещё нет.
+    Возвращает хеш, по которому на него ссылаются батчи и задачи.
+    """
+    if content_hash is None:
+        content_hash = compute_source_hash(content)
+    await db.execute(
+        insert(SourceBlob)
+        .values(
+            content_hash=content_hash,
+            content=content,
+            size_bytes=len(content.encode('utf-8')),
+            token_count=token_count,
+        )
+        .on_conflict_do_nothing(index_elements=[SourceBlob.content_hash])
+    )
+    return content_hash
+
+
+async def load_source_blob(db: AsyncSession, content_hash: str) -> str | None:
+    """Загружает код по хешу (асинхронно, для API)"""
+    result = await db.execute(
+        select(SourceBlob.content).where(SourceBlob.content_hash == content_hash)
+    )
+    return result.scalar_one_or_none()
+
+
+async def load_source_token_count(db: AsyncSession, content_hash: str) -> int | None:
+    """Токены уже сохранённого кода (None — кода ещё нет или счёт не сохранён)"""
+    result = await db.execute(
+        select(SourceBlob.token_count).where(SourceBlob.content_hash == content_hash)
+    )
+    return result.scalar_one_or_none()
+
+
+def load_source_blob_sync(db: Session, content_hash: str) -> str | None:
+    """Загружает код по хешу (синхронно, для воркеров)"""
+    return db.execute(
+        select(SourceBlob.content).where(SourceBlob.content_hash == content_hash)
+    ).scalar_one_or_none()
@@ -0,0 +1,18 @@
+from fastapi           import APIRouter, Depends, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from redis.asyncio     import Redis
+
+from api.core.metrics   import QUEUE_DEPTH
+from api.core.redis_con import get_async_redis, QUEUE_NAME
+
+metrics_router = APIRouter(tags=["metrics"])
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+async def get_metrics(redis_conn: Redis = Depends(get_async_redis)):
+    """
+    Метрики API в формате Prometheus.
+    Метрики вызовов провайдеров и этапов задач отдают воркеры (WORKER_METRICS_PORT).
+    """
+    QUEUE_DEPTH.labels(QUEUE_NAME).set(await redis_conn.llen(f"rq:queue:{QUEUE_NAME}"))
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
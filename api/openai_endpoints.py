@@ -1,69 +1,139 @@
+import json
+import asyncio
 import logging
-from fastapi                    import APIRouter, Depends, status, HTTPException
+from fastapi                    import APIRouter, Depends, Header, Query, Request, Response, status, HTTPException
+from fastapi.responses          import ORJSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio     import AsyncSession
-from api.core.db_con            import get_db, JobResult, BatchStatus
-from api.schemas.openapi_schema import prompt_form, request_form
+from api.core.db_con            import get_db, async_session, JobResult, BatchStatus, ProviderCall
+from api.core.source_blobs      import load_source_blob
+from api.core.redis_con         import get_queue, get_async_redis, QUEUE_NAME
+from api.core.pagination        import keyset_page, page_result, total_rows, offset_page, check_offset_mode
+from api.core.etag              import make_etag, etag_matches, set_etag, not_modified
+from api.core.result_stream     import stream_batch_rows, ndjson_results, tar_gz_results
+from api.schemas.openapi_schema import prompt_form, request_form, JobListResponse, ResultListItem, ResultListResponse, BatchStatusResponse
 from api.core.security          import SECRET_KEY_OPENAI, SECRET_KEY_DEEPSEEK, SECRET_KEY_SONNET, verify_admin_token
 from api.broker.task            import send_task
+from api.broker.events          import batch_event_hub, FINAL_BATCH_STATUSES
 from api.core.db_con            import Prompt, get_db
 from openai_.openai_client      import ChatGPTClient
 from openai_.deepseek_client    import DeepSeekClient
 from openai_.sonnet_client      import SonnetClient
-from sqlalchemy import select
+from redis.asyncio import Redis
+from rq import Queue
+from sqlalchemy import select, func
+from sqlalchemy.orm import defer
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Literal
 
 ai_model = APIRouter(prefix="/api/v1/ai_model", tags=["ai_model"])
 
+# Как часто SSE поток шлёт keepalive, если событий нет, с
+SSE_KEEPALIVE = 15
+
 #new version(send only code(promt from files on the Server))
 # TODO: Вернуть проверку авторизации после добавления системы регистрации
 @ai_model.post("/send_prompt/", status_code=status.HTTP_201_CREATED)
-async def add_prompt_new(request_data: request_form, db: AsyncSession = Depends(get_db)):
-    return await send_task(request_data, db)
+async def add_prompt_new(
+    request_data: request_form,
+    db: AsyncSession = Depends(get_db),
+    q: Queue = Depends(get_queue),
+    redis_conn: Redis = Depends(get_async_redis),
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key")
+):
+    """
+    Ставит код в обработку всеми активными промптами.
+    Повтор с тем же Idempotency-Key или отправка того же кода, пока он ещё в работе,
+    возвращает уже существующий батч (deduplicated=true).
+    """
+    return await send_task(request_data, db, q, redis_conn, idempotency_key)
+
+
+@ai_model.get("/queue")
+async def get_queue_status(redis_conn: Redis = Depends(get_async_redis)):
+    """Количество задач, ожидающих воркера в очереди"""
+    queued_jobs = await redis_conn.llen(f"rq:queue:{QUEUE_NAME}")
+    return {
+        "queue": QUEUE_NAME,
+        "queued_jobs": queued_jobs
+    }
+
+# Колонки для списков: без request_code и result_text (мегабайты на строку)
+JOB_LIST_COLUMNS = (
+    JobResult.id,
+    JobResult.job_id,
+    JobResult.status,
+    JobResult.ai_model,
+    JobResult.model,
+    JobResult.prompt_name,
+    JobResult.created_at,
+    JobResult.completed_at,
+)
+
 
-@ai_model.get("/jobs", dependencies=[Depends(verify_admin_token)])
+@ai_model.get(
+    "/jobs",
+    response_model=JobListResponse,
+    response_class=ORJSONResponse,
+    dependencies=[Depends(verify_admin_token)]
+)
 async def get_all_jobs(
     db: AsyncSession = Depends(get_db),
-    limit: int = 50,
-    offset: int = 0,
-    status_filter: str = None
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    status_filter: str = None,
+    total: Literal["approximate", "exact"] | None = None,
+    offset: int | None = Query(None, ge=0, deprecated=True)
 ):
-    """Получить список всех задач с фильтрацией"""
-    query = select(JobResult).order_by(JobResult.created_at.desc())
+    """
+    Список задач, новые первыми. Следующая страница — cursor из next_cursor предыдущей.
+    total=approximate — оценка планировщика (мгновенно), exact — COUNT(*).
+    offset — прежняя постраничная выдача для старых клиентов: OFFSET, total — число задач на странице.
+    """
+    query = select(*JOB_LIST_COLUMNS)
     
     if status_filter:
         query = query.where(JobResult.status == status_filter)
     
-    query = query.limit(limit).offset(offset)
-    result = await db.execute(query)
-    jobs = result.scalars().all()
+    if offset is not None:
+        check_offset_mode(cursor)
+        jobs = (await db.execute(offset_page(query, JobResult.created_at, offset, limit))).mappings().all()
+        return {"jobs": jobs, "total": len(jobs)}
+    
+    rows = (await db.execute(keyset_page(query, JobResult.created_at, JobResult.id, cursor, limit))).mappings().all()
+    jobs, next_cursor = page_result(rows, limit, "created_at")
     
     return {
-        "jobs": [
-            {
-                "job_id": job.job_id,
-                "status": job.status,
-                "ai_model": job.ai_model,
-                "model": job.model,
-                "prompt_name": job.prompt_name,
-                "created_at": job.created_at.isoformat() if job.created_at else None,
-                "completed_at": job.completed_at.isoformat() if job.completed_at else None
-            }
-            for job in jobs
-        ],
-        "total": len(jobs)
+        "jobs": jobs,
+        "next_cursor": next_cursor,
+        "total": await total_rows(db, query, total)
     }
 
 
 @ai_model.get("/results/{result_id}", dependencies=[Depends(verify_admin_token)])
-async def get_result_by_id(result_id: int, db: AsyncSession = Depends(get_db)):
-    """Получить полную информацию о результате по ID"""
+async def get_result_by_id(result_id: int, include_code: bool = False, db: AsyncSession = Depends(get_db)):
+    """Получить полную информацию о результате по ID (исходный код — только при include_code=true)"""
     result = await db.execute(
-        select(JobResult).where(JobResult.id == result_id)
+        select(JobResult)
+        .options(defer(JobResult.request_code))
+        .where(JobResult.id == result_id)
     )
     job_record = result.scalar_one_or_none()
     
     if not job_record:
         raise HTTPException(status_code=404, detail=f"Результат с ID {result_id} не найден")
     
+    request_code = None
+    if include_code:
+        if job_record.source_hash:
+            request_code = await load_source_blob(db, job_record.source_hash)
+        else:
+            # Старые записи хранят код прямо в job_results
+            legacy = await db.execute(
+                select(JobResult.request_code).where(JobResult.id == result_id)
+            )
+            request_code = legacy.scalar_one_or_none()
+    
     return {
         "id": job_record.id,
         "job_id": job_record.job_id,
@@ -72,109 +142,314 @@ async def get_result_by_id(result_id: int, db: AsyncSession = Depends(get_db)):
         "ai_model": job_record.ai_model,
         "model": job_record.model,
         "prompt_name": job_record.prompt_name,
-        "request_code": job_record.request_code,
+        "source_hash": job_record.source_hash,
+        "request_code": request_code,
         "result_text": job_record.result_text,
         "prompt_tokens": job_record.prompt_tokens,
         "completion_tokens": job_record.completion_tokens,
         "total_tokens": job_record.total_tokens,
+        "cached_tokens": job_record.cached_tokens,
+        "from_cache": job_record.from_cache,
         "error_message": job_record.error_message,
         "created_at": job_record.created_at.isoformat() if job_record.created_at else None,
         "completed_at": job_record.completed_at.isoformat() if job_record.completed_at else None
     }
 
 
-@ai_model.get("/results", dependencies=[Depends(verify_admin_token)])
+@ai_model.get(
+    "/results",
+    response_model=ResultListResponse | list[ResultListItem],
+    response_class=ORJSONResponse,
+    dependencies=[Depends(verify_admin_token)]
+)
 async def get_all_results(
     db: AsyncSession = Depends(get_db),
-    limit: int = 50,
-    offset: int = 0
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    total: Literal["approximate", "exact"] | None = None,
+    offset: int | None = Query(None, ge=0, deprecated=True)
 ):
-    """Получить список всех завершённых результатов (только ID)"""
-    query = select(JobResult).where(JobResult.status == 'finished').order_by(JobResult.completed_at.desc())
-    query = query.limit(limit).offset(offset)
-    result = await db.execute(query)
-    jobs = result.scalars().all()
+    """
+    Список завершённых результатов (только ID), последние первыми; страницы — как в /jobs.
+    offset — прежний ответ для старых клиентов: список без обёртки, страницы через OFFSET.
+    """
+    query = select(JobResult.id, JobResult.job_id, JobResult.completed_at).where(JobResult.status == 'finished')
+    if offset is not None:
+        check_offset_mode(cursor)
+        return (await db.execute(offset_page(query, JobResult.completed_at, offset, limit))).mappings().all()
+    rows = (await db.execute(keyset_page(query, JobResult.completed_at, JobResult.id, cursor, limit))).mappings().all()
+    results, next_cursor = page_result(rows, limit, "completed_at")
     
+    return {
+        "results": results,
+        "next_cursor": next_cursor,
+        "total": await total_rows(db, query, total)
+    }
+
+
+def _seconds(end, start):
+    return func.extract("epoch", end - start)
+
+
+def _percentiles(name: str, expr, levels=(0.5, 0.95, 0.99)) -> list:
     return [
-        {
-            "id": job.id,
-            "job_id": job.job_id
-        }
-        for job in jobs
+        func.percentile_cont(level).within_group(expr).label(f"{name}_p{int(level * 100)}")
+        for level in levels
     ]
 
 
-# TODO: Вернуть проверку авторизации после добавления системы регистрации
-@ai_model.get("/batch/{batch_id}")
-async def get_batch_status(batch_id: str, db: AsyncSession = Depends(get_db)):
-    """Получить статус всего батча задач"""
+@ai_model.get("/provider_calls/stats", dependencies=[Depends(verify_admin_token)])
+async def get_provider_call_stats(
+    db: AsyncSession = Depends(get_db),
+    hours: int = 24,
+    ai_model_filter: str | None = None
+):
+    """
+    Перцентили задержек вызовов провайдеров по модели и промпту за последние hours часов (секунды):
+    duration — весь вызов, ttfb — до первого байта ответа, wait — ожидание лимитера и очереди чанков,
+    queue_wait — от постановки задачи в очередь до готовности чанков.
+    """
+    latency = _seconds(ProviderCall.ended_at, ProviderCall.started_at)
+    query = (
+        select(
+            ProviderCall.ai_model,
+            ProviderCall.model,
+            JobResult.prompt_name,
+            func.count().label("calls"),
+            func.count().filter(ProviderCall.succeeded.is_(False)).label("failed"),
+            func.sum(ProviderCall.retry_count).label("retries"),
+            func.sum(ProviderCall.prompt_tokens).label("prompt_tokens"),
+            func.sum(ProviderCall.completion_tokens).label("completion_tokens"),
+            func.sum(ProviderCall.cached_tokens).label("cached_tokens"),
+            func.sum(latency).label("total_seconds"),
+            *_percentiles("duration", latency),
+            *_percentiles("ttfb", _seconds(ProviderCall.first_byte_at, ProviderCall.started_at)),
+            *_percentiles("wait", _seconds(ProviderCall.started_at, ProviderCall.enqueued_at), (0.5, 0.95)),
+            *_percentiles("queue_wait", _seconds(ProviderCall.enqueued_at, JobResult.created_at), (0.5, 0.95)),
+        )
+        .join(JobResult, JobResult.job_id == ProviderCall.job_id)
+        .where(ProviderCall.started_at >= datetime.utcnow() - timedelta(hours=hours))
+        .group_by(ProviderCall.ai_model, ProviderCall.model, JobResult.prompt_name)
+        # Сверху — кто больше всего времени держит провайдеров
+        .order_by(func.sum(latency).desc())
+    )
+    if ai_model_filter:
+        query = query.where(ProviderCall.ai_model == ai_model_filter)
+
+    rows = (await db.execute(query)).mappings().all()
+    return {
+        "hours": hours,
+        "stats": [
+            {
+                key: round(float(value), 3) if isinstance(value, (float, Decimal)) else value
+                for key, value in row.items()
+            }
+            for row in rows
+        ]
+    }
+
+
+async def load_batch_status(db: AsyncSession, batch_id: str) -> dict | None:
+    """Состояние батча и его задач (только короткие колонки); None — батча нет"""
     # Получаем информацию о батче
     batch_result = await db.execute(
-        select(BatchStatus).where(BatchStatus.batch_id == batch_id)
+        select(
+            BatchStatus.batch_id,
+            BatchStatus.status,
+            BatchStatus.total_jobs,
+            BatchStatus.completed_jobs,
+            BatchStatus.failed_jobs,
+            BatchStatus.created_at,
+            BatchStatus.completed_at
+        ).where(BatchStatus.batch_id == batch_id)
     )
-    batch = batch_result.scalar_one_or_none()
+    batch = batch_result.mappings().one_or_none()
     
     if not batch:
-        raise HTTPException(status_code=404, detail="Батч не найден")
+        return None
     
     # Получаем все задачи этого батча (исключая объединенный файл)
     jobs_result = await db.execute(
-        select(JobResult).where(
+        select(
+            JobResult.job_id,
+            JobResult.prompt_name,
+            JobResult.status,
+            JobResult.total_tokens,
+            JobResult.error_message,
+            JobResult.created_at,
+            JobResult.completed_at
+        ).where(
             JobResult.batch_id == batch_id,
             JobResult.prompt_name != "MERGED_DOCUMENTATION"
         ).order_by(JobResult.created_at)
     )
-    jobs = jobs_result.scalars().all()
+    jobs = jobs_result.mappings().all()
     
     # Проверяем наличие объединенного файла
     merged_result = await db.execute(
-        select(JobResult).where(
+        select(JobResult.job_id).where(
             JobResult.batch_id == batch_id,
             JobResult.prompt_name == "MERGED_DOCUMENTATION"
         )
     )
-    merged_job = merged_result.scalar_one_or_none()
-    
-    response = {
-        "batch_id": batch.batch_id,
-        "status": batch.status,
-        "total_jobs": batch.total_jobs,
-        "completed_jobs": batch.completed_jobs,
-        "failed_jobs": batch.failed_jobs,
-        "created_at": batch.created_at.isoformat() if batch.created_at else None,
-        "completed_at": batch.completed_at.isoformat() if batch.completed_at else None,
-        "has_merged_result": merged_job is not None,
-        "merged_job_id": merged_job.job_id if merged_job else None,
-        "jobs": [
-            {
-                "job_id": job.job_id,
-                "prompt_name": job.prompt_name,
-                "status": job.status,
-                "total_tokens": job.total_tokens,
-                "error_message": job.error_message,
-                "created_at": job.created_at.isoformat() if job.created_at else None,
-                "completed_at": job.completed_at.isoformat() if job.completed_at else None
-            }
-            for job in jobs
-        ]
-    }
+    merged_job_id = merged_result.scalar_one_or_none()
     
-    return response
+    return {
+        **batch,
+        "has_merged_result": merged_job_id is not None,
+        "merged_job_id": merged_job_id,
+        "jobs": jobs
+    }
+
+
+# TODO: Вернуть проверку авторизации после добавления системы регистрации
+@ai_model.get("/batch/{batch_id}", response_model=BatchStatusResponse, response_class=ORJSONResponse)
+async def get_batch_status(
+    batch_id: str,
+    response: Response,
+    if_none_match: str | None = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """Получить статус всего батча задач. ETag — версия батча; If-None-Match с ней же получает 304"""
+    version = (await db.execute(
+        select(BatchStatus.id, BatchStatus.version).where(BatchStatus.batch_id == batch_id)
+    )).first()
+    if not version:
+        raise HTTPException(status_code=404, detail="Батч не найден")
+
+    # Версия читается до снимка: если батч изменится между запросами, ETag будет старше ответа, а не новее
+    etag = make_etag(*version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    batch = await load_batch_status(db, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Батч не найден")
+    set_etag(response, etag)
+    return batch
+
+
+async def batch_snapshot_event(batch_id: str) -> tuple:
+    """(SSE событие batch с состоянием из БД, статус батча). Сессия открывается только на чтение снимка"""
+    async with async_session() as db:
+        snapshot = await load_batch_status(db, batch_id)
+    if snapshot is None:
+        return sse_event("error", {"detail": "Батч не найден"}), 'failed'
+    return sse_event("batch", BatchStatusResponse.model_validate(snapshot).model_dump(mode="json")), snapshot["status"]
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+# TODO: Вернуть проверку авторизации после добавления системы регистрации
+@ai_model.get("/batch/{batch_id}/events")
+async def stream_batch_events(batch_id: str, request: Request):
+    """
+    Server-Sent Events: снимок батча (событие batch), затем изменения из Redis —
+    job (задача взята в работу), progress (задача завершена, счётчики батча) и batch (итог).
+    Поток закрывается после завершения батча.
+    """
+    async def events():
+        queue = await batch_event_hub.subscribe(batch_id)
+        try:
+            # Снимок читается после подписки: события, пришедшие во время чтения, не теряются
+            snapshot, status = await batch_snapshot_event(batch_id)
+            yield snapshot
+            while status not in FINAL_BATCH_STATUSES:
+                try:
+                    message = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    if batch_event_hub.connected:
+                        # Комментарий держит соединение открытым через прокси
+                        yield ": keepalive\n\n"
+                    else:
+                        # Redis недоступен — отдаём состояние из БД с интервалом keepalive
+                        snapshot, status = await batch_snapshot_event(batch_id)
+                        yield snapshot
+                    continue
+
+                if message["event"] == "resync":
+                    snapshot, status = await batch_snapshot_event(batch_id)
+                    yield snapshot
+                    continue
+                yield sse_event(message["event"], message["data"])
+                if message["event"] == "batch":
+                    status = message["data"]["status"]
+        finally:
+            batch_event_hub.unsubscribe(batch_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# TODO: Вернуть проверку авторизации после добавления системы регистрации
+@ai_model.get("/batch/{batch_id}/results")
+async def get_batch_results(
+    batch_id: str,
+    format: Literal["ndjson", "tar"] = Query("ndjson", description="ndjson — строка JSON на задачу, tar — tar.gz с markdown файлами"),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Все результаты батча одним потоковым ответом: текст и статистика каждой задачи
+    (и объединённого файла). Строки читаются серверным курсором, батч целиком в памяти не держится.
+    """
+    exists = (await db.execute(
+        select(BatchStatus.id).where(BatchStatus.batch_id == batch_id)
+    )).scalar_one_or_none()
+    if exists is None:
+        raise HTTPException(status_code=404, detail="Батч не найден")
+
+    rows = stream_batch_rows(batch_id)
+    if format == "tar":
+        return StreamingResponse(
+            tar_gz_results(rows, batch_id),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f'attachment; filename="batch_{batch_id}.tar.gz"'}
+        )
+    return StreamingResponse(ndjson_results(rows), media_type="application/x-ndjson")
 
 
 # TODO: Вернуть проверку авторизации после добавления системы регистрации
 @ai_model.get("/jobs/{job_id}")
-async def get_job_status(job_id: str, db: AsyncSession = Depends(get_db)):
-    """Получить статус и результат задачи из БД"""
+async def get_job_status(
+    job_id: str,
+    response: Response,
+    if_none_match: str | None = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Получить статус и результат задачи из БД.
+    ETag — статус и время завершения: result_text после завершения не меняется,
+    поэтому If-None-Match получает 304 без чтения результата
+    """
+    state = (await db.execute(
+        select(JobResult.status, JobResult.completed_at).where(JobResult.job_id == job_id)
+    )).first()
+    if not state:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+
+    etag = make_etag(state.status, int(state.completed_at.timestamp() * 1000) if state.completed_at else 0)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
     result = await db.execute(
-        select(JobResult).where(JobResult.job_id == job_id)
+        select(JobResult)
+        .options(defer(JobResult.request_code))
+        .where(JobResult.job_id == job_id)
     )
     job_record = result.scalar_one_or_none()
     
     if not job_record:
         raise HTTPException(status_code=404, detail="Задача не найдена")
     
-    response = {
+    set_etag(response, etag)
+    job_response = {
         "job_id": job_record.job_id,
         "status": job_record.status,
         "ai_model": job_record.ai_model,
@@ -185,13 +460,15 @@ async def get_job_status(job_id: str, db: AsyncSession = Depends(get_db)):
     }
     
     if job_record.status == 'finished':
-        response["result"] = job_record.result_text
-        response["statistics"] = {
+        job_response["result"] = job_record.result_text
+        job_response["statistics"] = {
             "prompt_tokens": job_record.prompt_tokens,
             "completion_tokens": job_record.completion_tokens,
-            "total_tokens": job_record.total_tokens
+            "total_tokens": job_record.total_tokens,
+            "cached_tokens": job_record.cached_tokens,
+            "from_cache": job_record.from_cache
         }
     elif job_record.status == 'failed':
-        response["error"] = job_record.error_message
+        job_response["error"] = job_record.error_message
     
-    return response
+    return job_response
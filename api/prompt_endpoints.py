@@ -4,6 +4,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from api.core.db_con import get_db, PromptTemplate
 from api.core.security import verify_admin_token
+from openai_.tokenizer import count_tokens
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional
 from datetime import datetime
@@ -29,6 +31,7 @@ class PromptResponse(BaseModel):
     content: str
     description: Optional[str]
     is_active: bool
+    token_count: Optional[int] = None
     created_at: datetime
     updated_at: datetime
 
@@ -51,12 +54,13 @@ async def create_prompt(prompt_data: PromptCreate, db: AsyncSession = Depends(ge
             detail=f"Промпт с именем '{prompt_data.name}' уже существует"
         )
     
-    # Создаём новый промпт
+    # Создаём новый промпт (токены считаем один раз здесь, воркеры их не пересчитывают)
     new_prompt = PromptTemplate(
         name=prompt_data.name,
         content=prompt_data.content,
         description=prompt_data.description,
-        is_active=prompt_data.is_active
+        is_active=prompt_data.is_active,
+        token_count=await run_in_threadpool(count_tokens, prompt_data.content)
     )
     
     db.add(new_prompt)
@@ -126,6 +130,7 @@ async def update_prompt(prompt_name: str, prompt_data: PromptUpdate, db: AsyncSe
     
     if prompt_data.content is not None:
         prompt.content = prompt_data.content
+        prompt.token_count = await run_in_threadpool(count_tokens, prompt_data.content)
     if prompt_data.description is not None:
         prompt.description = prompt_data.description
     if prompt_data.is_active is not None:
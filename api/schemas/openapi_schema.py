@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic import BaseModel, ConfigDict
 
 class prompt_form(BaseModel):
@@ -16,5 +17,62 @@ class request_form(BaseModel):
     request: str
     model: str
     callback_url: str | None = None
+    # Код отправляется первым, как кешируемый префикс, промпт — после него
+    prompt_caching: bool = False
+    # Брать ответы из кеша, если этот код уже отправлялся с теми же промптами
+    use_cache: bool = True
+    # Код больше контекста: чанки обрабатываются независимо, затем ответы сворачиваются в один
+    map_reduce: bool = False
+    # Инкрементальный режим: повторная отправка того же репозитория (ключ — например, URL)
+    # переиспользует результаты по неизменённым файлам и отправляет в модель только изменения
+    repository: str | None = None
 
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+
+# Ответы списков: только короткие поля, без кода и текста результатов
+
+class JobListItem(BaseModel):
+    job_id: str
+    status: str
+    ai_model: str
+    model: str
+    prompt_name: str
+    created_at: datetime | None = None
+    completed_at: datetime | None = None
+
+class JobListResponse(BaseModel):
+    jobs: list[JobListItem]
+    # Курсор следующей страницы (None — страница последняя)
+    next_cursor: str | None = None
+    # Всего строк по фильтру, если запрошен total=approximate|exact
+    total: int | None = None
+
+class ResultListItem(BaseModel):
+    id: int
+    job_id: str
+
+class ResultListResponse(BaseModel):
+    results: list[ResultListItem]
+    next_cursor: str | None = None
+    total: int | None = None
+
+class BatchJobItem(BaseModel):
+    job_id: str
+    prompt_name: str
+    status: str
+    total_tokens: int | None = None
+    error_message: str | None = None
+    created_at: datetime | None = None
+    completed_at: datetime | None = None
+
+class BatchStatusResponse(BaseModel):
+    batch_id: str
+    status: str
+    total_jobs: int
+    completed_jobs: int | None = None
+    failed_jobs: int | None = None
+    created_at: datetime | None = None
+    completed_at: datetime | None = None
+    has_merged_result: bool
+    merged_job_id: str | None = None
+    jobs: list[BatchJobItem]
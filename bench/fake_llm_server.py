@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Фейковый LLM провайдер для нагрузочных тестов.
+
+Отвечает в формате OpenAI / DeepSeek (POST /v1/chat/completions) и Anthropic (POST /v1/messages),
+с настраиваемой задержкой, usage и долей ответов 429. Настройки — переменные окружения FAKE_*.
+
+Запуск:
+    uvicorn bench.fake_llm_server:app --host 0.0.0.0 --port 9000
+
+Переключение сервиса на фейковый сервер (.env):
+    OPENAI_BASE_URL=http://fake_llm:9000/v1
+    ANTHROPIC_BASE_URL=http://fake_llm:9000
+    DEEPSEEK_API_URL=http://fake_llm:9000/v1/chat/completions
+"""
+
+import os
+import time
+import uuid
+import random
+import asyncio
+from fastapi           import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+# Распределение задержки ответа: fixed | uniform | lognormal
+LATENCY_DIST = os.getenv("FAKE_LATENCY_DIST", "lognormal")
+LATENCY_MS = float(os.getenv("FAKE_LATENCY_MS", "800"))            # fixed / медиана lognormal / середина uniform
+LATENCY_SIGMA = float(os.getenv("FAKE_LATENCY_SIGMA", "0.5"))      # разброс lognormal
+LATENCY_SPREAD_MS = float(os.getenv("FAKE_LATENCY_SPREAD_MS", "400"))  # ± для uniform
+MS_PER_OUTPUT_TOKEN = float(os.getenv("FAKE_MS_PER_OUTPUT_TOKEN", "0"))
+
+# Ответ: число completion токенов (среднее, ±50%), входные токены — по ~4 символа
+COMPLETION_TOKENS = int(os.getenv("FAKE_COMPLETION_TOKENS", "500"))
+CHARS_PER_TOKEN = 4
+
+# Ошибки: доля ответов 429 и Retry-After для них
+RATE_LIMIT_RATE = float(os.getenv("FAKE_429_RATE", "0"))
+RETRY_AFTER = int(os.getenv("FAKE_RETRY_AFTER", "1"))
+
+app = FastAPI(title="Fake LLM provider")
+
+stats = {"requests": 0, "rate_limited": 0, "started_at": time.time()}
+
+
+def sample_latency() -> float:
+    if LATENCY_DIST == "fixed":
+        latency_ms = LATENCY_MS
+    elif LATENCY_DIST == "uniform":
+        latency_ms = random.uniform(LATENCY_MS - LATENCY_SPREAD_MS, LATENCY_MS + LATENCY_SPREAD_MS)
+    else:
+        latency_ms = random.lognormvariate(0, LATENCY_SIGMA) * LATENCY_MS
+    return max(0.0, latency_ms) / 1000
+
+
+def sample_completion_tokens() -> int:
+    return max(1, int(COMPLETION_TOKENS * random.uniform(0.5, 1.5)))
+
+
+def count_input_tokens(texts: list) -> int:
+    return sum(len(text) for text in texts) // CHARS_PER_TOKEN
+
+
+def message_texts(messages: list) -> list:
+    """Тексты сообщений: content — строка или список блоков (Anthropic, cache_control)"""
+    texts = []
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(block.get("text", "") for block in content if isinstance(block, dict))
+    return texts
+
+
+def fake_text(completion_tokens: int) -> str:
+    return ("Документация. " * (completion_tokens * CHARS_PER_TOKEN // 14 + 1))[:completion_tokens * CHARS_PER_TOKEN]
+
+
+async def simulate(completion_tokens: int) -> bool:
+    """Ждёт как провайдер; возвращает False, если нужно ответить 429"""
+    stats["requests"] += 1
+    if random.random() < RATE_LIMIT_RATE:
+        stats["rate_limited"] += 1
+        await asyncio.sleep(0.01)
+        return False
+    await asyncio.sleep(sample_latency() + completion_tokens * MS_PER_OUTPUT_TOKEN / 1000)
+    return True
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """OpenAI и DeepSeek"""
+    body = await request.json()
+    prompt_tokens = count_input_tokens(message_texts(body.get("messages", [])))
+    completion_tokens = sample_completion_tokens()
+
+    if not await simulate(completion_tokens):
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": str(RETRY_AFTER)},
+            content={"error": {"message": "Rate limit reached (fake)", "type": "rate_limit_exceeded", "code": "rate_limit_exceeded"}}
+        )
+
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": fake_text(completion_tokens)},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+            "prompt_cache_hit_tokens": 0,
+            "prompt_cache_miss_tokens": prompt_tokens
+        }
+    }
+
+
+@app.post("/v1/messages")
+async def anthropic_messages(request: Request):
+    """Anthropic Messages API"""
+    body = await request.json()
+    system = body.get("system") or ""
+    system_texts = [system] if isinstance(system, str) else [block.get("text", "") for block in system]
+    input_tokens = count_input_tokens(system_texts + message_texts(body.get("messages", [])))
+    completion_tokens = min(sample_completion_tokens(), int(body.get("max_tokens", COMPLETION_TOKENS)))
+
+    if not await simulate(completion_tokens):
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": str(RETRY_AFTER)},
+            content={"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limit reached (fake)"}}
+        )
+
+    return {
+        "id": f"msg_{uuid.uuid4().hex}",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model", "fake"),
+        "content": [{"type": "text", "text": fake_text(completion_tokens)}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": input_tokens,
+            "output_tokens": completion_tokens,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0
+        }
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    """Сколько запросов принято и сколько из них получили 429"""
+    return {**stats, "uptime": round(time.time() - stats["started_at"], 1)}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("FAKE_PORT", "9000")))
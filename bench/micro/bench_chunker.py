@@ -0,0 +1,36 @@
+"""Нарезка выгрузки репозитория на чанки по файлам и определениям (openai_/chunker)"""
+import pytest
+
+from openai_.openai_client import ChatGPTClient
+from openai_.chunker       import layout_export, split_export_into_chunks, ratio_estimator
+
+
+CHUNK_SIZE = 8000
+
+
+@pytest.fixture(scope="module")
+def chatgpt():
+    return ChatGPTClient(api_key="bench", openai_client=object(), async_openai_client=object())
+
+
+@pytest.fixture(scope="module")
+def chunking(chatgpt, export_text):
+    """Оценка токенов и запасной сплиттер — как в pipeline.build_job_messages"""
+    estimate = ratio_estimator(export_text, chatgpt.count_tokens(export_text))
+    fallback_split = lambda text, size: chatgpt.split_text_into_chunks(text, chunk_size=size)
+    return estimate, fallback_split
+
+
+def test_split_export_into_chunks(benchmark, peak_memory, export_text, chunking):
+    estimate, fallback_split = chunking
+    peak_memory(split_export_into_chunks, export_text, CHUNK_SIZE, estimate, fallback_split)
+    benchmark(split_export_into_chunks, export_text, CHUNK_SIZE, estimate, fallback_split)
+
+
+def test_layout_export_incremental(benchmark, peak_memory, export_text, chunking):
+    # Раскладка прошлого батча того же кода: все чанки сохраняются, упаковывать нечего
+    estimate, fallback_split = chunking
+    _, layout = layout_export(export_text, CHUNK_SIZE, estimate, fallback_split)
+    previous_layout = {content_hash: chunk_index for _, content_hash, chunk_index in layout}
+    peak_memory(layout_export, export_text, CHUNK_SIZE, estimate, fallback_split, previous_layout)
+    benchmark(layout_export, export_text, CHUNK_SIZE, estimate, fallback_split, previous_layout)
@@ -0,0 +1,23 @@
+"""Обход репозитория и фильтрация файлов в RepoExporter._collect_files"""
+import json
+
+import pytest
+
+from export_repo import RepoExporter
+
+
+@pytest.fixture(scope="module")
+def exporter(tmp_path_factory):
+    config = tmp_path_factory.mktemp("export_config") / "config.json"
+    config.write_text(json.dumps({
+        "exclude_patterns": ["*.png", "*.min.js", "*.lock"],
+        "exclude_directories": ["node_modules", "__pycache__"],
+        "exclude_files": ["package-lock.json"]
+    }), encoding="utf-8")
+    return RepoExporter(str(config))
+
+
+def test_collect_files(benchmark, peak_memory, exporter, repo_path, capsys):
+    exporter._load_gitignore(repo_path)
+    peak_memory(exporter._collect_files, repo_path)
+    benchmark(exporter._collect_files, repo_path)
@@ -0,0 +1,62 @@
+"""Сборка итогового документа батча (merge_batch_results) без БД"""
+from types import SimpleNamespace
+
+from api.broker.task import merge_batch_results
+
+
+class FakeQuery:
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def filter(self, *args):
+        return self
+
+    def order_by(self, *args):
+        return self
+
+    def all(self):
+        return self.jobs
+
+
+class FakeSession:
+    """Сессия, отдающая готовые задачи: меряется только сборка текста"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def query(self, model):
+        return FakeQuery(self.jobs)
+
+    def add(self, obj):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def make_jobs(export_text: str, sections: int = 20) -> list:
+    # Каждая секция — ответ модели размером в долю исходного кода
+    size = max(1, len(export_text) // sections)
+    return [
+        SimpleNamespace(
+            prompt_name=f"prompt_{idx:02d}",
+            result_text=export_text[idx * size:(idx + 1) * size],
+            prompt_tokens=size // 4,
+            completion_tokens=size // 8,
+            total_tokens=size // 4 + size // 8,
+            cached_tokens=0,
+            ai_model="chatgpt",
+            model="gpt-4o-mini",
+            source_hash="0" * 64
+        )
+        for idx in range(sections)
+    ]
+
+
+def test_merge_batch_results(benchmark, peak_memory, export_text, capsys):
+    db = FakeSession(make_jobs(export_text))
+    peak_memory(merge_batch_results, "bench", db)
+    benchmark(merge_batch_results, "bench", db)
@@ -0,0 +1,55 @@
+"""Токенизация и нарезка на чанки в клиентах провайдеров"""
+import pytest
+
+from openai_.openai_client   import ChatGPTClient
+from openai_.deepseek_client import DeepSeekClient
+from openai_.sonnet_client   import SonnetClient
+
+
+CHUNK_SIZE = 8000
+
+
+@pytest.fixture(scope="module")
+def chatgpt():
+    # Транспорт не нужен: сетевые вызовы в бенчмарках не делаются
+    return ChatGPTClient(api_key="bench", openai_client=object(), async_openai_client=object())
+
+
+@pytest.fixture(scope="module")
+def deepseek():
+    return DeepSeekClient(api_key="bench", http_client=object(), async_http_client=object())
+
+
+@pytest.fixture(scope="module")
+def sonnet():
+    return SonnetClient(api_key="bench", anthropic_client=object(), async_anthropic_client=object())
+
+
+def test_chatgpt_tokenize_text(benchmark, peak_memory, chatgpt, export_text):
+    peak_memory(chatgpt.tokenize_text, export_text)
+    benchmark(chatgpt.tokenize_text, export_text)
+
+
+def test_chatgpt_split_text_into_chunks(benchmark, peak_memory, chatgpt, export_text):
+    peak_memory(chatgpt.split_text_into_chunks, export_text, CHUNK_SIZE)
+    benchmark(chatgpt.split_text_into_chunks, export_text, CHUNK_SIZE)
+
+
+def test_deepseek_tokenize_text(benchmark, peak_memory, deepseek, export_text):
+    peak_memory(deepseek.tokenize_text, export_text)
+    benchmark(deepseek.tokenize_text, export_text)
+
+
+def test_deepseek_split_text_into_chunks(benchmark, peak_memory, deepseek, export_text):
+    peak_memory(deepseek.split_text_into_chunks, export_text, CHUNK_SIZE)
+    benchmark(deepseek.split_text_into_chunks, export_text, CHUNK_SIZE)
+
+
+def test_sonnet_count_tokens(benchmark, peak_memory, sonnet, export_text):
+    peak_memory(sonnet.count_tokens, export_text)
+    benchmark(sonnet.count_tokens, export_text)
+
+
+def test_sonnet_split_text_into_chunks(benchmark, peak_memory, sonnet, export_text):
+    peak_memory(sonnet.split_text_into_chunks, export_text, CHUNK_SIZE)
+    benchmark(sonnet.split_text_into_chunks, export_text, CHUNK_SIZE)
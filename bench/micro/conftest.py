@@ -0,0 +1,126 @@
+"""
+Общие фикстуры микробенчмарков: синтетические выгрузки и репозитории заданных размеров,
+замер пикового потребления памяти (tracemalloc) и сравнение его с сохранённым базовым уровнем.
+
+Размеры задаются через BENCH_SIZES (по умолчанию 100KB,1MB,10MB; 100MB — только явно).
+"""
+import os
+import sys
+import json
+import tracemalloc
+from   pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+# api.core.db_con создаёт engine при импорте и падает без DB_*; к базе бенчмарки не подключаются
+for name, value in (("DB_USER", "bench"), ("DB_PASSWORD", "bench"), ("DB_NAME", "bench"), ("DB_PORT", "5432")):
+    os.environ.setdefault(name, value)
+
+
+MEMORY_BASELINE = Path(__file__).with_name("memory_baseline.json")
+# Во сколько раз пик памяти может превысить базовый уровень, прежде чем тест упадёт
+MEMORY_TOLERANCE = float(os.getenv("BENCH_MEMORY_TOLERANCE", "1.2"))
+
+UNITS = {"KB": 1024, "MB": 1024 ** 2}
+
+
+def parse_size(size: str) -> int:
+    return int(size[:-2]) * UNITS[size[-2:].upper()]
+
+
+SIZES = os.getenv("BENCH_SIZES", "100KB,1MB,10MB").split(",")
+
+_memory_results = {}
+
+
+def pytest_addoption(parser):
+    parser.addoption("--memory-save", action="store_true", help="Сохранить пики памяти как базовый уровень")
+    parser.addoption("--memory-compare", action="store_true", help="Сравнить пики памяти с базовым уровнем")
+
+
+def synthetic_file(idx: int, functions: int = 40) -> str:
+    """Модуль Python, похожий на реальный код: функции, docstring, ветвления, не-ASCII"""
+    return "".join(
+        f"def handler_{idx}_{n}(request, session=None):\n"
+        f"    \"\"\"Обработчик запроса {n} модуля {idx}\"\"\"\n"
+        f"    if request.get('value') is None:\n"
+        f"        raise ValueError('Нет значения в запросе {n}')\n"
+        f"    result = {{'status': 'ok', 'value': request['value'] * {n}}}\n"
+        f"    return result\n\n"
+        for n in range(functions)
+    )
+
+
+def synthetic_export(size: int) -> str:
+    """Выгрузка в формате export_repo.py примерно заданного размера в байтах"""
+    parts, total, idx = [], 0, 0
+    while total < size:
+        text = f"=== src/package_{idx // 50}/module_{idx}.py ===\n{synthetic_file(idx)}---\n"
+        parts.append(text)
+        total += len(text.encode("utf-8"))
+        idx += 1
+    return "".join(parts)
+
+
+@pytest.fixture(scope="session", params=SIZES)
+def export_text(request):
+    return synthetic_export(parse_size(request.param))
+
+
+@pytest.fixture(scope="session", params=SIZES)
+def repo_path(request, tmp_path_factory):
+    """Дерево файлов на диске с .gitignore, исключаемыми каталогами и бинарными файлами"""
+    size = parse_size(request.param)
+    root = tmp_path_factory.mktemp(f"repo_{request.param}")
+    (root / ".gitignore").write_text("*.log\nbuild/\n", encoding="utf-8")
+    for excluded in ("node_modules", "build", ".git"):
+        (root / excluded).mkdir()
+        (root / excluded / "skip.js").write_text("x", encoding="utf-8")
+
+    total, idx = 0, 0
+    while total < size:
+        package = root / "src" / f"package_{idx // 50}"
+        package.mkdir(parents=True, exist_ok=True)
+        text = synthetic_file(idx)
+        (package / f"module_{idx}.py").write_text(text, encoding="utf-8")
+        if idx % 20 == 0:
+            (package / f"debug_{idx}.log").write_text("log", encoding="utf-8")
+            (package / f"image_{idx}.png").write_bytes(b"\x89PNG\x00\x00")
+        total += len(text.encode("utf-8"))
+        idx += 1
+    return root
+
+
+@pytest.fixture
+def peak_memory(request, benchmark):
+    """
+    Один прогон функции под tracemalloc: пик памяти пишется в extra_info бенчмарка
+    и сравнивается с базовым уровнем (--memory-compare).
+    """
+    def measure(func, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        peak_mb = round(peak / 1024 ** 2, 2)
+        benchmark.extra_info["peak_memory_mb"] = peak_mb
+        _memory_results[request.node.nodeid] = peak_mb
+
+        if request.config.getoption("--memory-compare") and MEMORY_BASELINE.exists():
+            baseline = json.loads(MEMORY_BASELINE.read_text()).get(request.node.nodeid)
+            if baseline and peak_mb > baseline * MEMORY_TOLERANCE:
+                pytest.fail(f"Пик памяти {peak_mb} MB превысил базовый уровень {baseline} MB")
+        return peak_mb
+    return measure
+
+
+def pytest_sessionfinish(session):
+    if session.config.getoption("--memory-save") and _memory_results:
+        baseline = json.loads(MEMORY_BASELINE.read_text()) if MEMORY_BASELINE.exists() else {}
+        baseline.update(_memory_results)
+        MEMORY_BASELINE.write_text(json.dumps(baseline, indent=2, ensure_ascii=False, sort_keys=True) + "\n")
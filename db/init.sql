@@ -22,6 +22,7 @@ CREATE TABLE prompts (
     content         TEXT NOT NULL,
     description     TEXT,
     is_active       BOOLEAN DEFAULT true,
+    token_count     INTEGER,
     created_at      TIMESTAMP DEFAULT NOW(),
     updated_at      TIMESTAMP DEFAULT NOW()
 );
@@ -36,11 +37,14 @@ CREATE TABLE job_results (
     ai_model        TEXT NOT NULL,
     model           TEXT NOT NULL,
     prompt_name     TEXT NOT NULL,
-    request_code    TEXT NOT NULL,
+    source_hash     TEXT,
+    request_code    TEXT,
     result_text     TEXT,
     prompt_tokens   INTEGER,
     completion_tokens INTEGER,
     total_tokens    INTEGER,
+    cached_tokens   INTEGER,
+    from_cache      BOOLEAN DEFAULT FALSE,
     status          TEXT NOT NULL DEFAULT 'queued',
     error_message   TEXT,
     created_at      TIMESTAMP DEFAULT NOW(),
@@ -49,7 +53,10 @@ CREATE TABLE job_results (
 
 CREATE INDEX idx_job_results_job_id ON job_results(job_id);
 CREATE INDEX idx_job_results_batch_id ON job_results(batch_id);
-CREATE INDEX idx_job_results_created_at ON job_results(created_at);
+-- Под keyset-пагинацию списков /jobs и /results
+CREATE INDEX idx_job_results_created_at_id ON job_results(created_at, id);
+CREATE INDEX idx_job_results_status_completed_at_id ON job_results(status, completed_at, id);
+CREATE INDEX idx_job_results_source_hash ON job_results(source_hash);
 
 CREATE TABLE batch_status (
     id              BIGSERIAL PRIMARY KEY,
@@ -60,14 +67,58 @@ CREATE TABLE batch_status (
     status          TEXT NOT NULL DEFAULT 'processing',
     callback_url    TEXT,
     callback_sent   BOOLEAN DEFAULT FALSE,
+    source_hash     TEXT,
+    repository      TEXT,
+    version         INTEGER NOT NULL DEFAULT 0,
     created_at      TIMESTAMP DEFAULT NOW(),
     completed_at    TIMESTAMP
 );
 
 CREATE INDEX idx_batch_status_batch_id ON batch_status(batch_id);
 CREATE INDEX idx_batch_status_status ON batch_status(status);
+CREATE INDEX idx_batch_status_repository ON batch_status(repository);
+
+CREATE TABLE batch_files (
+    id              BIGSERIAL PRIMARY KEY,
+    batch_id        TEXT NOT NULL,
+    path            TEXT NOT NULL,
+    content_hash    TEXT NOT NULL,
+    chunk_index     INTEGER NOT NULL,
+    UNIQUE (batch_id, content_hash)
+);
+
+CREATE INDEX idx_batch_files_batch_id ON batch_files(batch_id);
 CREATE INDEX idx_batch_status_created_at ON batch_status(created_at);
 
+CREATE TABLE provider_calls (
+    id              BIGSERIAL PRIMARY KEY,
+    job_id          TEXT NOT NULL,
+    ai_model        TEXT NOT NULL,
+    model           TEXT NOT NULL,
+    kind            TEXT NOT NULL DEFAULT 'chunk',
+    chunk_index     INTEGER,
+    enqueued_at     TIMESTAMP,
+    started_at      TIMESTAMP,
+    first_byte_at   TIMESTAMP,
+    ended_at        TIMESTAMP,
+    prompt_tokens   INTEGER,
+    completion_tokens INTEGER,
+    cached_tokens   INTEGER,
+    retry_count     INTEGER DEFAULT 0,
+    succeeded       BOOLEAN DEFAULT TRUE
+);
+
+CREATE INDEX idx_provider_calls_job_id ON provider_calls(job_id);
+CREATE INDEX idx_provider_calls_started_at ON provider_calls(started_at);
+
+CREATE TABLE source_blobs (
+    content_hash    TEXT PRIMARY KEY,
+    content         TEXT NOT NULL,
+    size_bytes      INTEGER NOT NULL,
+    token_count     INTEGER,
+    created_at      TIMESTAMP DEFAULT NOW()
+);
+
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO postgres;
 ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT ALL PRIVILEGES ON TABLES TO postgres;
 
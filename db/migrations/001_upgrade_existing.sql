@@ -0,0 +1,70 @@
+-- Обновление схемы баз, созданных до изменений init.sql (init.sql выполняется только на пустом томе,
+-- а create_all не меняет существующие таблицы). Идемпотентно: выполняется при каждом старте API.
+
+-- Несколько реплик API не должны менять схему одновременно (блокировка до конца транзакции)
+SELECT pg_advisory_xact_lock(7270010001);
+
+ALTER TABLE prompts ADD COLUMN IF NOT EXISTS token_count INTEGER;
+
+ALTER TABLE job_results ADD COLUMN IF NOT EXISTS source_hash TEXT;
+ALTER TABLE job_results ADD COLUMN IF NOT EXISTS cached_tokens INTEGER;
+ALTER TABLE job_results ADD COLUMN IF NOT EXISTS from_cache BOOLEAN DEFAULT FALSE;
+-- Код хранится один раз в source_blobs, задачи ссылаются на него по source_hash
+ALTER TABLE job_results ALTER COLUMN request_code DROP NOT NULL;
+
+DROP INDEX IF EXISTS idx_job_results_created_at;
+CREATE INDEX IF NOT EXISTS idx_job_results_created_at_id ON job_results(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_job_results_status_completed_at_id ON job_results(status, completed_at, id);
+CREATE INDEX IF NOT EXISTS idx_job_results_source_hash ON job_results(source_hash);
+
+-- Keyset-пагинация /jobs и /results пропускает строки без значения сортировки: проставляем его старым строкам.
+-- Строки без единой даты уходят в конец списка
+UPDATE job_results SET created_at = COALESCE(completed_at, 'epoch'::timestamp) WHERE created_at IS NULL;
+UPDATE job_results SET completed_at = created_at WHERE status = 'finished' AND completed_at IS NULL;
+
+ALTER TABLE batch_status ADD COLUMN IF NOT EXISTS source_hash TEXT;
+ALTER TABLE batch_status ADD COLUMN IF NOT EXISTS repository TEXT;
+ALTER TABLE batch_status ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_batch_status_repository ON batch_status(repository);
+CREATE INDEX IF NOT EXISTS idx_batch_status_created_at ON batch_status(created_at);
+
+CREATE TABLE IF NOT EXISTS batch_files (
+    id              BIGSERIAL PRIMARY KEY,
+    batch_id        TEXT NOT NULL,
+    path            TEXT NOT NULL,
+    content_hash    TEXT NOT NULL,
+    chunk_index     INTEGER NOT NULL,
+    UNIQUE (batch_id, content_hash)
+);
+
+CREATE INDEX IF NOT EXISTS idx_batch_files_batch_id ON batch_files(batch_id);
+
+CREATE TABLE IF NOT EXISTS provider_calls (
+    id              BIGSERIAL PRIMARY KEY,
+    job_id          TEXT NOT NULL,
+    ai_model        TEXT NOT NULL,
+    model           TEXT NOT NULL,
+    kind            TEXT NOT NULL DEFAULT 'chunk',
+    chunk_index     INTEGER,
+    enqueued_at     TIMESTAMP,
+    started_at      TIMESTAMP,
+    first_byte_at   TIMESTAMP,
+    ended_at        TIMESTAMP,
+    prompt_tokens   INTEGER,
+    completion_tokens INTEGER,
+    cached_tokens   INTEGER,
+    retry_count     INTEGER DEFAULT 0,
+    succeeded       BOOLEAN DEFAULT TRUE
+);
+
+CREATE INDEX IF NOT EXISTS idx_provider_calls_job_id ON provider_calls(job_id);
+CREATE INDEX IF NOT EXISTS idx_provider_calls_started_at ON provider_calls(started_at);
+
+CREATE TABLE IF NOT EXISTS source_blobs (
+    content_hash    TEXT PRIMARY KEY,
+    content         TEXT NOT NULL,
+    size_bytes      INTEGER NOT NULL,
+    token_count     INTEGER,
+    created_at      TIMESTAMP DEFAULT NOW()
+);
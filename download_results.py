@@ -3,6 +3,7 @@
 Скрипт для скачивания объединенной документации из последнего батча
 Использование: python download_results.py
 """
+import json
 import requests
 import sys
 from pathlib import Path
@@ -34,51 +35,49 @@ def get_latest_batch_id():
         print(f"Ошибка при получении информации о промптах: {e}")
         return None
 
-def get_batch_status(batch_id):
-    """Получает статус батча"""
-    try:
-        response = requests.get(
-            f"{API_URL}/api/v1/ai_model/batch/{batch_id}"
-        )
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка при получении статуса батча: {e}")
-        return None
+def iter_batch_results(batch_id):
+    """Результаты всех задач батча одним потоковым запросом (строка JSON на задачу)"""
+    response = requests.get(
+        f"{API_URL}/api/v1/ai_model/batch/{batch_id}/results",
+        params={"format": "ndjson"},
+        stream=True
+    )
+    response.raise_for_status()
+    for line in response.iter_lines():
+        if line:
+            yield json.loads(line)
 
 def download_merged_result(batch_id, output_dir="results"):
     """Скачивает объединенный результат батча"""
-    print(f"\nПолучение информации о батче {batch_id}...")
+    print(f"\nПолучение результатов батча {batch_id}...")
     
-    batch_data = get_batch_status(batch_id)
-    if not batch_data:
-        print("Не удалось получить информацию о батче")
+    try:
+        merged = None
+        completed, failed, total = 0, 0, 0
+        for job in iter_batch_results(batch_id):
+            if job['prompt_name'] == "MERGED_DOCUMENTATION":
+                merged = job
+                continue
+            total += 1
+            if job['status'] == 'finished':
+                completed += 1
+            elif job['status'] == 'failed':
+                failed += 1
+    except requests.exceptions.RequestException as e:
+        print(f"Ошибка при получении результатов батча: {e}")
         return False
     
-    print(f"Статус батча: {batch_data['status']}")
-    print(f"Завершено задач: {batch_data['completed_jobs']}/{batch_data['total_jobs']}")
-    print(f"Ошибок: {batch_data['failed_jobs']}")
+    print(f"Завершено задач: {completed}/{total}")
+    print(f"Ошибок: {failed}")
     
-    if not batch_data.get('has_merged_result'):
+    if not merged or not merged.get('result'):
         print("\n❌ Объединенный результат еще не готов")
         print("Батч должен быть полностью завершен для создания объединенного файла")
         return False
     
-    merged_job_id = batch_data.get('merged_job_id')
-    if not merged_job_id:
-        print("\n❌ ID объединенного результата не найден")
-        return False
-    
-    print(f"\n✅ Объединенный результат найден (ID: {merged_job_id})")
+    print(f"\n✅ Объединенный результат найден (ID: {merged['job_id']})")
     
-    # Скачиваем объединенный результат
     try:
-        response = requests.get(
-            f"{API_URL}/api/v1/ai_model/jobs/{merged_job_id}"
-        )
-        response.raise_for_status()
-        result_data = response.json()
-        
         # Создаем директорию для результатов
         output_path = Path(output_dir)
         output_path.mkdir(exist_ok=True)
@@ -90,23 +89,20 @@ def download_merged_result(batch_id, output_dir="results"):
         
         # Сохраняем файл
         with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(result_data['result_text'])
+            f.write(merged['result'])
         
         print(f"\n✅ Документация сохранена: {filepath}")
         
         # Выводим статистику
-        stats = result_data.get('statistics', {})
+        stats = merged.get('statistics', {})
         if stats:
             print(f"\n📊 Статистика:")
-            print(f"   - Токенов (prompt): {stats.get('prompt_tokens', 0):,}")
-            print(f"   - Токенов (completion): {stats.get('completion_tokens', 0):,}")
-            print(f"   - Всего токенов: {stats.get('total_tokens', 0):,}")
+            print(f"   - Токенов (prompt): {stats.get('prompt_tokens') or 0:,}")
+            print(f"   - Токенов (completion): {stats.get('completion_tokens') or 0:,}")
+            print(f"   - Всего токенов: {stats.get('total_tokens') or 0:,}")
         
         return True
         
-    except requests.exceptions.RequestException as e:
-        print(f"\n❌ Ошибка при скачивании результата: {e}")
-        return False
     except Exception as e:
         print(f"\n❌ Ошибка при сохранении файла: {e}")
         return False
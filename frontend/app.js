@@ -2,6 +2,8 @@
 let selectedFile = null;
 let currentBatchId = null;
 let pollingInterval = null;
+let eventSource = null;
+let selectionId = null; // для Idempotency-Key: повторная отправка того же выбора не создаёт новый батч
 
 // DOM элементы
 const dropZone = document.getElementById('dropZone');
@@ -100,6 +102,7 @@ removeFileBtn.addEventListener('click', () => {
 // Обработка выбора файла
 function handleFileSelect(file) {
     selectedFile = file;
+    selectionId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
     fileName.textContent = file.name;
     fileSize.textContent = formatFileSize(file.size);
     fileInfo.classList.add('show');
@@ -132,7 +135,8 @@ submitBtn.addEventListener('click', async () => {
         const response = await fetch('/api/v1/ai_model/send_prompt/', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'Idempotency-Key': `${selectionId}:${aiModel.value}:${model.value}`
             },
             body: JSON.stringify({
                 ai_model: aiModel.value,
@@ -156,8 +160,8 @@ submitBtn.addEventListener('click', async () => {
         // Очищаем карточки результатов (не показываем их)
         resultsGrid.innerHTML = '';
         
-        // Начинаем polling
-        startPolling();
+        // Подписываемся на события батча (при недоступности SSE — polling)
+        startEvents();
         
     } catch (error) {
         console.error('Error:', error);
@@ -199,11 +203,52 @@ function formatPromptName(name) {
         .replace(/\b\w/g, l => l.toUpperCase());
 }
 
-// Начало polling статуса
-function startPolling() {
+// Подписка на события батча (Server-Sent Events)
+function startEvents() {
+    stopUpdates();
+    
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    
+    const batchId = currentBatchId;
+    eventSource = new EventSource(`/api/v1/ai_model/batch/${batchId}/events`);
+    
+    // Снимок состояния: при подключении, после переподключения сервера к Redis и итог батча
+    eventSource.addEventListener('batch', (e) => {
+        handleBatchStatus(JSON.parse(e.data));
+    });
+    
+    // Задача завершена: счётчики батча пересчитаны
+    eventSource.addEventListener('progress', (e) => {
+        updateProgress(JSON.parse(e.data));
+    });
+    
+    eventSource.onerror = () => {
+        // Поток закрыт после завершения батча или соединение потеряно — дальше опрашиваем
+        if (eventSource && batchId === currentBatchId) {
+            console.warn('Batch events unavailable, falling back to polling');
+            startPolling();
+        }
+    };
+}
+
+// Остановка подписки и polling
+function stopUpdates() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
     if (pollingInterval) {
         clearInterval(pollingInterval);
+        pollingInterval = null;
     }
+}
+
+// Начало polling статуса
+function startPolling() {
+    stopUpdates();
     
     // Проверяем сразу и затем каждые 3 секунды
     checkBatchStatus();
@@ -221,28 +266,32 @@ async function checkBatchStatus() {
             throw new Error('Ошибка при получении статуса');
         }
         
-        const data = await response.json();
-        updateProgress(data);
-        
-        // Если все завершено, останавливаем polling
-        if (data.status === 'completed' || data.status === 'completed_with_errors') {
-            clearInterval(pollingInterval);
-            submitBtn.disabled = false;
-            submitBtn.innerHTML = 'Получить документацию';
-            
-            // Показываем кнопку скачивания объединенного файла если он есть
-            if (data.has_merged_result && data.merged_job_id) {
-                downloadAllBtn.style.display = 'block';
-                // Сохраняем merged_job_id для функции скачивания
-                downloadAllBtn.dataset.mergedJobId = data.merged_job_id;
-            }
-        }
+        handleBatchStatus(await response.json());
         
     } catch (error) {
         console.error('Polling error:', error);
     }
 }
 
+// Обработка состояния батча (из SSE или polling)
+function handleBatchStatus(data) {
+    updateProgress(data);
+    
+    // Если все завершено, останавливаем обновления
+    if (data.status === 'completed' || data.status === 'completed_with_errors' || data.status === 'failed') {
+        stopUpdates();
+        submitBtn.disabled = false;
+        submitBtn.innerHTML = 'Получить документацию';
+        
+        // Показываем кнопку скачивания объединенного файла если он есть
+        if (data.has_merged_result && data.merged_job_id) {
+            downloadAllBtn.style.display = 'block';
+            // Сохраняем merged_job_id для функции скачивания
+            downloadAllBtn.dataset.mergedJobId = data.merged_job_id;
+        }
+    }
+}
+
 // Обновление прогресса
 function updateProgress(batchData) {
     const completed = batchData.completed_jobs || 0;
@@ -379,22 +428,13 @@ downloadAllBtn.addEventListener('click', async () => {
             document.body.removeChild(a);
             window.URL.revokeObjectURL(url);
         } else {
-            // Фолбэк: скачиваем каждый результат отдельно
-            const response = await fetch(`/api/v1/ai_model/batch/${currentBatchId}`);
-            
-            if (!response.ok) {
-                throw new Error('Ошибка при получении результатов');
-            }
-            
-            const batchData = await response.json();
-            const completedJobs = batchData.jobs.filter(job => job.status === 'finished');
-            
-            // Скачиваем каждый результат
-            for (const job of completedJobs) {
-                await downloadResult(job.job_id);
-                // Небольшая задержка между скачиваниями
-                await new Promise(resolve => setTimeout(resolve, 300));
-            }
+            // Фолбэк: все результаты батча одним архивом (markdown файл на задачу)
+            const a = document.createElement('a');
+            a.href = `/api/v1/ai_model/batch/${currentBatchId}/results?format=tar`;
+            a.download = `batch_${currentBatchId}.tar.gz`;
+            document.body.appendChild(a);
+            a.click();
+            document.body.removeChild(a);
         }
         
         downloadAllBtn.disabled = false;
@@ -3,8 +3,11 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from api.openai_endpoints import ai_model
 from api.prompt_endpoints import prompt_router
+from api.metrics_endpoints import metrics_router
 import uvicorn
-from api.core.db_con import engine, Base
+from api.core.db_con import engine, Base, apply_migrations
+from api.core.redis_con import init_redis, close_redis
+from api.broker.events import batch_event_hub
 import os
 
 app = FastAPI()
@@ -20,6 +23,8 @@ app.add_middleware(
 
 app.include_router(ai_model)
 app.include_router(prompt_router)
+# До frontend: mount("/") перехватывает все пути, зарегистрированные после него
+app.include_router(metrics_router)
 
 frontend_path = os.path.join(os.path.dirname(__file__), "frontend")
 if os.path.exists(frontend_path):
@@ -29,6 +34,14 @@ if os.path.exists(frontend_path):
 async def on_startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all не меняет существующие таблицы
+        await apply_migrations(conn)
+    init_redis()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await batch_event_hub.stop()
+    await close_redis()
         
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
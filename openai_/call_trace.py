@@ -0,0 +1,78 @@
+import contextvars
+from   datetime import datetime
+from   typing   import Callable, Optional
+
+
+class CallTrace:
+    """
+    Тайминги одного вызова провайдера, которые видит только HTTP клиент:
+    отправка первого запроса, первый байт ответа и число HTTP попыток (ретраи SDK и клиентов).
+    reserve — резерв в лимитере перед повтором (функция или корутина, возвращает зарезервированные токены),
+    reserved — сколько токенов зарезервировано за весь вызов.
+    """
+    __slots__ = ("started_at", "first_byte_at", "attempts", "reserve", "reserved")
+
+    def __init__(self, reserve: Optional[Callable] = None, reserved: int = 0):
+        self.started_at = None
+        self.first_byte_at = None
+        self.attempts = 0
+        self.reserve = reserve
+        self.reserved = reserved
+
+    @property
+    def retry_count(self) -> int:
+        return max(0, self.attempts - 1)
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("provider_call_trace", default=None)
+
+
+def start_trace(reserve: Optional[Callable] = None, reserved: int = 0) -> tuple:
+    """Начинает трассировку вызова в текущем потоке / задаче asyncio. Возвращает (trace, token для end_trace)"""
+    trace = CallTrace(reserve, reserved)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token) -> None:
+    _current_trace.reset(token)
+
+
+def reserve_retry() -> None:
+    """Ретрай клиента ждёт места в общем лимитере, как первая попытка (если вызов идёт через лимитер)"""
+    trace = _current_trace.get()
+    if trace is not None and trace.reserve is not None:
+        trace.reserved += trace.reserve()
+
+
+async def areserve_retry() -> None:
+    trace = _current_trace.get()
+    if trace is not None and trace.reserve is not None:
+        trace.reserved += await trace.reserve()
+
+
+def _on_request(request) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attempts += 1
+        if trace.started_at is None:
+            trace.started_at = datetime.utcnow()
+
+
+def _on_response(response) -> None:
+    # Хук вызывается после заголовков, до чтения тела; при ретрае — время ответа последней попытки
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.first_byte_at = datetime.utcnow()
+
+
+async def _aon_request(request) -> None:
+    _on_request(request)
+
+
+async def _aon_response(response) -> None:
+    _on_response(response)
+
+
+# event_hooks для httpx.Client и httpx.AsyncClient (в том числе внутри SDK OpenAI и Anthropic)
+EVENT_HOOKS = {"request": [_on_request], "response": [_on_response]}
+ASYNC_EVENT_HOOKS = {"request": [_aon_request], "response": [_aon_response]}
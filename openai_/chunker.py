@@ -0,0 +1,267 @@
+import ast
+import math
+import hashlib
+import logging
+from   typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+
+SEPARATOR = "---\n"
+
+
+class ExportedFile(NamedTuple):
+    """Файл из выгрузки export_repo.py: путь и текст вместе с заголовком и разделителем"""
+    path: str
+    text: str
+
+
+class ChunkUnit(NamedTuple):
+    """Неделимая часть выгрузки: файл целиком или фрагмент большого файла"""
+    index: int
+    path: str
+    text: str
+    tokens: int
+
+    @property
+    def content_hash(self) -> str:
+        return hashlib.sha256(self.text.encode('utf-8')).hexdigest()
+
+
+def _header_path(line: str) -> Optional[str]:
+    stripped = line.rstrip('\n')
+    if stripped.startswith("=== ") and stripped.endswith(" ===") and len(stripped) > 8:
+        return stripped[4:-4]
+    return None
+
+
+def parse_export(text: str) -> Optional[List[ExportedFile]]:
+    """
+    Разбирает выгрузку формата "=== path ===" ... "---".
+    Заголовком считается только строка в начале текста или сразу после "---",
+    поэтому "---" и "===" внутри файлов не ломают разбор.
+    Возвращает None, если текст не похож на выгрузку.
+    """
+    lines = text.splitlines(keepends=True)
+    if not lines or _header_path(lines[0]) is None:
+        return None
+
+    files = []
+    path, start = None, 0
+    for idx, line in enumerate(lines):
+        header = _header_path(line)
+        if header is None or (idx > 0 and lines[idx - 1] != SEPARATOR):
+            continue
+        if path is not None:
+            files.append(ExportedFile(path, "".join(lines[start:idx])))
+        path, start = header, idx
+
+    files.append(ExportedFile(path, "".join(lines[start:])))
+    return files
+
+
+def _python_parts(body: str) -> Optional[List[Tuple[Optional[str], str]]]:
+    """
+    Делит код модуля по верхнеуровневым определениям (None, если код не парсится).
+    Возвращает (имя определения или None для кода до первого определения, текст)
+    """
+    try:
+        tree = ast.parse(body)
+    except (SyntaxError, ValueError):
+        return None
+
+    lines = body.splitlines(keepends=True)
+    names = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            first = min([node.lineno] + [d.lineno for d in node.decorator_list])
+            names[first - 1] = node.name
+    # Всё до первого определения (импорты, константы) идёт одной частью
+    starts = sorted(set([0]) | set(names))
+
+    return [
+        (names.get(start), "".join(lines[start:end]))
+        for start, end in zip(starts, starts[1:] + [len(lines)])
+        if start < end
+    ]
+
+
+def _line_parts(body: str, chunk_size: int, estimate: Callable[[str], int]) -> List[str]:
+    """Делит текст по строкам на части не больше chunk_size"""
+    parts, current, current_size = [], [], 0
+    for line in body.splitlines(keepends=True):
+        line_tokens = estimate(line)
+        if current and current_size + line_tokens > chunk_size:
+            parts.append("".join(current))
+            current, current_size = [], 0
+        current.append(line)
+        current_size += line_tokens
+    if current:
+        parts.append("".join(current))
+    return parts
+
+
+def _split_file(
+    file: ExportedFile,
+    chunk_size: int,
+    estimate: Callable[[str], int],
+    fallback_split: Callable[[str, int], List[str]]
+) -> List[str]:
+    """Слишком большой файл: по определениям Python, затем по строкам, в крайнем случае — сплиттером клиента"""
+    lines = file.text.splitlines(keepends=True)
+    body = "".join(lines[1:-1] if lines[-1] == SEPARATOR else lines[1:])
+
+    pieces = _python_parts(body) if file.path.endswith(".py") else None
+    if pieces is None:
+        pieces = [(None, body)]
+
+    parts = []
+    for name, piece in pieces:
+        if estimate(piece) <= chunk_size:
+            parts.append((name, piece))
+            continue
+        sub_parts = []
+        for line_part in _line_parts(piece, chunk_size, estimate):
+            if estimate(line_part) <= chunk_size:
+                sub_parts.append(line_part)
+            else:
+                # Одна строка больше чанка (минифицированный код и т.п.)
+                sub_parts.extend(fallback_split(line_part, chunk_size))
+        parts.extend(
+            (f"{name}, часть {idx}" if name else None, sub_part)
+            for idx, sub_part in enumerate(sub_parts, 1)
+        )
+
+    # Каждая часть — самостоятельный фрагмент с путём файла. Метка фрагмента — имя определения
+    # или хеш текста, без номера среди всех частей файла: правка одного определения не меняет
+    # текст (и хеш) остальных фрагментов, и инкрементальный режим отправляет только изменённый
+    return [
+        f"=== {file.path} ({name or _fragment_id(part)}) ===\n{part}"
+        + ("" if part.endswith("\n") else "\n") + SEPARATOR
+        for name, part in parts
+    ]
+
+
+def _fragment_id(text: str) -> str:
+    return "#" + hashlib.sha256(text.encode('utf-8')).hexdigest()[:8]
+
+
+def pack_units(units: List[ChunkUnit], chunk_size: int) -> List[List[ChunkUnit]]:
+    """First-fit decreasing: крупные части раскладываются первыми, мелкие заполняют остатки"""
+    bins, free = [], []
+    for unit in sorted(units, key=lambda u: u.tokens, reverse=True):
+        for idx, space in enumerate(free):
+            if unit.tokens <= space:
+                bins[idx].append(unit)
+                free[idx] -= unit.tokens
+                break
+        else:
+            bins.append([unit])
+            free.append(chunk_size - unit.tokens)
+    return bins
+
+
+def _export_units(
+    files: List[ExportedFile],
+    chunk_size: int,
+    estimate: Callable[[str], int],
+    fallback_split: Callable[[str, int], List[str]]
+) -> List[ChunkUnit]:
+    units = []
+    for file in files:
+        tokens = estimate(file.text)
+        if tokens <= chunk_size:
+            units.append(ChunkUnit(len(units), file.path, file.text, tokens))
+            continue
+        for part in _split_file(file, chunk_size, estimate, fallback_split):
+            units.append(ChunkUnit(len(units), file.path, part, min(estimate(part), chunk_size)))
+    return units
+
+
+def _keep_previous_chunks(units: List[ChunkUnit], chunk_size: int, previous_layout: Dict[str, int]) -> List[List[ChunkUnit]]:
+    """
+    Чанки прошлого батча, все части которых не изменились: их текст совпадёт с прошлым,
+    поэтому результаты по ним берутся из кеша.
+    """
+    previous_chunks = {}
+    for content_hash, chunk_index in previous_layout.items():
+        previous_chunks.setdefault(chunk_index, set()).add(content_hash)
+
+    by_hash = {unit.content_hash: unit for unit in units}
+    kept, used = [], set()
+    for chunk_index in sorted(previous_chunks):
+        hashes = previous_chunks[chunk_index]
+        if not hashes <= by_hash.keys() or hashes & used:
+            continue
+        chunk = [by_hash[content_hash] for content_hash in hashes]
+        if sum(unit.tokens for unit in chunk) > chunk_size:
+            continue
+        kept.append(chunk)
+        used |= hashes
+    return kept
+
+
+def layout_export(
+    text: str,
+    chunk_size: int,
+    estimate: Callable[[str], int],
+    fallback_split: Callable[[str, int], List[str]],
+    previous_layout: Optional[Dict[str, int]] = None
+) -> Optional[Tuple[List[str], List[Tuple[str, str, int]]]]:
+    """
+    Нарезает выгрузку репозитория на чанки по границам файлов (большие .py — по определениям).
+    Части упаковываются в минимум чанков по chunk_size токенов.
+    previous_layout ({хеш части: номер чанка} прошлого батча) — неизменённые чанки сохраняются как были,
+    в новые чанки упаковываются только изменённые и новые файлы.
+    Возвращает (чанки, раскладка [(путь, хеш части, номер чанка)]) или None, если текст не в формате выгрузки.
+    """
+    files = parse_export(text)
+    if files is None:
+        return None
+
+    units = _export_units(files, chunk_size, estimate, fallback_split)
+
+    kept = _keep_previous_chunks(units, chunk_size, previous_layout) if previous_layout else []
+    kept_hashes = {unit.content_hash for chunk in kept for unit in chunk}
+    bins = kept + pack_units([unit for unit in units if unit.content_hash not in kept_hashes], chunk_size)
+
+    # Внутри чанка и между чанками сохраняем исходный порядок файлов
+    for chunk in bins:
+        chunk.sort(key=lambda u: u.index)
+    bins.sort(key=lambda chunk: chunk[0].index)
+
+    chunks = ["".join(unit.text for unit in chunk) for chunk in bins]
+    layout = [
+        (unit.path, unit.content_hash, chunk_index)
+        for chunk_index, chunk in enumerate(bins)
+        for unit in chunk
+    ]
+
+    if previous_layout is not None:
+        changed_paths = {unit.path for unit in units if unit.content_hash not in previous_layout}
+        logging.info(
+            f"Incremental split: {len(changed_paths)} of {len(files)} files changed, "
+            f"{len(kept)} of {len(chunks)} chunks unchanged"
+        )
+    logging.info(f"Split export of {len(files)} files into {len(chunks)} chunks")
+    return chunks, layout
+
+
+def split_export_into_chunks(
+    text: str,
+    chunk_size: int,
+    estimate: Callable[[str], int],
+    fallback_split: Callable[[str, int], List[str]]
+) -> List[str]:
+    """Чанки выгрузки репозитория (см. layout_export); текст не в формате выгрузки режется fallback_split"""
+    result = layout_export(text, chunk_size, estimate, fallback_split)
+    if result is None:
+        return fallback_split(text, chunk_size)
+    return result[0]
+
+
+def ratio_estimator(text: str, total_tokens: int) -> Callable[[str], int]:
+    """
+    Оценка токенов части текста по средней плотности всего текста.
+    Токены всего текста уже известны, поэтому части не приходится токенизировать заново.
+    """
+    ratio = total_tokens / max(1, len(text))
+    return lambda part: math.ceil(len(part) * ratio)
@@ -1,9 +1,11 @@
-import requests
+import httpx
 import json
 import logging
 import tiktoken
 from   typing   import Dict, List, Optional
 
+from .call_trace import EVENT_HOOKS, ASYNC_EVENT_HOOKS
+
 
 class DeepSeekClient:
     """
@@ -14,25 +16,71 @@ class DeepSeekClient:
         api_key: str, 
         model_name: str = "deepseek-chat",
         system_prompt: str = "",
-        mathematical_percent: int = 20
+        mathematical_percent: int = 20,
+        http_client: httpx.Client | None = None,
+        async_http_client: httpx.AsyncClient | None = None,
+        api_url: str = "https://api.deepseek.com/v1/chat/completions"
     ):
         self.api_key = api_key
         self.model_name = model_name
         self.system_prompt = system_prompt
         self.math_p = mathematical_percent
         
-        self.api_url = "https://api.deepseek.com/v1/chat/completions"
+        self.api_url = api_url
         
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
         
+        # Постоянный клиент с пулом keep-alive соединений; можно передать общий
+        self.http_client = http_client or self.create_http_client()
+        self._async_http_client = async_http_client
+        
         self.tokenizer = tiktoken.get_encoding('cl100k_base')
         
         self.token = self.get_model_token_limit(self.model_name)
         self.max_tokens = self.token - int((self.token / 100) * self.math_p)
     
+    @staticmethod
+    def create_http_client() -> httpx.Client:
+        return httpx.Client(
+            timeout=300,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            event_hooks=EVENT_HOOKS,
+        )
+
+    @staticmethod
+    def create_async_http_client() -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=300,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+            event_hooks=ASYNC_EVENT_HOOKS,
+        )
+
+    @property
+    def async_http_client(self) -> httpx.AsyncClient:
+        """Асинхронный клиент для async воркера, создаётся при первом обращении"""
+        if self._async_http_client is None:
+            self._async_http_client = self.create_async_http_client()
+        return self._async_http_client
+
+    def _build_messages(self, user_input: str, system_prompt: Optional[str], prompt_caching: bool = False) -> List[Dict]:
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+        if prompt_caching and system_prompt:
+            # Общий код первым (system): DeepSeek кеширует совпадающий префикс на диске сам.
+            # Инструкция промпта — следующим сообщением user, чтобы порядок ролей оставался обычным
+            return [
+                {"role": "system", "content": user_input},
+                {"role": "user", "content": system_prompt}
+            ]
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": user_input})
+        return messages
+    
     def get_model_token_limit(self, model_name: str) -> int:
         """Возвращает лимит токенов для модели DeepSeek"""
         model_token_limits = {
@@ -41,6 +89,10 @@ class DeepSeekClient:
         }
         return model_token_limits.get(model_name, 32000)
     
+    def count_tokens(self, text: str) -> int:
+        """Количество токенов в тексте"""
+        return len(self.tokenize_text(text))
+
     def tokenize_text(self, text: str) -> List[int]:
         """Токенизирует текст"""
         tokens = self.tokenizer.encode(text)
@@ -67,65 +119,105 @@ class DeepSeekClient:
         result = self.send_message_with_usage(user_input)
         return result["text"]
 
-    def send_message_with_usage(self, user_input: str, temperature: float = 0.7) -> Dict:
-        """
-        Отправляет сообщение и возвращает ответ с usage статистикой.
-        Возвращает: {'text': str, 'usage': dict}
-        """
-        messages = []
-        if self.system_prompt:
-            messages.append({"role": "system", "content": self.system_prompt})
-        messages.append({"role": "user", "content": user_input})
-        
-        payload = {
+    def _build_payload(
+        self,
+        user_input: str,
+        temperature: float,
+        system_prompt: Optional[str],
+        prompt_caching: bool = False
+    ) -> Dict:
+        return {
             "model": self.model_name,
-            "messages": messages,
+            "messages": self._build_messages(user_input, system_prompt, prompt_caching),
             "temperature": temperature,
             "stream": False
         }
+
+    @staticmethod
+    def _parse_response(response: httpx.Response) -> Dict:
+        if response.status_code != 200:
+            raise Exception(f"DeepSeek API error: {response.status_code} - {response.text}")
+        
+        result = response.json()
+        
+        text = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+        
+        usage = result.get("usage", {})
+        
+        return {
+            "text": text,
+            "usage": {
+                "prompt_tokens": usage.get("prompt_tokens", 0),
+                "completion_tokens": usage.get("completion_tokens", 0),
+                "total_tokens": usage.get("total_tokens", 0),
+                "cached_tokens": usage.get("prompt_cache_hit_tokens", 0)
+            }
+        }
+
+    def send_message_with_usage(
+        self,
+        user_input: str,
+        temperature: float = 0.7,
+        system_prompt: Optional[str] = None,
+        prompt_caching: bool = False
+    ) -> Dict:
+        """
+        Отправляет сообщение и возвращает ответ с usage статистикой.
+        Возвращает: {'text': str, 'usage': dict}
+        """
+        payload = self._build_payload(user_input, temperature, system_prompt, prompt_caching)
         
         try:
-            response = requests.post(
+            response = self.http_client.post(
                 self.api_url, 
                 headers=self.headers, 
-                json=payload,
-                timeout=300
+                json=payload
             )
+            return self._parse_response(response)
             
-            if response.status_code != 200:
-                raise Exception(f"DeepSeek API error: {response.status_code} - {response.text}")
-            
-            result = response.json()
-            
-            text = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-            
-            usage = result.get("usage", {})
-            
-            return {
-                "text": text,
-                "usage": {
-                    "prompt_tokens": usage.get("prompt_tokens", 0),
-                    "completion_tokens": usage.get("completion_tokens", 0),
-                    "total_tokens": usage.get("total_tokens", 0)
-                }
-            }
+        except httpx.TimeoutException:
+            raise Exception("DeepSeek API timeout - запрос слишком долгий")
+        except httpx.HTTPError as e:
+            raise Exception(f"DeepSeek API connection error: {str(e)}")
+        except Exception as e:
+            raise Exception(f"DeepSeek API error: {str(e)}")
+
+    async def asend_message_with_usage(
+        self,
+        user_input: str,
+        temperature: float = 0.7,
+        system_prompt: Optional[str] = None,
+        prompt_caching: bool = False
+    ) -> Dict:
+        """Асинхронный вариант send_message_with_usage"""
+        payload = self._build_payload(user_input, temperature, system_prompt, prompt_caching)
+        
+        try:
+            response = await self.async_http_client.post(
+                self.api_url,
+                headers=self.headers,
+                json=payload
+            )
+            return self._parse_response(response)
             
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             raise Exception("DeepSeek API timeout - запрос слишком долгий")
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             raise Exception(f"DeepSeek API connection error: {str(e)}")
         except Exception as e:
             raise Exception(f"DeepSeek API error: {str(e)}")
     
-    def send_message_streaming(self, user_input: str, temperature: float = 0.7) -> List[str]:
+    def send_message_streaming(
+        self,
+        user_input: str,
+        temperature: float = 0.7,
+        system_prompt: Optional[str] = None
+    ) -> List[str]:
         """
         Отправляет сообщение со streaming и возвращает список чанков.
         Используется если нужен потоковый вывод.
         """
-        messages = []
-        if self.system_prompt:
-            messages.append({"role": "system", "content": self.system_prompt})
-        messages.append({"role": "user", "content": user_input})
+        messages = self._build_messages(user_input, system_prompt)
         
         payload = {
             "model": self.model_name,
@@ -135,69 +227,69 @@ class DeepSeekClient:
         }
         
         try:
-            response = requests.post(
+            with self.http_client.stream(
+                "POST",
                 self.api_url,
                 headers=self.headers,
-                json=payload,
-                stream=True,
-                timeout=300
-            )
+                json=payload
+            ) as response:
+                if response.status_code != 200:
+                    response.read()
+                    raise Exception(f"DeepSeek API error: {response.status_code} - {response.text}")
+                
+                chunks = []
+                buffer = ""
             
-            if response.status_code != 200:
-                raise Exception(f"DeepSeek API error: {response.status_code} - {response.text}")
-            
-            chunks = []
-            buffer = ""
-            
-            for line in response.iter_lines():
-                if line:
-                    decoded_line = line.decode('utf-8')
-                    
-                    if decoded_line.startswith("data: "):
-                        content = decoded_line[6:].strip()
+                for decoded_line in response.iter_lines():
+                    if decoded_line:
+                        if decoded_line.startswith("data: "):
+                            content = decoded_line[6:].strip()
                         
-                        if content == "[DONE]":
-                            break
+                            if content == "[DONE]":
+                                break
                         
-                        try:
-                            json_data = json.loads(content)
-                            delta = json_data.get("choices", [{}])[0].get("delta", {})
-                            text = delta.get("content", "")
+                            try:
+                                json_data = json.loads(content)
+                                delta = json_data.get("choices", [{}])[0].get("delta", {})
+                                text = delta.get("content", "")
                             
-                            if text:
-                                buffer += text
+                                if text:
+                                    buffer += text
                                 
-                                if len(buffer) > 1000:
-                                    chunks.append(buffer)
-                                    buffer = ""
+                                    if len(buffer) > 1000:
+                                        chunks.append(buffer)
+                                        buffer = ""
                                     
-                        except json.JSONDecodeError as e:
-                            logging.error(f"Error parsing stream chunk: {e}")
-                            continue
+                            except json.JSONDecodeError as e:
+                                logging.error(f"Error parsing stream chunk: {e}")
+                                continue
             
             if buffer:
                 chunks.append(buffer)
             
             return chunks
             
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             raise Exception("DeepSeek API timeout")
         except Exception as e:
             raise Exception(f"DeepSeek streaming error: {str(e)}")
     
-    def send_full_request_with_usage(self, user_message: str) -> Dict:
+    def send_full_request_with_usage(self, user_message: str, system_prompt: Optional[str] = None) -> Dict:
         """
         Отправляет полный запрос с проверкой размера.
         Аналог метода из ChatGPT клиента для единообразия API.
         """
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+        
         total_tokens = len(self.tokenize_text(user_message))
-        if self.system_prompt:
-            total_tokens += len(self.tokenize_text(self.system_prompt))
+        if system_prompt:
+            total_tokens += len(self.tokenize_text(system_prompt))
         
         if total_tokens > self.max_tokens:
             raise ValueError(f"Запрос слишком большой: {total_tokens} токенов, максимум {self.max_tokens}")
         
-        return self.send_message_with_usage(user_message)
+        return self.send_message_with_usage(user_message, system_prompt=system_prompt)
     
     def calculate_cost(self, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
         """
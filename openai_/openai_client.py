@@ -4,7 +4,7 @@ from   langchain.schema import HumanMessage, SystemMessage
 from   langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from   pydantic         import SecretStr
 from   typing           import List, Optional
-from   openai           import OpenAI
+from   openai           import OpenAI, AsyncOpenAI
 
 
 class ChatGPTClient(object):
@@ -15,19 +15,18 @@ class ChatGPTClient(object):
             embeddings_model_name: str = 'text-embedding-3-small',
             system_prompt: str | None = None,
             mathematical_percent: Optional[int] = 20,
+            openai_client: OpenAI | None = None,
+            async_openai_client: AsyncOpenAI | None = None,
     ):
         self._api_key = api_key
         self.model_name = model_name
         self.math_p = mathematical_percent
         self.embeddings_model_name = embeddings_model_name
-        self.chat_model = ChatOpenAI(
-            openai_api_key=self._api_key,
-            model_name=self.model_name,
-        )
-        self.embeddings_model = OpenAIEmbeddings(
-            openai_api_key=self._api_key,
-            model=self.embeddings_model_name,
-        )
+        # Один HTTP клиент (с keep-alive) на весь срок жизни объекта; можно передать общий
+        self.client = openai_client or OpenAI(api_key=self._api_key)
+        self._async_client = async_openai_client
+        self._chat_model = None
+        self._embeddings_model = None
         self.chat_history = []
 
         self.tokenizer = tiktoken.get_encoding('cl100k_base')
@@ -43,6 +42,32 @@ class ChatGPTClient(object):
         self.max_tokens = self.token - int((self.token / 100) * self.math_p)
         self.embeddings_max_tokens = self.get_model_token_limit(self.embeddings_model_name)
 
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """Асинхронный клиент для async воркера, создаётся при первом обращении"""
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self._api_key)
+        return self._async_client
+
+    @property
+    def chat_model(self) -> ChatOpenAI:
+        """LangChain модель нужна только для диалога с историей, создаётся при первом обращении"""
+        if self._chat_model is None:
+            self._chat_model = ChatOpenAI(
+                openai_api_key=self._api_key,
+                model_name=self.model_name,
+            )
+        return self._chat_model
+
+    @property
+    def embeddings_model(self) -> OpenAIEmbeddings:
+        if self._embeddings_model is None:
+            self._embeddings_model = OpenAIEmbeddings(
+                openai_api_key=self._api_key,
+                model=self.embeddings_model_name,
+            )
+        return self._embeddings_model
+
     def get_model_token_limit(self, model_name: str) -> int:
         """Возвращает лимит токенов для модели"""
         model_token_limits = {
@@ -57,6 +82,10 @@ class ChatGPTClient(object):
         }
         return model_token_limits.get(model_name, 4096)
 
+    def count_tokens(self, text: str) -> int:
+        """Количество токенов в тексте"""
+        return len(self.tokenize_text(text))
+
     def tokenize_text(self, text: str, tokenizer=None) -> List[int]:
         if tokenizer is None:
             tokenizer = self.tokenizer
@@ -106,62 +135,85 @@ class ChatGPTClient(object):
 
         self.chat_history = trimmed_history
 
-    def send_message_with_usage(self, message: str) -> dict:
-        """
-        Отправляет ONE-SHOT запрос без истории.
-        Используется для обработки отдельных чанков.
-        """
-        client = OpenAI(api_key=self._api_key)
+    def _build_messages(self, message: str, system_prompt: str | None, prompt_caching: bool = False) -> list:
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+
+        if prompt_caching and system_prompt:
+            # Общий для всех промптов код — первым (system), OpenAI кеширует совпадающий префикс сам.
+            # Инструкция промпта — следующим сообщением user: system после user часть бэкендов не принимает
+            return [
+                {"role": "system", "content": message},
+                {"role": "user", "content": system_prompt}
+            ]
 
         messages = []
-        if self.system_prompt:
-            messages.append({"role": "system", "content": self.system_prompt})
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": message})
+        return messages
 
-        response = client.chat.completions.create(
-            model=self.model_name,
-            messages=messages,
-        )
-
+    @staticmethod
+    def _parse_response(response) -> dict:
+        details = getattr(response.usage, "prompt_tokens_details", None)
         return {
             "text": response.choices[0].message.content,
             "usage": {
                 "prompt_tokens": response.usage.prompt_tokens,
                 "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens
+                "total_tokens": response.usage.total_tokens,
+                "cached_tokens": (getattr(details, "cached_tokens", None) or 0) if details else 0
             }
         }
+
+    def send_message_with_usage(
+            self,
+            message: str,
+            system_prompt: str | None = None,
+            prompt_caching: bool = False
+    ) -> dict:
+        """
+        Отправляет ONE-SHOT запрос без истории.
+        Используется для обработки отдельных чанков.
+        system_prompt передаётся на каждый вызов (по умолчанию — из конструктора).
+        prompt_caching — сообщение отправляется перед промптом, как кешируемый префикс.
+        """
+        response = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=self._build_messages(message, system_prompt, prompt_caching),
+        )
+        return self._parse_response(response)
+
+    async def asend_message_with_usage(
+            self,
+            message: str,
+            system_prompt: str | None = None,
+            prompt_caching: bool = False
+    ) -> dict:
+        """Асинхронный вариант send_message_with_usage"""
+        response = await self.async_client.chat.completions.create(
+            model=self.model_name,
+            messages=self._build_messages(message, system_prompt, prompt_caching),
+        )
+        return self._parse_response(response)
     
-    def send_full_request_with_usage(self, user_message: str) -> dict:
+    def send_full_request_with_usage(self, user_message: str, system_prompt: str | None = None) -> dict:
         """
         НОВЫЙ МЕТОД: Отправляет весь запрос целиком с автоматическим разбиением на чанки.
         Для документирования кода - лучше отправлять весь код целиком, если помещается.
         """
-        client = OpenAI(api_key=self._api_key)
-        
-        messages = []
-        if self.system_prompt:
-            messages.append({"role": "system", "content": self.system_prompt})
-        messages.append({"role": "user", "content": user_message})
+        messages = self._build_messages(user_message, system_prompt)
         
         total_tokens = sum(len(self.tokenize_text(msg.get("content", ""))) for msg in messages)
         
         if total_tokens > self.max_tokens:
             raise ValueError(f"Запрос слишком большой: {total_tokens} токенов, максимум {self.max_tokens}")
         
-        response = client.chat.completions.create(
+        response = self.client.chat.completions.create(
             model=self.model_name,
             messages=messages,
         )
-
-        return {
-            "text": response.choices[0].message.content,
-            "usage": {
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens,
-                "total_tokens": response.usage.total_tokens
-            }
-        }
+        return self._parse_response(response)
     
     def calculate_cost(self, prompt_tokens, completion_tokens):
         """Рассчитывает стоимость запроса"""
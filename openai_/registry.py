@@ -0,0 +1,106 @@
+import threading
+import anthropic
+import openai
+from   anthropic import Anthropic, AsyncAnthropic
+from   openai    import OpenAI, AsyncOpenAI
+
+from .openai_client   import ChatGPTClient
+from .deepseek_client import DeepSeekClient
+from .sonnet_client   import SonnetClient
+from .call_trace      import EVENT_HOOKS, ASYNC_EVENT_HOOKS
+from api.core.security import OPENAI_BASE_URL, ANTHROPIC_BASE_URL, DEEPSEEK_API_URL
+
+
+class ClientRegistry:
+    """
+    Кеш клиентов провайдеров на процесс воркера.
+    - одна пара HTTP клиентов (sync и async, с keep-alive) на (провайдер, API ключ);
+    - один объект клиента на (провайдер, модель, API ключ), системный промпт передаётся на каждый вызов.
+    """
+    def __init__(self, mathematical_percent: int = 10):
+        self.math_p = mathematical_percent
+        self._transports = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, ai_model: str, model_name: str, api_key: str):
+        key = (ai_model, model_name, api_key)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._build_client(ai_model, model_name, api_key)
+                self._clients[key] = client
+        return client
+
+    def _get_transports(self, ai_model: str, api_key: str) -> tuple:
+        key = (ai_model, api_key)
+        transports = self._transports.get(key)
+        if transports is None:
+            if ai_model == "chatgpt":
+                # HTTP клиенты SDK с настройками по умолчанию и хуками трассировки вызовов
+                transports = (
+                    OpenAI(
+                        api_key=api_key, base_url=OPENAI_BASE_URL,
+                        http_client=openai.DefaultHttpxClient(event_hooks=EVENT_HOOKS)
+                    ),
+                    AsyncOpenAI(
+                        api_key=api_key, base_url=OPENAI_BASE_URL,
+                        http_client=openai.DefaultAsyncHttpxClient(event_hooks=ASYNC_EVENT_HOOKS)
+                    )
+                )
+            elif ai_model == "deepseek":
+                transports = (DeepSeekClient.create_http_client(), DeepSeekClient.create_async_http_client())
+            elif ai_model == "sonnet":
+                # Ретраями управляет SonnetClient (через общий лимитер), у SDK они выключены
+                transports = (
+                    Anthropic(
+                        api_key=api_key, base_url=ANTHROPIC_BASE_URL, max_retries=0,
+                        http_client=anthropic.DefaultHttpxClient(event_hooks=EVENT_HOOKS)
+                    ),
+                    AsyncAnthropic(
+                        api_key=api_key, base_url=ANTHROPIC_BASE_URL, max_retries=0,
+                        http_client=anthropic.DefaultAsyncHttpxClient(event_hooks=ASYNC_EVENT_HOOKS)
+                    )
+                )
+            else:
+                raise ValueError(f"Нет такой AI модели: {ai_model}")
+            self._transports[key] = transports
+        return transports
+
+    def _build_client(self, ai_model: str, model_name: str, api_key: str):
+        sync_transport, async_transport = self._get_transports(ai_model, api_key)
+
+        if ai_model == "chatgpt":
+            return ChatGPTClient(
+                api_key=api_key,
+                model_name=model_name,
+                embeddings_model_name="text-embedding-3-small",
+                mathematical_percent=self.math_p,
+                openai_client=sync_transport,
+                async_openai_client=async_transport
+            )
+        if ai_model == "deepseek":
+            return DeepSeekClient(
+                api_key=api_key,
+                model_name=model_name,
+                mathematical_percent=self.math_p,
+                http_client=sync_transport,
+                async_http_client=async_transport,
+                api_url=DEEPSEEK_API_URL
+            )
+        if ai_model == "sonnet":
+            return SonnetClient(
+                api_key=api_key,
+                model_name=model_name,
+                mathematical_percent=self.math_p,
+                anthropic_client=sync_transport,
+                async_anthropic_client=async_transport
+            )
+        raise ValueError(f"Нет такой AI модели: {ai_model}")
+
+
+client_registry = ClientRegistry()
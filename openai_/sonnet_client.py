@@ -1,8 +1,12 @@
 import time
+import asyncio
 import logging
 import anthropic
-from   anthropic import Anthropic
-from   typing    import List, Optional, Dict
+from   anthropic          import Anthropic, AsyncAnthropic
+from   concurrent.futures import ThreadPoolExecutor
+from   typing             import List, Optional, Dict
+
+from   .call_trace        import reserve_retry, areserve_retry
 
 
 class SonnetClient:
@@ -14,8 +18,13 @@ class SonnetClient:
         mathematical_percent: int = 20,
         max_retries: int = 3,
         retry_delay: float = 1.0,
+        anthropic_client: Optional[Anthropic] = None,
+        async_anthropic_client: Optional[AsyncAnthropic] = None,
     ):
-        self.client = Anthropic(api_key=api_key)
+        # Один HTTP клиент (с keep-alive) на весь срок жизни объекта; можно передать общий
+        self.client = anthropic_client or Anthropic(api_key=api_key)
+        self._api_key = api_key
+        self._async_client = async_anthropic_client
         self.model_name = model_name
         self.system_prompt = system_prompt
         self.math_p = mathematical_percent
@@ -83,60 +92,111 @@ class SonnetClient:
         logging.info(f'Split text into {len(chunks)} chunks for Claude.')
         return chunks
 
-    def _send_with_retry(self, messages: List[Dict], include_system: bool = True) -> anthropic.types.Message:
-        """Отправляет запрос с retry логикой"""
+    @property
+    def async_client(self) -> AsyncAnthropic:
+        """Асинхронный клиент для async воркера, создаётся при первом обращении"""
+        if self._async_client is None:
+            self._async_client = AsyncAnthropic(api_key=self._api_key)
+        return self._async_client
+
+    def _build_api_kwargs(
+        self,
+        messages: List[Dict],
+        include_system: bool,
+        system_prompt: Optional[str]
+    ) -> Dict:
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+
         api_kwargs = {
             "model": self.model_name,
             "max_tokens": self.max_tokens_response,
             "messages": messages
         }
         
-        if include_system and self.system_prompt:
-            api_kwargs["system"] = self.system_prompt
+        if include_system and system_prompt:
+            api_kwargs["system"] = system_prompt
+        return api_kwargs
+
+    def _retry_wait_time(self, attempt: int, error: Exception) -> float:
+        """Сколько ждать перед следующей попыткой; если попытки кончились — пробрасывает ошибку"""
+        if isinstance(error, anthropic.RateLimitError):
+            if attempt < self.max_retries - 1:
+                wait_time = self.retry_delay * (2 ** attempt)
+                logging.warning(f"Rate limit hit, waiting {wait_time}s before retry {attempt + 1}/{self.max_retries}")
+                return wait_time
+            raise Exception(f"Claude API rate limit exceeded after {self.max_retries} retries: {str(error)}")
+        if isinstance(error, anthropic.APIError):
+            if attempt < self.max_retries - 1:
+                wait_time = self.retry_delay * (2 ** attempt)
+                logging.warning(f"API error, retrying in {wait_time}s: {str(error)}")
+                return wait_time
+            raise Exception(f"Claude API error after {self.max_retries} retries: {str(error)}")
+        raise Exception(f"Claude API unexpected error: {str(error)}")
+
+    def _send_with_retry(
+        self,
+        messages: List[Dict],
+        include_system: bool = True,
+        system_prompt: Optional[str] = None
+    ) -> anthropic.types.Message:
+        """Отправляет запрос с retry логикой; повтор после 429 или перегрузки проходит через общий лимитер"""
+        api_kwargs = self._build_api_kwargs(messages, include_system, system_prompt)
 
         for attempt in range(self.max_retries):
+            if attempt:
+                reserve_retry()
             try:
                 response = self.client.messages.create(**api_kwargs)
                 return response
-            except anthropic.RateLimitError as e:
-                if attempt < self.max_retries - 1:
-                    wait_time = self.retry_delay * (2 ** attempt)
-                    logging.warning(f"Rate limit hit, waiting {wait_time}s before retry {attempt + 1}/{self.max_retries}")
-                    time.sleep(wait_time)
-                else:
-                    raise Exception(f"Claude API rate limit exceeded after {self.max_retries} retries: {str(e)}")
-            except anthropic.APIError as e:
-                if attempt < self.max_retries - 1:
-                    wait_time = self.retry_delay * (2 ** attempt)
-                    logging.warning(f"API error, retrying in {wait_time}s: {str(e)}")
-                    time.sleep(wait_time)
-                else:
-                    raise Exception(f"Claude API error after {self.max_retries} retries: {str(e)}")
             except Exception as e:
-                raise Exception(f"Claude API unexpected error: {str(e)}")
+                time.sleep(self._retry_wait_time(attempt, e))
 
-    def send_message(self, user_text: str) -> str:
-        """Отправляет сообщение и возвращает текст ответа"""
-        result = self.send_message_with_usage(user_text)
-        return result["text"]
+    async def _asend_with_retry(
+        self,
+        messages: List[Dict],
+        include_system: bool = True,
+        system_prompt: Optional[str] = None
+    ) -> anthropic.types.Message:
+        """Асинхронный вариант _send_with_retry"""
+        api_kwargs = self._build_api_kwargs(messages, include_system, system_prompt)
 
-    def send_message_with_usage(self, user_text: str) -> Dict:
-        """
-        Отправляет одно сообщение (без разбиения) и возвращает ответ с usage.
-        Возвращает: {'text': str, 'usage': dict}
-        """
-        messages = [{"role": "user", "content": user_text}]
-        
-        response = self._send_with_retry(messages, include_system=True)
-        
+        for attempt in range(self.max_retries):
+            if attempt:
+                await areserve_retry()
+            try:
+                return await self.async_client.messages.create(**api_kwargs)
+            except Exception as e:
+                await asyncio.sleep(self._retry_wait_time(attempt, e))
+
+    @staticmethod
+    def _build_messages(user_text: str, system_prompt: Optional[str], prompt_caching: bool) -> List[Dict]:
+        if not prompt_caching:
+            return [{"role": "user", "content": user_text}]
+
+        # Общий код — первый блок с cache_control, промпт идёт после него.
+        # Префикс одинаков для всех промптов батча, поэтому читается из кеша
+        content = [{"type": "text", "text": user_text, "cache_control": {"type": "ephemeral"}}]
+        if system_prompt:
+            content.append({"type": "text", "text": system_prompt})
+        return [{"role": "user", "content": content}]
+
+    @staticmethod
+    def _parse_response(response: anthropic.types.Message) -> Dict:
         text = ""
         if response.content:
             text = response.content[0].text.strip()
         
+        # input_tokens у Anthropic не включает токены, записанные в кеш и прочитанные из него
+        cache_write = getattr(response.usage, "cache_creation_input_tokens", None) or 0
+        cache_read = getattr(response.usage, "cache_read_input_tokens", None) or 0
+        prompt_tokens = (response.usage.input_tokens or 0) + cache_write + cache_read
+        
         usage = {
-            "prompt_tokens": response.usage.input_tokens or 0,
+            "prompt_tokens": prompt_tokens,
             "completion_tokens": response.usage.output_tokens or 0,
-            "total_tokens": (response.usage.input_tokens or 0) + (response.usage.output_tokens or 0)
+            "total_tokens": prompt_tokens + (response.usage.output_tokens or 0),
+            "cached_tokens": cache_read
         }
         
         return {
@@ -144,41 +204,95 @@ class SonnetClient:
             "usage": usage
         }
 
-    def send_full_request_with_usage(self, user_message: str) -> Dict:
+    def send_message(self, user_text: str) -> str:
+        """Отправляет сообщение и возвращает текст ответа"""
+        result = self.send_message_with_usage(user_text)
+        return result["text"]
+
+    def send_message_with_usage(
+        self,
+        user_text: str,
+        system_prompt: Optional[str] = None,
+        prompt_caching: bool = False
+    ) -> Dict:
+        """
+        Отправляет одно сообщение (без разбиения) и возвращает ответ с usage.
+        prompt_caching — текст идёт кешируемым префиксом, промпт после него (не в system).
+        Возвращает: {'text': str, 'usage': dict}
+        """
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+        messages = self._build_messages(user_text, system_prompt, prompt_caching)
+        
+        response = self._send_with_retry(messages, include_system=not prompt_caching, system_prompt=system_prompt)
+        return self._parse_response(response)
+
+    async def asend_message_with_usage(
+        self,
+        user_text: str,
+        system_prompt: Optional[str] = None,
+        prompt_caching: bool = False
+    ) -> Dict:
+        """Асинхронный вариант send_message_with_usage"""
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+        messages = self._build_messages(user_text, system_prompt, prompt_caching)
+        
+        response = await self._asend_with_retry(messages, include_system=not prompt_caching, system_prompt=system_prompt)
+        return self._parse_response(response)
+
+    def send_full_request_with_usage(self, user_message: str, system_prompt: Optional[str] = None) -> Dict:
         """
         Отправляет полный запрос с проверкой размера.
         Для единообразия API с другими клиентами.
         """
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+
         total_tokens = self.count_tokens(user_message)
-        if self.system_prompt:
-            total_tokens += self.count_tokens(self.system_prompt)
+        if system_prompt:
+            total_tokens += self.count_tokens(system_prompt)
         
         if total_tokens > self.max_tokens:
             raise ValueError(f"Запрос слишком большой: ~{total_tokens} токенов, максимум {self.max_tokens}")
         
-        return self.send_message_with_usage(user_message)
+        return self.send_message_with_usage(user_message, system_prompt=system_prompt)
 
-    def send_chunked_message_with_usage(self, user_text: str) -> Dict:
+    def send_chunked_message_with_usage(
+        self,
+        user_text: str,
+        max_concurrency: int = 1,
+        system_prompt: Optional[str] = None
+    ) -> Dict:
         """
-        Разбивает текст на чанки и отправляет их последовательно.
-        Собирает результаты и usage статистику.
+        Разбивает текст на чанки и отправляет их (до max_concurrency одновременно).
+        Собирает результаты в порядке чанков и суммирует usage статистику.
         """
-        system_tokens = self.count_tokens(self.system_prompt) if self.system_prompt else 0
+        if system_prompt is None:
+            system_prompt = self.system_prompt
+
+        system_tokens = self.count_tokens(system_prompt) if system_prompt else 0
         chunk_size = int(self.max_tokens * 0.8) - system_tokens
         
         chunks = self.split_text_into_chunks(user_text, chunk_size=chunk_size)
-        
-        full_text = []
-        total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
 
-        for i, chunk in enumerate(chunks, 1):
+        def _send_chunk(item):
+            i, chunk = item
             logging.info(f"Processing Claude chunk {i}/{len(chunks)}")
             
             chunk_message = f"[Часть {i} из {len(chunks)}]\n\n{chunk}"
             messages = [{"role": "user", "content": chunk_message}]
             
-            response = self._send_with_retry(messages, include_system=(i == 1))
+            return self._send_with_retry(messages, include_system=(i == 1), system_prompt=system_prompt)
+
+        workers = max(1, min(max_concurrency, len(chunks)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            responses = list(executor.map(_send_chunk, enumerate(chunks, 1)))
+        
+        full_text = []
+        total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
 
+        for response in responses:
             if response.content:
                 full_text.append(response.content[0].text.strip())
 
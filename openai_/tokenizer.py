@@ -0,0 +1,16 @@
+import tiktoken
+from   functools import lru_cache
+
+
+@lru_cache(maxsize=1)
+def get_tokenizer() -> tiktoken.Encoding:
+    return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: str) -> int:
+    """
+    Количество токенов по cl100k_base — общая оценка для всех провайдеров.
+    Считается один раз при сохранении промпта и при отправке кода, дальше передаётся в задачи.
+    Тяжёлая операция для больших текстов: в API вызывать через пул потоков.
+    """
+    return len(get_tokenizer().encode(text, disallowed_special=()))
@@ -0,0 +1,193 @@
+import sys
+
+
+sys.path.insert(0, '/app')
+
+import os
+import signal
+import socket
+import asyncio
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from rq.job        import Job, JobStatus
+from rq.queue      import Queue
+from rq.worker     import Worker
+from rq.executions import Execution
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+from rq.defaults   import DEFAULT_MAINTENANCE_TASK_INTERVAL
+from rq.utils      import as_text, now
+
+from api.core.redis_con import get_queue
+from api.core.metrics   import start_worker_metrics_server
+from api.core.security  import ASYNC_WORKER_CONCURRENCY, ASYNC_WORKER_THREADS
+from api.broker.task    import add_prompt_task_async, requeue_abandoned_job
+
+
+# Асинхронные версии задач, которые кладёт в очередь send_task
+ASYNC_TASKS = {
+    "api.broker.task.add_prompt_task": add_prompt_task_async,
+}
+
+DEQUEUE_TIMEOUT = 5
+RESULT_TTL = 500
+# Heartbeat воркера и его задач в StartedJobRegistry. Без heartbeat дольше HEARTBEAT_TTL
+# задачи считаются брошенными, и очистка реестров (любого воркера) возвращает их в очередь
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TTL = HEARTBEAT_INTERVAL + 60
+
+
+class AsyncWorker:
+    """
+    Воркер очереди to_aimodel на asyncio: держит до concurrency задач одновременно
+    в одном процессе. Формат задач и их статусы в Redis совместимы с обычным RQ воркером.
+    Регистрация воркера, heartbeat и очистка реестров — через rq.Worker, как у обычного воркера:
+    задачи в работе лежат в StartedJobRegistry, поэтому после падения процесса их вернут в очередь.
+    """
+    def __init__(self, queue: Queue, concurrency: int):
+        self.queue = queue
+        self.connection = queue.connection
+        self.concurrency = concurrency
+        self.name = f"async-{socket.gethostname()}-{os.getpid()}"
+        self._stopping = False
+        # Только для регистрации и обслуживания, задачи выполняет этот класс
+        self._rq_worker = Worker(
+            [queue], name=self.name, connection=self.connection,
+            worker_ttl=HEARTBEAT_TTL, exception_handlers=[requeue_abandoned_job]
+        )
+        self._executions = {}
+
+    def request_stop(self) -> None:
+        logging.info(f"Worker {self.name}: stop requested, finishing running jobs")
+        self._stopping = True
+
+    def _dequeue(self) -> Job | None:
+        """Блокирующий BLPOP из очереди (выполняется в потоке)"""
+        try:
+            _, job_id = Queue.lpop([self.queue.key], DEQUEUE_TIMEOUT, connection=self.connection)
+        except DequeueTimeout:
+            return None
+        try:
+            return Job.fetch(as_text(job_id), connection=self.connection)
+        except NoSuchJobError:
+            return None
+
+    def _mark_started(self, job: Job) -> None:
+        with self.connection.pipeline() as pipeline:
+            job.prepare_for_execution(self.name, pipeline=pipeline)
+            self._executions[job.id] = (job, Execution.create(job, HEARTBEAT_TTL, pipeline=pipeline))
+            pipeline.execute()
+
+    def _end_execution(self, job: Job, pipeline) -> None:
+        _, execution = self._executions.pop(job.id)
+        execution.delete(job=job, pipeline=pipeline)
+
+    def _mark_finished(self, job: Job, result) -> None:
+        job._result = result
+        with self.connection.pipeline() as pipeline:
+            job._handle_success(job.get_result_ttl(RESULT_TTL), pipeline=pipeline, worker_name=self.name)
+            self._end_execution(job, pipeline)
+            pipeline.execute()
+
+    def _mark_failed(self, job: Job, exc_string: str) -> None:
+        with self.connection.pipeline() as pipeline:
+            job.set_status(JobStatus.FAILED, pipeline=pipeline)
+            job._handle_failure(exc_string, pipeline=pipeline, worker_name=self.name)
+            self._end_execution(job, pipeline)
+            pipeline.execute()
+
+    def _heartbeat(self) -> None:
+        """Продлевает жизнь воркеру и всем его задачам в StartedJobRegistry"""
+        with self.connection.pipeline() as pipeline:
+            self._rq_worker.heartbeat(HEARTBEAT_TTL, pipeline=pipeline)
+            for job, execution in list(self._executions.values()):
+                execution.heartbeat(job.started_job_registry, HEARTBEAT_TTL, pipeline=pipeline)
+                job.heartbeat(now(), HEARTBEAT_TTL, pipeline=pipeline, xx=True)
+            pipeline.execute()
+
+    async def _maintain(self) -> None:
+        """Heartbeat каждые HEARTBEAT_INTERVAL; очистка реестров (возврат брошенных задач) — при старте и раз в интервал обслуживания RQ"""
+        last_cleaned = None
+        while True:
+            try:
+                await asyncio.to_thread(self._heartbeat)
+                if last_cleaned is None or (now() - last_cleaned).total_seconds() >= DEFAULT_MAINTENANCE_TASK_INTERVAL:
+                    await asyncio.to_thread(self._rq_worker.clean_registries)
+                    last_cleaned = now()
+            except Exception as e:
+                logging.error(f"Worker {self.name}: maintenance error: {e}")
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def _perform(self, job: Job) -> None:
+        handler = ASYNC_TASKS.get(job.func_name)
+        timeout = job.timeout or Queue.DEFAULT_TIMEOUT
+
+        await asyncio.to_thread(self._mark_started, job)
+        try:
+            if handler is not None:
+                result = await asyncio.wait_for(handler(*job.args, **job.kwargs), timeout=timeout)
+            else:
+                # Неизвестные задачи выполняем как обычный RQ, но в потоке
+                result = await asyncio.wait_for(asyncio.to_thread(job.func, *job.args, **job.kwargs), timeout=timeout)
+        except Exception:
+            exc_string = traceback.format_exc()
+            logging.error(f"Job {job.id} failed:\n{exc_string}")
+            await asyncio.to_thread(self._mark_failed, job, exc_string)
+        else:
+            await asyncio.to_thread(self._mark_finished, job, result)
+            logging.info(f"Job {job.id} OK")
+
+    async def run(self) -> None:
+        logging.info(f"Worker {self.name} listening on {self.queue.name}, concurrency={self.concurrency}")
+        await asyncio.to_thread(self._rq_worker.register_birth)
+        maintenance = asyncio.create_task(self._maintain())
+        slots = asyncio.Semaphore(self.concurrency)
+        running = set()
+
+        while not self._stopping:
+            # Новая задача забирается из очереди, только когда есть свободный слот
+            await slots.acquire()
+            try:
+                job = await asyncio.to_thread(self._dequeue)
+            except Exception as e:
+                logging.error(f"Dequeue error: {e}")
+                job = None
+                await asyncio.sleep(1)
+            if job is None:
+                slots.release()
+                continue
+
+            task = asyncio.create_task(self._perform(job))
+            running.add(task)
+
+            def _on_done(t, _running=running, _slots=slots):
+                _running.discard(t)
+                _slots.release()
+
+            task.add_done_callback(_on_done)
+
+        if running:
+            logging.info(f"Worker {self.name}: waiting for {len(running)} running jobs")
+            await asyncio.gather(*running, return_exceptions=True)
+
+        maintenance.cancel()
+        await asyncio.to_thread(self._rq_worker.register_death)
+
+
+async def main() -> None:
+    loop = asyncio.get_running_loop()
+    # Пул потоков для записи статусов в БД и подсчёта токенов
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_WORKER_THREADS))
+
+    start_worker_metrics_server()
+    worker = AsyncWorker(get_queue(), concurrency=ASYNC_WORKER_CONCURRENCY)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.request_stop)
+
+    await worker.run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
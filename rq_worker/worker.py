@@ -3,11 +3,18 @@ import sys
 
 sys.path.insert(0, '/app') 
 
-import redis
-from rq import Worker, Queue
+from rq import SimpleWorker
+from api.core.redis_con import get_redis, get_queue
+from api.core.metrics   import start_worker_metrics_server
+from api.broker.task    import requeue_abandoned_job
 
-redis_conn = redis.Redis(host='redis', port=6379)
-queues = [Queue('to_aimodel', connection=redis_conn)]
+start_worker_metrics_server()
 
-worker = Worker(queues, connection=redis_conn)
+redis_conn = get_redis()
+queues = [get_queue()]
+
+# SimpleWorker выполняет задачи в своём процессе без fork, поэтому
+# кеши клиентов провайдеров и исходного кода переживают смену задач
+# Задачи умерших воркеров при очистке реестров возвращаются в очередь
+worker = SimpleWorker(queues, connection=redis_conn, exception_handlers=[requeue_abandoned_job])
 worker.work()
\ No newline at end of file
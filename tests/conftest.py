@@ -0,0 +1,9 @@
+import os
+import sys
+from   pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# api.core.db_con создаёт engine при импорте и падает без DB_*; к базе тесты не подключаются
+for name, value in (("DB_USER", "test"), ("DB_PASSWORD", "test"), ("DB_NAME", "test"), ("DB_PORT", "5432")):
+    os.environ.setdefault(name, value)
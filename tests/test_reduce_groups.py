@@ -0,0 +1,47 @@
+"""Группировка частичных результатов map-reduce по бюджету reduce-вызова"""
+from api.broker.pipeline import plan_reduce_groups, split_oversized_results, _next_level_texts
+
+
+class WordClient:
+    """Токен — слово"""
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def split_text_into_chunks(self, text: str, chunk_size: int) -> list:
+        words = text.split()
+        return [" ".join(words[i:i + chunk_size]) for i in range(0, len(words), chunk_size)]
+
+
+def words(count: int) -> str:
+    return " ".join(["w"] * count)
+
+
+def test_groups_fit_budget():
+    client = WordClient()
+    groups = plan_reduce_groups(client, [words(30), words(30), words(30), words(50), words(10)], 100)
+    assert [indices for indices, _, _ in groups] == [[0, 1, 2], [3, 4]]
+    assert all(tokens <= 100 for _, tokens, _ in groups)
+
+
+def test_results_over_half_budget_are_not_merged():
+    client = WordClient()
+    texts = [words(60), words(70), words(80)]
+    groups = plan_reduce_groups(client, texts, 100)
+    assert [indices for indices, _, _ in groups] == [[0], [1], [2]]
+    assert all(tokens <= 100 and call for _, tokens, call in groups)
+
+
+def test_single_result_passes_through_when_others_merge():
+    client = WordClient()
+    texts = [words(60), words(30), words(80)]
+    groups = plan_reduce_groups(client, texts, 100)
+    assert groups == [([0, 1], 90, True), ([2], 80, False)]
+    assert _next_level_texts(texts, groups, [{"text": "merged"}]) == ["merged", words(80)]
+
+
+def test_oversized_result_is_split():
+    client = WordClient()
+    texts = split_oversized_results(client, [words(10), words(250)], 100)
+    assert [client.count_tokens(text) for text in texts] == [10, 50, 50, 50, 50, 50]
+    assert all(tokens <= 100 for _, tokens, _ in plan_reduce_groups(client, texts, 100))